@@ -0,0 +1,269 @@
+"""Benchmark das operações do UserService em diferentes escalas
+
+Uso (a partir de backend/):
+
+    python benchmarks/bench_user_service.py --scales 10000,100000 --output results.json
+    python benchmarks/bench_user_service.py --scales 10000 --compare results.json
+
+Cada escala popula um UserService com usuários, corridas e notificações
+sintéticos e mede cada operação individualmente. O resultado é um JSON
+com média e percentis por operação e a memória por corrida/notificação
+(registro armazenado vs. modelo Pydantic equivalente); no modo --compare, operações cujo
+p50 piorou mais que --threshold em relação ao baseline são sinalizadas
+e o processo termina com código 1.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from columnar import ColumnarRideStore  # noqa: E402
+from memory import deep_sizeof, estimate_entries  # noqa: E402
+from models import User, UserRole, RideStatus, TripData  # noqa: E402
+from records import NotificationRecord, RideRecord, TripRecord, to_micros  # noqa: E402
+from user_service import UserService  # noqa: E402
+
+# Distribuição de status das corridas históricas
+HISTORICAL_STATUSES = [RideStatus.FINALIZADO, RideStatus.RECUSADO, RideStatus.CANCELADO]
+
+
+def _percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _summary(samples: List[float]) -> Dict[str, Any]:
+    return {
+        "samples": len(samples),
+        "mean_us": sum(samples) / len(samples) * 1e6,
+        "p50_us": _percentile(samples, 0.50) * 1e6,
+        "p95_us": _percentile(samples, 0.95) * 1e6,
+        "p99_us": _percentile(samples, 0.99) * 1e6,
+    }
+
+
+def seed(scale: int, rng: random.Random, columnar: bool = False) -> Dict[str, Any]:
+    """Popula um UserService com `scale` corridas e usuários/notificações proporcionais"""
+    service = UserService(columns=ColumnarRideStore() if columnar else None)
+    n_drivers = max(20, scale // 20)
+    n_enterprises = max(5, scale // 200)
+    now = datetime.utcnow()
+    now_us = to_micros(now)
+
+    drivers = [f"BDRV-{i}" for i in range(n_drivers)]
+    enterprises = [f"BEMP-{i}" for i in range(n_enterprises)]
+    for user_id in drivers:
+        service._apply_user(User(id=user_id, name=user_id, role=UserRole.DRIVER, contact="bench@example.com", created_at=now))
+    for user_id in enterprises:
+        service._apply_user(User(id=user_id, name=user_id, role=UserRole.ENTERPRISE, contact="bench@example.com", created_at=now))
+
+    # Metade dos motoristas fica livre para os benchmarks de criação
+    busy_drivers = drivers[: n_drivers // 2]
+    free_drivers = drivers[n_drivers // 2:]
+
+    for i in range(scale):
+        driver_id = rng.choice(busy_drivers)
+        status = rng.choice(HISTORICAL_STATUSES)
+        if i < len(busy_drivers):
+            driver_id = busy_drivers[i]
+            status = RideStatus.EM_ANDAMENTO
+        ride_id = f"BREQ-{i}"
+        trip = TripRecord(f"BTRIP-{i}", driver_id, ["-23.55,-46.63", "-23.56,-46.64", "-23.57,-46.65"])
+        service._apply_ride(RideRecord(
+            ride_id, rng.choice(enterprises), driver_id, trip, status,
+            created_at=now_us - rng.randint(0, 90 * 24 * 3600) * 1_000_000,
+        ))
+
+    for i in range(scale):
+        user_id = rng.choice(drivers) if i % 2 else rng.choice(enterprises)
+        notifications = service.notifications[user_id]
+        if len(notifications) >= 50:
+            continue
+        notifications.append(NotificationRecord(
+            f"BNOTIF-{i}", user_id, "ride_request", "Nova Corrida Disponível",
+            f"A empresa {user_id} enviou uma solicitação de corrida.",
+            {"ride_request_id": f"BREQ-{i}", "enterprise_name": user_id},
+            read=bool(i % 3), created_at=now_us - i * 1_000_000,
+        ))
+
+    return {"service": service, "drivers": drivers, "free_drivers": free_drivers, "enterprises": enterprises}
+
+
+def memory_per_entry(service: UserService, sample: int = 1000) -> Dict[str, Any]:
+    """Bytes por corrida/notificação armazenada e do modelo Pydantic equivalente"""
+    rides = service.ride_requests
+    notifications = [item for items in service.notifications.values() for item in items]
+    result = {
+        "ride_requests": estimate_entries(rides.items(), len(rides), 0, sample),
+        "notifications": estimate_entries(((n,) for n in notifications), len(notifications), 0, sample),
+    }
+    for name, records in (("ride_requests", list(rides.values())[:sample]), ("notifications", notifications[:sample])):
+        if records:
+            # Mesma medida usada para os registros: ID + objeto, sem contar duas vezes o que compartilham
+            model_bytes = 0
+            for record in records:
+                seen: set = set()
+                model_bytes += deep_sizeof(record.id, seen) + deep_sizeof(record.to_model(), seen)
+            model_bytes /= len(records)
+            result[name]["model_bytes_per_entry"] = round(model_bytes, 1)
+            result[name]["reduction"] = round(model_bytes / result[name]["bytes_per_entry"], 1)
+    return result
+
+
+async def _measure(fn: Callable[[int], Awaitable[Any]], iterations: int, max_seconds: float) -> List[float]:
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    for i in range(iterations):
+        start = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    return samples
+
+
+async def run_scale(scale: int, iterations: int, max_seconds: float, rng: random.Random,
+                    columnar: bool = False) -> Dict[str, Any]:
+    seed_start = time.perf_counter()
+    data = seed(scale, rng, columnar)
+    seed_seconds = time.perf_counter() - seed_start
+    service: UserService = data["service"]
+    memory = memory_per_entry(service)
+    trip_template = TripData(trip_id="BENCH", driver="", route=["-23.55,-46.63", "-23.56,-46.64", "-23.57,-46.65"])
+
+    created: List[str] = []
+    free_drivers = list(data["free_drivers"])
+    iterations = min(iterations, len(free_drivers))
+
+    async def create(i):
+        driver_id = free_drivers[i]
+        ride = await service.create_ride_request(
+            rng.choice(data["enterprises"]), driver_id,
+            trip_template.model_copy(update={"trip_id": f"BENCH-{i}", "driver": driver_id}),
+        )
+        created.append(ride.id)
+
+    async def accept(i):
+        ride = service.ride_requests[created[i]]
+        await service.accept_ride_request(ride.id, ride.driver_id)
+
+    def rides_for(user_ids):
+        async def op(i):
+            await service.get_ride_requests_for_user(user_ids[i % len(user_ids)])
+        return op
+
+    async def scan(i):
+        until = datetime.utcnow() - timedelta(days=rng.randint(0, 60))
+        await service.scan_rides(HISTORICAL_STATUSES[i % len(HISTORICAL_STATUSES)],
+                                 until - timedelta(days=30), until, limit=50)
+
+    async def notifications(i):
+        await service.get_notifications(rng.choice(data["drivers"]))
+
+    async def mark_read(i):
+        user_id = rng.choice(data["drivers"])
+        user_notifications = service.notifications[user_id]
+        if user_notifications:
+            await service.mark_notification_read(user_id, user_notifications[-1].id)
+
+    gc.collect()
+    results: Dict[str, Any] = {}
+    results["create_ride_request"] = _summary(await _measure(create, iterations, max_seconds))
+    results["accept_ride_request"] = _summary(await _measure(accept, len(created), max_seconds))
+    results["get_ride_requests_for_user[driver]"] = _summary(
+        await _measure(rides_for(data["drivers"]), iterations, max_seconds))
+    results["get_ride_requests_for_user[enterprise]"] = _summary(
+        await _measure(rides_for(data["enterprises"]), iterations, max_seconds))
+    results["get_ride_requests_for_user[admin]"] = _summary(
+        await _measure(rides_for(["ADM-001"]), iterations, max_seconds))
+    results["scan_rides"] = _summary(await _measure(scan, iterations, max_seconds))
+    results["get_notifications"] = _summary(await _measure(notifications, iterations, max_seconds))
+    results["mark_notification_read"] = _summary(await _measure(mark_read, iterations, max_seconds))
+
+    return {"seed_seconds": seed_seconds, "memory": memory, "operations": results}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Lista as operações cujo p50 piorou mais que `threshold` (fração) em relação ao baseline"""
+    regressions = []
+    for scale, scale_results in results["scales"].items():
+        base_scale = baseline.get("scales", {}).get(scale)
+        if not base_scale:
+            continue
+        for name, current in scale_results["operations"].items():
+            base = base_scale["operations"].get(name)
+            if not base or not base["p50_us"]:
+                continue
+            change = current["p50_us"] / base["p50_us"] - 1
+            if change > threshold:
+                regressions.append(f"{scale} {name}: p50 {base['p50_us']:.1f}us -> {current['p50_us']:.1f}us (+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10000,100000,1000000", help="número de corridas por escala, separado por vírgula")
+    parser.add_argument("--iterations", type=int, default=500, help="amostras por operação")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="tempo máximo por operação")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="arquivo JSON de saída (padrão: stdout)")
+    parser.add_argument("--columnar", action="store_true", help="usa o store colunar (numpy) nas varreduras")
+    parser.add_argument("--compare", help="arquivo JSON de baseline para detectar regressões")
+    parser.add_argument("--threshold", type=float, default=0.20, help="piora tolerada no p50 (0.20 = 20%%)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "git_revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "columnar": args.columnar,
+        },
+        "scales": {},
+    }
+
+    for scale in [int(value) for value in args.scales.split(",") if value]:
+        print(f"# escala {scale}...", file=sys.stderr)
+        results["scales"][str(scale)] = asyncio.run(run_scale(scale, args.iterations, args.max_seconds, rng, args.columnar))
+
+    encoded = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(encoded)
+    else:
+        print(encoded)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSÃO {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("# sem regressões", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
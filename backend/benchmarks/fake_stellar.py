@@ -0,0 +1,502 @@
+"""Servidor local que imita o Horizon e o Soroban RPC usados pelo StellarContractService
+
+Uso (a partir de backend/):
+
+    python benchmarks/fake_stellar.py --port 8001 --ledger-close 1.0 \\
+        --latency simulateTransaction=0.05:0.01 --latency sendTransaction=0.1 \\
+        --error-rate sendTransaction=0.02 --tx-failure-rate 0.01
+
+e, em outro terminal, o backend apontando para ele:
+
+    STELLAR_RPC_MODE=rpc HORIZON_URL=http://127.0.0.1:8001 \\
+    SOROBAN_RPC_URL=http://127.0.0.1:8001 STELLAR_CONTRACT_ID=<qualquer C...> \\
+    STELLAR_TX_POLL_INTERVAL=0.2 python main.py
+
+Rotas do Horizon: GET /accounts/{id} e GET /ledgers. Métodos JSON-RPC
+(POST /): getHealth, getNetwork, getLatestLedger, simulateTransaction,
+sendTransaction, getTransaction e getEvents. O contrato de viagens
+(initialize, get_admin, criar_viagem, marcar_saida, marcar_meio,
+marcar_chegada, get_viagem) é executado em memória, sem verificação de
+autorização; transações enviadas ficam pendentes até o fechamento do
+próximo ledger. GET /_stats retorna contadores do servidor.
+
+Latência por método: --latency metodo=media[:desvio] (segundos, normal
+truncada em zero; "horizon" vale para as rotas do Horizon e "*" para
+todos). Falhas: --error-rate metodo=fração responde erro JSON-RPC (503
+no Horizon) e --tx-failure-rate faz transações falharem ao serem
+aplicadas no ledger.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from stellar_sdk import Address, Keypair, Network, TransactionEnvelope, scval, xdr
+from stellar_sdk.operation import InvokeHostFunction
+
+PROTOCOL_VERSION = 22
+
+# Códigos de erro do contrato em memória
+CONTRACT_ERRORS = {
+    "JaInicializado": 1,
+    "NaoInicializado": 2,
+    "ViagemJaExiste": 3,
+    "ViagemNaoEncontrada": 4,
+    "EstadoInvalido": 5,
+}
+
+# função -> (status exigido, novo status)
+TRANSITIONS = {
+    "marcar_saida": ("Pendente", "EmAndamento"),
+    "marcar_meio": ("EmAndamento", "PontoIntermediario"),
+    "marcar_chegada": ("PontoIntermediario", "Finalizada"),
+}
+
+
+class ContractError(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"HostError: Error(Contract, #{CONTRACT_ERRORS.get(name, 0)}) {name}")
+        self.name = name
+
+
+class TripContract:
+    """Estado e regras do contrato de viagens"""
+
+    def __init__(self):
+        self.admin: Optional[xdr.SCVal] = None
+        self.trips: Dict[str, Dict[str, Any]] = {}
+
+    def call(self, function: str, args: List[xdr.SCVal], commit: bool) -> Tuple[xdr.SCVal, Optional[xdr.SCVal]]:
+        """Executa a função; retorna (valor de retorno, valor do evento ou None)
+
+        Com commit=False (simulação) as regras são verificadas sem alterar o estado.
+        """
+        if function == "initialize":
+            if self.admin is not None:
+                raise ContractError("JaInicializado")
+            if commit:
+                self.admin = args[0]
+            return scval.to_void(), args[0]
+        if function == "get_admin":
+            if self.admin is None:
+                raise ContractError("NaoInicializado")
+            return self.admin, None
+
+        trip_id = scval.from_string(args[0]).decode()
+        if function == "criar_viagem":
+            if trip_id in self.trips:
+                raise ContractError("ViagemJaExiste")
+            if commit:
+                self.trips[trip_id] = {
+                    "status": "Pendente",
+                    "saida_checkpoint": args[1],
+                    "meio_checkpoint": args[2],
+                    "chegada_checkpoint": args[3],
+                }
+            return scval.to_void(), scval.to_symbol("Pendente")
+
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            raise ContractError("ViagemNaoEncontrada")
+        if function == "get_viagem":
+            return scval.to_struct({
+                "trip_id": scval.to_string(trip_id),
+                "status": scval.to_enum(trip["status"], None),
+                "saida_checkpoint": trip["saida_checkpoint"],
+                "meio_checkpoint": trip["meio_checkpoint"],
+                "chegada_checkpoint": trip["chegada_checkpoint"],
+            }), None
+        if function in TRANSITIONS:
+            required, new_status = TRANSITIONS[function]
+            if trip["status"] != required:
+                raise ContractError("EstadoInvalido")
+            if commit:
+                trip["status"] = new_status
+            return scval.to_void(), scval.to_symbol(new_status)
+        raise ContractError("FuncaoInexistente")
+
+
+class PendingTransaction:
+    __slots__ = ("hash", "envelope_xdr", "source", "sequence", "contract_id", "function", "args", "received_at")
+
+    def __init__(self, tx_hash: str, envelope_xdr: str, source: str, sequence: int,
+                 contract_id: str, function: str, args: List[xdr.SCVal]):
+        self.hash = tx_hash
+        self.envelope_xdr = envelope_xdr
+        self.source = source
+        self.sequence = sequence
+        self.contract_id = contract_id
+        self.function = function
+        self.args = args
+        self.received_at = time.time()
+
+
+class FakeStellar:
+    """Estado do ledger simulado: contas, contratos, transações e eventos"""
+
+    def __init__(self, passphrase: str, ledger_close: float, retention_ledgers: int,
+                 latency: Dict[str, Tuple[float, float]], error_rates: Dict[str, float],
+                 tx_failure_rate: float, rng: random.Random):
+        self.passphrase = passphrase
+        self.ledger_close = ledger_close
+        self.retention_ledgers = retention_ledgers
+        self.latency = latency
+        self.error_rates = error_rates
+        self.tx_failure_rate = tx_failure_rate
+        self.rng = rng
+
+        self.ledger = 1000
+        self.ledger_close_time = int(time.time())
+        self.ledger_times: "OrderedDict[int, int]" = OrderedDict({self.ledger: self.ledger_close_time})
+        self.sequences: Dict[str, int] = {}
+        self.contracts: Dict[str, TripContract] = {}
+        self.pending: List[PendingTransaction] = []
+        self.transactions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.events: deque = deque()
+        self.stats: Counter = Counter()
+
+        # Recursos fixos devolvidos em toda simulação
+        self.transaction_data = xdr.SorobanTransactionData(
+            ext=xdr.SorobanTransactionDataExt(0),
+            resources=xdr.SorobanResources(
+                footprint=xdr.LedgerFootprint(read_only=[], read_write=[]),
+                instructions=xdr.Uint32(1_000_000),
+                disk_read_bytes=xdr.Uint32(2_000),
+                write_bytes=xdr.Uint32(1_000),
+            ),
+            resource_fee=xdr.Int64(50_000),
+        ).to_xdr()
+
+    # =================== INJEÇÃO DE LATÊNCIA E FALHAS ===================
+
+    async def delay(self, method: str):
+        mean, stddev = self.latency.get(method, self.latency.get("*", (0.0, 0.0)))
+        if mean or stddev:
+            await asyncio.sleep(max(0.0, self.rng.gauss(mean, stddev)))
+
+    def should_fail(self, method: str) -> bool:
+        rate = self.error_rates.get(method, self.error_rates.get("*", 0.0))
+        return rate > 0 and self.rng.random() < rate
+
+    # =================== LEDGER ===================
+
+    @property
+    def oldest_ledger(self) -> int:
+        return next(iter(self.ledger_times))
+
+    def ledger_info(self) -> Dict[str, Any]:
+        return {
+            "latestLedger": self.ledger,
+            "latestLedgerCloseTime": self.ledger_close_time,
+            "oldestLedger": self.oldest_ledger,
+            "oldestLedgerCloseTime": self.ledger_times[self.oldest_ledger],
+        }
+
+    def contract(self, contract_id: str) -> TripContract:
+        contract = self.contracts.get(contract_id)
+        if contract is None:
+            contract = self.contracts[contract_id] = TripContract()
+        return contract
+
+    def close_ledger(self):
+        """Fecha um ledger aplicando as transações pendentes em ordem de sequência"""
+        self.ledger += 1
+        self.ledger_close_time = int(time.time())
+        self.ledger_times[self.ledger] = self.ledger_close_time
+        pending, self.pending = self.pending, []
+        pending.sort(key=lambda tx: (tx.source, tx.sequence))
+
+        for order, tx in enumerate(pending, start=1):
+            record = {
+                "status": "FAILED",
+                "ledger": self.ledger,
+                "createdAt": self.ledger_close_time,
+                "applicationOrder": order,
+                "feeBump": False,
+                "envelopeXdr": tx.envelope_xdr,
+            }
+            if tx.sequence <= self.sequences.get(tx.source, 0):
+                self.stats["tx_bad_seq"] += 1
+            elif self.rng.random() < self.tx_failure_rate:
+                self.sequences[tx.source] = tx.sequence
+                self.stats["tx_injected_failures"] += 1
+            else:
+                self.sequences[tx.source] = tx.sequence
+                try:
+                    _, event_value = self.contract(tx.contract_id).call(tx.function, tx.args, commit=True)
+                except ContractError:
+                    self.stats["tx_contract_errors"] += 1
+                else:
+                    record["status"] = "SUCCESS"
+                    self.stats["tx_applied"] += 1
+                    if event_value is not None:
+                        self.events.append(self._event(tx, order, event_value))
+            self.transactions[tx.hash] = record
+
+        self._purge()
+
+    def _event(self, tx: PendingTransaction, order: int, value: xdr.SCVal) -> Dict[str, Any]:
+        topic = [scval.to_symbol(tx.function)]
+        if tx.args and tx.function not in ("initialize", "get_admin"):
+            topic.append(tx.args[0])
+        return {
+            "type": "contract",
+            "ledger": self.ledger,
+            "ledgerClosedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.ledger_close_time)),
+            "contractId": tx.contract_id,
+            "id": f"{self.ledger:019d}-{order:010d}",
+            "pagingToken": f"{self.ledger:019d}-{order:010d}",
+            "topic": [item.to_xdr() for item in topic],
+            "value": value.to_xdr(),
+            "inSuccessfulContractCall": True,
+            "operationIndex": 0,
+            "transactionIndex": order,
+            "txHash": tx.hash,
+        }
+
+    def _purge(self):
+        oldest = self.ledger - self.retention_ledgers
+        while self.ledger_times and next(iter(self.ledger_times)) < oldest:
+            self.ledger_times.popitem(last=False)
+        while self.transactions and next(iter(self.transactions.values()))["ledger"] < oldest:
+            self.transactions.popitem(last=False)
+        while self.events and self.events[0]["ledger"] < oldest:
+            self.events.popleft()
+
+    async def run_ledgers(self):
+        while True:
+            await asyncio.sleep(self.ledger_close)
+            self.close_ledger()
+
+    # =================== TRANSAÇÕES ===================
+
+    def decode(self, envelope_xdr: str) -> PendingTransaction:
+        envelope = TransactionEnvelope.from_xdr(envelope_xdr, self.passphrase)
+        transaction = envelope.transaction
+        operation = transaction.operations[0] if len(transaction.operations) == 1 else None
+        if not isinstance(operation, InvokeHostFunction) or operation.host_function.invoke_contract is None:
+            raise ValueError("Apenas transações com uma operação InvokeContract são suportadas")
+        invoke = operation.host_function.invoke_contract
+        return PendingTransaction(
+            envelope.hash_hex(),
+            envelope_xdr,
+            transaction.source.account_id,
+            transaction.sequence,
+            Address.from_xdr_sc_address(invoke.contract_address).address,
+            invoke.function_name.sc_symbol.decode(),
+            list(invoke.args),
+        )
+
+    # =================== MÉTODOS JSON-RPC ===================
+
+    def rpc_getHealth(self, params):
+        return {"status": "healthy", "latestLedger": self.ledger, "oldestLedger": self.oldest_ledger,
+                "ledgerRetentionWindow": self.retention_ledgers}
+
+    def rpc_getNetwork(self, params):
+        return {"passphrase": self.passphrase, "protocolVersion": PROTOCOL_VERSION}
+
+    def rpc_getLatestLedger(self, params):
+        return {"id": f"{self.ledger:064x}", "protocolVersion": PROTOCOL_VERSION, "sequence": self.ledger}
+
+    def rpc_simulateTransaction(self, params):
+        tx = self.decode(params["transaction"])
+        try:
+            result, _ = self.contract(tx.contract_id).call(tx.function, tx.args, commit=False)
+        except ContractError as e:
+            return {"error": str(e), "events": [], "latestLedger": self.ledger}
+        return {
+            "transactionData": self.transaction_data,
+            "minResourceFee": "50000",
+            "events": [],
+            "results": [{"auth": [], "xdr": result.to_xdr()}],
+            "latestLedger": self.ledger,
+        }
+
+    def rpc_sendTransaction(self, params):
+        envelope_xdr = params["transaction"]
+        tx = self.decode(envelope_xdr)
+        response = {"hash": tx.hash, "latestLedger": self.ledger, "latestLedgerCloseTime": self.ledger_close_time}
+        if tx.hash in self.transactions or any(pending.hash == tx.hash for pending in self.pending):
+            return {**response, "status": "DUPLICATE"}
+        if not TransactionEnvelope.from_xdr(envelope_xdr, self.passphrase).signatures:
+            return {**response, "status": "ERROR", "errorResultXdr": ""}
+        self.pending.append(tx)
+        return {**response, "status": "PENDING"}
+
+    def rpc_getTransaction(self, params):
+        tx_hash = params["hash"]
+        record = self.transactions.get(tx_hash)
+        response = {"txHash": tx_hash, **self.ledger_info()}
+        if record is None:
+            return {**response, "status": "NOT_FOUND"}
+        return {**response, **record}
+
+    def rpc_getEvents(self, params):
+        pagination = params.get("pagination") or {}
+        limit = int(pagination.get("limit") or 100)
+        cursor = pagination.get("cursor")
+        start_ledger = int(params.get("startLedger") or self.oldest_ledger)
+        contract_ids = set()
+        for event_filter in params.get("filters") or []:
+            contract_ids.update(event_filter.get("contractIds") or [])
+
+        events = []
+        for event in self.events:
+            if cursor is not None and event["id"] <= cursor:
+                continue
+            if cursor is None and event["ledger"] < start_ledger:
+                continue
+            if contract_ids and event["contractId"] not in contract_ids:
+                continue
+            events.append(event)
+            if len(events) >= limit:
+                break
+        next_cursor = events[-1]["id"] if events else (cursor or f"{self.ledger:019d}-{0:010d}")
+        return {"events": events, "cursor": next_cursor, **self.ledger_info()}
+
+
+def create_app(fake: FakeStellar) -> Starlette:
+    async def rpc(request: Request):
+        payload = await request.json()
+        method = payload.get("method", "")
+        request_id = payload.get("id")
+        fake.stats[f"rpc.{method}"] += 1
+        await fake.delay(method)
+
+        handler = getattr(fake, f"rpc_{method}", None)
+        if handler is None:
+            error = {"code": -32601, "message": f"method not found: {method}"}
+        elif fake.should_fail(method):
+            fake.stats[f"injected_error.{method}"] += 1
+            error = {"code": -32603, "message": "injected failure"}
+        else:
+            try:
+                return JSONResponse({"jsonrpc": "2.0", "id": request_id, "result": handler(payload.get("params") or {})})
+            except (KeyError, ValueError) as e:
+                error = {"code": -32602, "message": f"invalid params: {e}"}
+        return JSONResponse({"jsonrpc": "2.0", "id": request_id, "error": error})
+
+    async def horizon_guard(name: str) -> Optional[JSONResponse]:
+        fake.stats[f"horizon.{name}"] += 1
+        await fake.delay("horizon")
+        if fake.should_fail("horizon"):
+            fake.stats["injected_error.horizon"] += 1
+            return JSONResponse({"title": "Service Unavailable", "status": 503}, status_code=503)
+        return None
+
+    async def account(request: Request):
+        failure = await horizon_guard("account")
+        if failure is not None:
+            return failure
+        account_id = request.path_params["account_id"]
+        try:
+            Keypair.from_public_key(account_id)
+        except Exception:
+            return JSONResponse({"title": "Resource Missing", "status": 404}, status_code=404)
+        # Contas desconhecidas são criadas sob demanda, como se já estivessem financiadas
+        sequence = fake.sequences.setdefault(account_id, fake.ledger << 32)
+        return JSONResponse({
+            "id": account_id,
+            "account_id": account_id,
+            "sequence": str(sequence),
+            "subentry_count": 0,
+            "last_modified_ledger": fake.ledger,
+            "thresholds": {"low_threshold": 0, "med_threshold": 0, "high_threshold": 0},
+            "balances": [{"balance": "10000.0000000", "asset_type": "native"}],
+            "signers": [{"weight": 1, "key": account_id, "type": "ed25519_public_key"}],
+        })
+
+    async def ledgers(request: Request):
+        failure = await horizon_guard("ledgers")
+        if failure is not None:
+            return failure
+        return JSONResponse({"_embedded": {"records": [{
+            "id": f"{fake.ledger:064x}",
+            "hash": f"{fake.ledger:064x}",
+            "sequence": fake.ledger,
+            "closed_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(fake.ledger_close_time)),
+            "protocol_version": PROTOCOL_VERSION,
+        }]}})
+
+    async def stats(request: Request):
+        return JSONResponse({
+            "ledger": fake.ledger,
+            "pending": len(fake.pending),
+            "transactions": len(fake.transactions),
+            "events": len(fake.events),
+            "trips": sum(len(contract.trips) for contract in fake.contracts.values()),
+            "counters": dict(fake.stats),
+        })
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        task = asyncio.create_task(fake.run_ledgers())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    return Starlette(
+        routes=[
+            Route("/", rpc, methods=["POST"]),
+            Route("/accounts/{account_id}", account, methods=["GET"]),
+            Route("/ledgers", ledgers, methods=["GET"]),
+            Route("/_stats", stats, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+    )
+
+
+def _parse_latency(values: List[str]) -> Dict[str, Tuple[float, float]]:
+    latency = {}
+    for value in values:
+        method, _, spec = value.partition("=")
+        mean, _, stddev = spec.partition(":")
+        latency[method] = (float(mean), float(stddev or 0))
+    return latency
+
+
+def _parse_rates(values: List[str]) -> Dict[str, float]:
+    return {method: float(rate) for method, _, rate in (value.partition("=") for value in values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--passphrase", default=os.getenv("SOROBAN_NETWORK_PASSPHRASE", Network.TESTNET_NETWORK_PASSPHRASE))
+    parser.add_argument("--ledger-close", type=float, default=5.0, help="segundos entre fechamentos de ledger")
+    parser.add_argument("--retention-ledgers", type=int, default=1440, help="ledgers mantidos para getTransaction/getEvents")
+    parser.add_argument("--latency", action="append", default=[], help="metodo=media[:desvio] em segundos (repetível)")
+    parser.add_argument("--error-rate", action="append", default=[], help="metodo=fração de respostas com erro (repetível)")
+    parser.add_argument("--tx-failure-rate", type=float, default=0.0, help="fração de transações que falham no ledger")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeStellar(
+        passphrase=args.passphrase,
+        ledger_close=args.ledger_close,
+        retention_ledgers=args.retention_ledgers,
+        latency=_parse_latency(args.latency),
+        error_rates=_parse_rates(args.error_rate),
+        tx_failure_rate=args.tx_failure_rate,
+        rng=random.Random(args.seed),
+    )
+
+    import uvicorn
+    print(f"# fake Stellar em http://{args.host}:{args.port} (ledger a cada {args.ledger_close}s)", file=sys.stderr)
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""Gerador de carga ponta a ponta simulando empresas e motoristas
+
+Uso (a partir de backend/):
+
+    # Em processo, chamando main.app diretamente pela interface ASGI
+    python benchmarks/loadgen.py --enterprises 20 --drivers 200 --duration 120
+
+    # Contra um servidor uvicorn em execução
+    python benchmarks/loadgen.py --url http://127.0.0.1:3000 --enterprises 20 --drivers 200
+
+Cada empresa cria corridas para motoristas livres e inicia as aceitas;
+cada motorista aceita (ou rejeita) as solicitações recebidas e marca
+saída, meio e chegada no contrato. Ambos consultam o dashboard na
+cadência real do frontend (motorista a cada 10 s, empresa a cada 15 s),
+que pode ser acelerada com --time-scale. O relatório traz throughput,
+latência p50/p95/p99 por rota e o atraso do event loop.
+
+A API não tem transição que encerre a corrida: depois da chegada ela
+continua EmAndamento e o motorista não recebe outra. Cada motorista
+atende no máximo uma corrida; quando não sobra motorista livre, o
+restante da execução é só consulta aos dashboards. O relatório traz
+esse instante (drivers_exhausted_after_seconds): dimensione --drivers
+para que ele não chegue antes do fim de --duration.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DRIVER_POLL_SECONDS = 10
+ENTERPRISE_POLL_SECONDS = 15
+
+
+class ASGIClient:
+    """Cliente que chama a aplicação ASGI no mesmo processo"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        path_only, _, query = path.partition("?")
+        raw_headers = [(b"host", b"loadgen")]
+        if body is not None:
+            raw_headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        for name, value in (headers or {}).items():
+            raw_headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path_only, "raw_path": path_only.encode(),
+            "query_string": query.encode(), "root_path": "", "headers": raw_headers,
+            "client": ("127.0.0.1", 0), "server": ("loadgen", 80),
+        }
+        request_sent = False
+        response_done = asyncio.Event()
+        status = 0
+        chunks: List[bytes] = []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body or b"", "more_body": False}
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks)
+
+    async def start(self):
+        """Executa o protocolo lifespan (startup) da aplicação, se houver"""
+        self._lifespan_queue: asyncio.Queue = asyncio.Queue()
+        self._lifespan_events: asyncio.Queue = asyncio.Queue()
+        await self._lifespan_queue.put({"type": "lifespan.startup"})
+
+        async def receive():
+            return await self._lifespan_queue.get()
+
+        async def send(message):
+            await self._lifespan_events.put(message)
+
+        self._lifespan_task = asyncio.create_task(self.app({"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}, receive, send))
+        event = await self._lifespan_events.get()
+        if event["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"Falha no startup da aplicação: {event}")
+
+    async def close(self):
+        await self._lifespan_queue.put({"type": "lifespan.shutdown"})
+        await self._lifespan_events.get()
+        await self._lifespan_task
+
+
+class HTTPClient:
+    """Cliente HTTP/1.1 mínimo com pool de conexões keep-alive"""
+
+    def __init__(self, url: str, connections: int):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connections = connections
+        self._pool: asyncio.Queue = asyncio.Queue()
+
+    async def start(self):
+        for _ in range(self.connections):
+            await self._pool.put(None)
+
+    async def close(self):
+        while not self._pool.empty():
+            connection = self._pool.get_nowait()
+            if connection:
+                connection[1].close()
+
+    async def request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        connection = await self._pool.get()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(self.host, self.port)
+            reader, writer = connection
+            lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body or b'')}"]
+            if body is not None:
+                lines.append("Content-Type: application/json")
+            lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+            await writer.drain()
+
+            head = await reader.readuntil(b"\r\n\r\n")
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")
+            status = int(status_line.split()[1])
+            response_headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    response_headers[name.strip().lower()] = value.strip()
+            payload = await reader.readexactly(int(response_headers.get("content-length", 0)))
+            if response_headers.get("connection", "").lower() == "close":
+                writer.close()
+                connection = None
+            return status, payload
+        except Exception:
+            if connection:
+                connection[1].close()
+            connection = None
+            raise
+        finally:
+            await self._pool.put(connection)
+
+
+class Stats:
+    """Latências por rota, erros e atraso do event loop"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+        self.loop_lag: List[float] = []
+        self.rides_completed = 0
+        self.drivers_exhausted_after: Optional[float] = None
+
+    def record(self, route: str, elapsed: float, status: int):
+        self.latencies.setdefault(route, []).append(elapsed)
+        by_status = self.statuses.setdefault(route, {})
+        by_status[status] = by_status.get(status, 0) + 1
+        if status >= 500 or status == 0:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        def pct(samples, fraction):
+            ordered = sorted(samples)
+            return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+
+        routes = {}
+        total = 0
+        for route, samples in sorted(self.latencies.items()):
+            total += len(samples)
+            routes[route] = {
+                "requests": len(samples),
+                "rps": len(samples) / duration,
+                "p50_ms": pct(samples, 0.50),
+                "p95_ms": pct(samples, 0.95),
+                "p99_ms": pct(samples, 0.99),
+                "errors": self.errors.get(route, 0),
+                "statuses": {str(code): count for code, count in sorted(self.statuses[route].items())},
+            }
+        return {
+            "duration_seconds": duration,
+            "requests": total,
+            "throughput_rps": total / duration,
+            "rides_completed": self.rides_completed,
+            "drivers_exhausted_after_seconds": self.drivers_exhausted_after,
+            "event_loop_lag_ms": {
+                "p50": pct(self.loop_lag, 0.50) if self.loop_lag else 0.0,
+                "p99": pct(self.loop_lag, 0.99) if self.loop_lag else 0.0,
+                "max": max(self.loop_lag) * 1000 if self.loop_lag else 0.0,
+            },
+            "routes": routes,
+        }
+
+
+class Simulation:
+    """Ciclo de vida completo: criar, aceitar/rejeitar, iniciar, saída/meio/chegada"""
+
+    def __init__(self, client, stats: Stats, args):
+        self.client = client
+        self.stats = stats
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.free_drivers: List[str] = []
+        self.started = 0.0
+        self.deadline = 0.0
+        self.tasks: List[asyncio.Task] = []
+
+    async def call(self, route: str, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Tuple[int, Dict[str, Any]]:
+        body = json.dumps(payload).encode() if payload is not None else None
+        start = time.perf_counter()
+        try:
+            status, raw = await self.client.request(method, path, body)
+        except Exception:
+            self.stats.record(route, time.perf_counter() - start, 0)
+            return 0, {}
+        self.stats.record(route, time.perf_counter() - start, status)
+        try:
+            return status, json.loads(raw) if raw else {}
+        except ValueError:
+            return status, {}
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds * self.args.time_scale)
+
+    async def create_users(self) -> Tuple[List[str], List[str]]:
+        enterprises, drivers = [], []
+        for role, count, target in (("enterprise", self.args.enterprises, enterprises), ("driver", self.args.drivers, drivers)):
+            for i in range(count):
+                status, data = await self.call("POST /api/users", "POST", "/api/users", {
+                    "id": f"LOAD-{role[:3].upper()}-{uuid.uuid4().hex[:8]}",
+                    "name": f"Load {role} {i}", "role": role, "contact": "load@example.com",
+                })
+                if status == 200:
+                    target.append(data["data"]["user"]["id"])
+        return enterprises, drivers
+
+    async def enterprise(self, enterprise_id: str):
+        await self.sleep(self.rng.uniform(0, ENTERPRISE_POLL_SECONDS))
+        while time.monotonic() < self.deadline:
+            if not self.free_drivers and self.stats.drivers_exhausted_after is None:
+                self.stats.drivers_exhausted_after = round(time.monotonic() - self.started, 1)
+            if self.free_drivers and self.rng.random() < self.args.create_probability:
+                driver_id = self.free_drivers.pop(self.rng.randrange(len(self.free_drivers)))
+                trip_id = f"LOAD-TRIP-{uuid.uuid4().hex[:10]}"
+                await self.call("POST /api/ride-requests", "POST", "/api/ride-requests", {
+                    "enterprise_id": enterprise_id, "driver_id": driver_id,
+                    "trip_data": {
+                        "trip_id": trip_id, "driver": driver_id,
+                        "route": [self._point(), self._point(), self._point()],
+                        "estimated_duration": 30,
+                    },
+                })
+
+            # Dashboard da empresa
+            status, data = await self.call("GET /api/ride-requests", "GET", f"/api/ride-requests?user_id={enterprise_id}")
+            await self.call("GET /api/notifications/{user_id}", "GET", f"/api/notifications/{enterprise_id}")
+            for ride in (data.get("data") or {}).get("ride_requests", []):
+                if ride["status"] == "Aceito":
+                    await self.call("POST /api/ride-requests/{request_id}/start", "POST", f"/api/ride-requests/{ride['id']}/start",
+                                    {"enterprise_id": enterprise_id})
+            await self.sleep(ENTERPRISE_POLL_SECONDS)
+
+    async def driver(self, driver_id: str):
+        await self.sleep(self.rng.uniform(0, DRIVER_POLL_SECONDS))
+        handled = set()
+        while time.monotonic() < self.deadline:
+            status, data = await self.call("GET /api/ride-requests", "GET", f"/api/ride-requests?user_id={driver_id}")
+            await self.call("GET /api/notifications/{user_id}", "GET", f"/api/notifications/{driver_id}")
+            for ride in (data.get("data") or {}).get("ride_requests", []):
+                if ride["status"] == "Pendente":
+                    if self.rng.random() < self.args.reject_probability:
+                        await self.call("POST /api/ride-requests/{request_id}/reject", "POST", f"/api/ride-requests/{ride['id']}/reject",
+                                        {"driver_id": driver_id, "reason": "loadgen"})
+                        self.free_drivers.append(driver_id)
+                    else:
+                        await self.call("POST /api/ride-requests/{request_id}/accept", "POST", f"/api/ride-requests/{ride['id']}/accept",
+                                        {"driver_id": driver_id})
+                elif ride["status"] == "EmAndamento" and ride["id"] not in handled:
+                    handled.add(ride["id"])
+                    self.tasks.append(asyncio.create_task(self.checkpoints(driver_id, ride["trip_data"]["trip_id"])))
+            await self.sleep(DRIVER_POLL_SECONDS)
+
+    async def checkpoints(self, driver_id: str, trip_id: str):
+        for event in ("saida", "meio", "chegada"):
+            await self.sleep(self.args.leg_seconds)
+            status, _ = await self.call(f"POST /contract/{{trip_id}}/{event}", "POST", f"/contract/{trip_id}/{event}")
+            if status != 200:
+                return
+        self.stats.rides_completed += 1
+
+    def _point(self) -> str:
+        return f"{self.rng.uniform(-23.7, -23.4):.6f},{self.rng.uniform(-46.8, -46.4):.6f}"
+
+
+async def monitor_loop_lag(stats: Stats, interval: float = 0.1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def run(args) -> Dict[str, Any]:
+    if args.url:
+        client = HTTPClient(args.url, args.connections)
+    else:
+        from main import app
+        client = ASGIClient(app)
+    await client.start()
+
+    stats = Stats()
+    simulation = Simulation(client, stats, args)
+    enterprises, drivers = await simulation.create_users()
+    simulation.free_drivers = list(drivers)
+
+    lag_task = asyncio.create_task(monitor_loop_lag(stats))
+    start = time.monotonic()
+    simulation.started = start
+    simulation.deadline = start + args.duration
+    await asyncio.gather(
+        *[simulation.enterprise(enterprise_id) for enterprise_id in enterprises],
+        *[simulation.driver(driver_id) for driver_id in drivers],
+    )
+    # Checkpoints ainda em andamento no fim da execução não contam como corridas concluídas
+    for task in simulation.tasks:
+        task.cancel()
+    await asyncio.gather(*simulation.tasks, return_exceptions=True)
+    lag_task.cancel()
+    await client.close()
+    return stats.report(time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL de um servidor em execução (padrão: main.app em processo)")
+    parser.add_argument("--enterprises", type=int, default=10)
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=60.0, help="duração em segundos")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="fator aplicado às esperas (0.1 = 10x mais rápido)")
+    parser.add_argument("--leg-seconds", type=float, default=5.0, help="intervalo entre saída, meio e chegada")
+    parser.add_argument("--create-probability", type=float, default=0.5, help="chance de a empresa criar uma corrida a cada ciclo")
+    parser.add_argument("--reject-probability", type=float, default=0.1)
+    parser.add_argument("--connections", type=int, default=64, help="conexões keep-alive no modo --url")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="arquivo JSON de saída")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(encoded)
+
+    print(f"{'rota':<48} {'req':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'erros':>6}")
+    for route, values in report["routes"].items():
+        print(f"{route:<48} {values['requests']:>7} {values['rps']:>8.1f} {values['p50_ms']:>8.2f} "
+              f"{values['p95_ms']:>8.2f} {values['p99_ms']:>8.2f} {values['errors']:>6}")
+    lag = report["event_loop_lag_ms"]
+    print(f"\nthroughput: {report['throughput_rps']:.1f} req/s  corridas concluídas: {report['rides_completed']}  "
+          f"lag do event loop p50/p99/max: {lag['p50']:.2f}/{lag['p99']:.2f}/{lag['max']:.2f} ms")
+    if report["drivers_exhausted_after_seconds"] is not None:
+        print(f"motoristas livres esgotados após {report['drivers_exhausted_after_seconds']:.1f} s "
+              f"(daí em diante só consultas aos dashboards; aumente --drivers)")
+
+
+if __name__ == "__main__":
+    main()
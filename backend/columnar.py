@@ -0,0 +1,125 @@
+import logging
+import os
+from typing import Dict, List, Optional
+from models import RideStatus
+
+logger = logging.getLogger(__name__)
+
+# Código numérico de cada status (ordem de declaração do enum)
+STATUS_CODES: Dict[RideStatus, int] = {status: code for code, status in enumerate(RideStatus)}
+STATUSES: List[RideStatus] = list(RideStatus)
+
+
+class ColumnarRideStore:
+    """Colunas das corridas para varreduras administrativas
+
+    Cada corrida ocupa uma linha; status (uint8), created_at (int64, em
+    microssegundos como em records.RideRecord) e IDs de motorista/empresa
+    (int32, codificados por dicionário) ficam em arrays numpy. Filtros e
+    contagens são operações vetorizadas sobre as colunas e devolvem índices
+    de linha; o ID da corrida de cada linha está em `ride_ids`.
+
+    É um índice secundário: o UserService continua sendo a fonte dos dados
+    e chama upsert() em todo caminho de escrita/replicação.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        import numpy as np
+        self._np = np
+        self.size = 0
+        self.ride_ids: List[str] = []
+        self._row_by_id: Dict[str, int] = {}
+        self._users: List[str] = []
+        self._user_codes: Dict[str, int] = {}
+        self.status = np.zeros(capacity, dtype=np.uint8)
+        self.created_at = np.zeros(capacity, dtype=np.int64)
+        self.driver = np.zeros(capacity, dtype=np.int32)
+        self.enterprise = np.zeros(capacity, dtype=np.int32)
+
+    def _user_code(self, user_id: str) -> int:
+        code = self._user_codes.get(user_id)
+        if code is None:
+            code = self._user_codes[user_id] = len(self._users)
+            self._users.append(user_id)
+        return code
+
+    def _grow(self):
+        capacity = len(self.status) * 2
+        for name in ("status", "created_at", "driver", "enterprise"):
+            column = getattr(self, name)
+            grown = self._np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def upsert(self, ride):
+        """Insere ou atualiza a linha de um RideRecord"""
+        row = self._row_by_id.get(ride.id)
+        if row is None:
+            if self.size == len(self.status):
+                self._grow()
+            row = self._row_by_id[ride.id] = self.size
+            self.ride_ids.append(ride.id)
+            self.size += 1
+        self.status[row] = STATUS_CODES[ride.status]
+        self.created_at[row] = ride.created_at
+        self.driver[row] = self._user_code(ride.driver_id)
+        self.enterprise[row] = self._user_code(ride.enterprise_id)
+
+    def select(self, status: Optional[RideStatus] = None, created_from: Optional[int] = None,
+               created_to: Optional[int] = None, driver_id: Optional[str] = None,
+               enterprise_id: Optional[str] = None):
+        """Índices das linhas que atendem a todos os filtros (created_to exclusivo)"""
+        np = self._np
+        mask = np.ones(self.size, dtype=bool)
+        if status is not None:
+            mask &= self.status[:self.size] == STATUS_CODES[status]
+        if created_from is not None:
+            mask &= self.created_at[:self.size] >= created_from
+        if created_to is not None:
+            mask &= self.created_at[:self.size] < created_to
+        for user_id, column in ((driver_id, self.driver), (enterprise_id, self.enterprise)):
+            if user_id is not None:
+                code = self._user_codes.get(user_id)
+                if code is None:
+                    return np.empty(0, dtype=np.int64)
+                mask &= column[:self.size] == code
+        return np.flatnonzero(mask)
+
+    def _statuses(self, rows):
+        # Sem filtro as linhas são todas: fatia (view) em vez de indexação
+        return self.status[:self.size] if len(rows) == self.size else self.status[rows]
+
+    def with_status(self, rows, status: RideStatus):
+        """Subconjunto de `rows` com o status dado"""
+        return rows[self._statuses(rows) == STATUS_CODES[status]]
+
+    def count_by_status(self, rows) -> Dict[str, int]:
+        counts = self._np.bincount(self._statuses(rows), minlength=len(STATUSES))
+        return {status.value: int(count) for status, count in zip(STATUSES, counts)}
+
+    def newest(self, rows, limit: int) -> List[str]:
+        """IDs das `limit` corridas mais recentes entre `rows`"""
+        np = self._np
+        if limit <= 0 or len(rows) == 0:
+            return []
+        created = self.created_at[rows]
+        if limit < len(rows):
+            # Só as `limit` maiores precisam ser ordenadas
+            top = np.argpartition(created, -limit)[-limit:]
+            rows, created = rows[top], created[top]
+        order = np.argsort(created, kind="stable")[::-1]
+        return [self.ride_ids[row] for row in rows[order].tolist()]
+
+    def memory_bytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ("status", "created_at", "driver", "enterprise"))
+
+
+def create_columnar_store() -> Optional[ColumnarRideStore]:
+    """Cria o store colunar se RIDE_COLUMNAR_STORE=true (requer numpy)"""
+    if os.getenv("RIDE_COLUMNAR_STORE", "false").lower() != "true":
+        return None
+    try:
+        return ColumnarRideStore()
+    except ImportError:
+        logger.warning("RIDE_COLUMNAR_STORE=true mas numpy não está instalado; varreduras usarão os registros")
+        return None
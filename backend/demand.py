@@ -0,0 +1,142 @@
+import bisect
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from geo import geohash_bounds, geohash_cell_size, geohash_encode
+
+logger = logging.getLogger(__name__)
+
+
+class DemandHeatmap:
+    """Contagem de origens de corridas por célula de geohash e faixa de tempo
+
+    Cada corrida incrementa, no bucket de tempo da sua criação, um contador
+    por prefixo do geohash da origem (precisões 1 a `max_precision`): a
+    consulta numa precisão lê só os contadores daquela precisão nos buckets
+    do intervalo, sem passar pelas corridas.
+
+    Buckets mais antigos que `retention_buckets` em relação ao mais recente
+    são descartados.
+    """
+
+    def __init__(self, max_precision: int = 6, bucket_seconds: int = 3600, retention_buckets: int = 24 * 30):
+        self.max_precision = max_precision
+        self.bucket_seconds = bucket_seconds
+        self.retention_buckets = retention_buckets
+        # bucket -> contadores por precisão (índice 0 = precisão 1)
+        self._buckets: Dict[int, List[Dict[str, int]]] = {}
+        self._bucket_keys: List[int] = []
+        self.rides = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def add(self, lat: float, lng: float, created_at: float):
+        """Conta uma origem; `created_at` em segundos desde a época"""
+        bucket = int(created_at // self.bucket_seconds)
+        counters = self._buckets.get(bucket)
+        if counters is None:
+            if self._bucket_keys and bucket < self._bucket_keys[-1] - self.retention_buckets:
+                self.dropped += 1
+                return
+            counters = self._buckets[bucket] = [{} for _ in range(self.max_precision)]
+            bisect.insort(self._bucket_keys, bucket)
+            while self._bucket_keys[0] < self._bucket_keys[-1] - self.retention_buckets:
+                del self._buckets[self._bucket_keys.pop(0)]
+
+        geohash = geohash_encode(lat, lng, self.max_precision)
+        for precision, counter in enumerate(counters, start=1):
+            prefix = geohash[:precision]
+            counter[prefix] = counter.get(prefix, 0) + 1
+        self.rides += 1
+
+    def query(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+              start: float, end: float, precision: int) -> Dict[str, Any]:
+        """Contagens por célula que intersecta a caixa, nos buckets de [start, end)
+
+        Os buckets das pontas entram inteiros; as células, também (a
+        contagem é da célula, não só da parte dentro da caixa).
+        """
+        if not 1 <= precision <= self.max_precision:
+            raise ValueError(f"precision deve estar entre 1 e {self.max_precision}")
+        if min_lat > max_lat or min_lng > max_lng:
+            raise ValueError("Caixa inválida: mínimos maiores que os máximos")
+
+        # Linhas e colunas da grade de células da precisão que a caixa cobre
+        height, width = geohash_cell_size(precision)
+        rows = (self._row(min_lat, height), self._row(max_lat, height))
+        cols = (self._col(min_lng, width), self._col(max_lng, width))
+        cover_size = (rows[1] - rows[0] + 1) * (cols[1] - cols[0] + 1)
+        cover: Optional[List[str]] = None
+
+        first = bisect.bisect_left(self._bucket_keys, math.floor(start / self.bucket_seconds))
+        last = bisect.bisect_left(self._bucket_keys, math.ceil(end / self.bucket_seconds))
+        totals: Dict[str, int] = {}
+        for bucket in self._bucket_keys[first:last]:
+            counter = self._buckets[bucket][precision - 1]
+            if cover_size < len(counter):
+                # Caixa pequena: consulta cada célula dela
+                if cover is None:
+                    cover = [
+                        geohash_encode(-90 + (row + 0.5) * height, -180 + (col + 0.5) * width, precision)
+                        for row in range(rows[0], rows[1] + 1) for col in range(cols[0], cols[1] + 1)
+                    ]
+                cells = ((geohash, counter[geohash]) for geohash in cover if geohash in counter)
+            else:
+                # Caixa grande: percorre as células com corridas no bucket
+                cells = ((geohash, count) for geohash, count in counter.items()
+                         if self._inside(geohash, rows, cols, height, width))
+            for geohash, count in cells:
+                totals[geohash] = totals.get(geohash, 0) + count
+
+        result = []
+        for geohash, count in sorted(totals.items(), key=lambda item: -item[1]):
+            cell_min_lat, cell_min_lng, cell_max_lat, cell_max_lng = geohash_bounds(geohash)
+            result.append({
+                "geohash": geohash,
+                "lat": (cell_min_lat + cell_max_lat) / 2,
+                "lng": (cell_min_lng + cell_max_lng) / 2,
+                "count": count,
+            })
+        return {
+            "precision": precision,
+            "buckets": last - first,
+            "total": sum(totals.values()),
+            "cells": result,
+        }
+
+    @staticmethod
+    def _row(lat: float, height: float) -> int:
+        return min(int((lat + 90) // height), round(180 / height) - 1)
+
+    @staticmethod
+    def _col(lng: float, width: float) -> int:
+        return min(int((lng + 180) // width), round(360 / width) - 1)
+
+    def _inside(self, geohash: str, rows: Tuple[int, int], cols: Tuple[int, int], height: float, width: float) -> bool:
+        cell_min_lat, cell_min_lng, cell_max_lat, cell_max_lng = geohash_bounds(geohash)
+        row = self._row((cell_min_lat + cell_max_lat) / 2, height)
+        col = self._col((cell_min_lng + cell_max_lng) / 2, width)
+        return rows[0] <= row <= rows[1] and cols[0] <= col <= cols[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buckets": len(self._buckets),
+            "cells": sum(len(counter) for counters in self._buckets.values() for counter in counters),
+            "rides": self.rides,
+            "dropped": self.dropped,
+        }
+
+
+def create_demand_heatmap() -> Optional[DemandHeatmap]:
+    """Heatmap conforme DEMAND_HEATMAP_ENABLED e DEMAND_* (precisão máxima, bucket, retenção)"""
+    if os.getenv("DEMAND_HEATMAP_ENABLED", "true").lower() != "true":
+        return None
+    bucket_seconds = int(os.getenv("DEMAND_BUCKET_SECONDS", 3600))
+    return DemandHeatmap(
+        max_precision=int(os.getenv("DEMAND_MAX_PRECISION", 6)),
+        bucket_seconds=bucket_seconds,
+        retention_buckets=int(float(os.getenv("DEMAND_RETENTION_HOURS", 24 * 30)) * 3600 // bucket_seconds),
+    )
@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from geo import haversine_km_array
+from models import DispatchStatus, TripData, UserRole
+from tracing import traced, set_attribute
+
+logger = logging.getLogger(__name__)
+
+# Custo de pares além do raio no algoritmo exato: maior que qualquer soma de
+# distâncias viáveis, então a solução primeiro maximiza os pares viáveis
+_INFEASIBLE = 1e9
+
+# Linhas (corridas) por bloco ao selecionar candidatas na estratégia gulosa
+_CHUNK_ROWS = 512
+
+
+def solve_exact(cost) -> List[Tuple[int, int]]:
+    """Atribuição de custo total mínimo (algoritmo húngaro, caminhos aumentantes)
+
+    `cost` é uma matriz numpy linhas x colunas (qualquer formato); devolve
+    pares (linha, coluna), uma coluna por linha até min(linhas, colunas).
+    O(n² · m) no pior caso, com o laço interno vetorizado sobre as colunas.
+    """
+    import numpy as np
+    rows, cols = cost.shape
+    if rows == 0 or cols == 0:
+        return []
+    if rows > cols:
+        return [(row, col) for col, row in solve_exact(cost.T)]
+
+    # Potenciais u (linhas) e v (colunas); owner[j] = linha (1-based) na coluna j, 0 = livre.
+    # A coluna 0 é fictícia: é de onde parte cada caminho aumentante.
+    u = np.zeros(rows + 1)
+    v = np.zeros(cols + 1)
+    owner = np.zeros(cols + 1, dtype=np.int64)
+    way = np.zeros(cols + 1, dtype=np.int64)
+    for row in range(1, rows + 1):
+        owner[0] = row
+        col0 = 0
+        min_slack = np.full(cols + 1, np.inf)
+        used = np.zeros(cols + 1, dtype=bool)
+        while True:
+            used[col0] = True
+            row0 = owner[col0]
+            free = ~used
+            slack = cost[row0 - 1] - u[row0] - v[1:]
+            better = free[1:] & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = col0
+            candidates = np.where(free, min_slack, np.inf)
+            col1 = int(np.argmin(candidates))
+            delta = candidates[col1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_slack[free] -= delta
+            col0 = col1
+            if owner[col0] == 0:
+                break
+        # Inverte o caminho aumentante até a coluna fictícia
+        while col0:
+            col1 = way[col0]
+            owner[col0] = owner[col1]
+            col0 = col1
+    return [(int(owner[col]) - 1, col - 1) for col in range(1, cols + 1) if owner[col]]
+
+
+def solve_greedy(costs, rows, cols) -> List[Tuple[int, int, float]]:
+    """Atribuição gulosa sobre arestas candidatas, da mais barata à mais cara
+
+    `costs`, `rows` e `cols` são arrays paralelos de arestas; devolve
+    triplas (linha, coluna, custo) com cada linha e coluna no máximo uma vez.
+    """
+    import numpy as np
+    order = np.argsort(costs, kind="stable")
+    taken_rows, taken_cols = set(), set()
+    pairs = []
+    for row, col, cost in zip(rows[order].tolist(), cols[order].tolist(), costs[order].tolist()):
+        if row in taken_rows or col in taken_cols:
+            continue
+        taken_rows.add(row)
+        taken_cols.add(col)
+        pairs.append((row, col, cost))
+    return pairs
+
+
+def candidate_edges(ride_lat, ride_lng, driver_lat, driver_lng, max_km: float, k: int):
+    """Os k motoristas mais próximos de cada corrida, como arestas (custos, linhas, colunas)
+
+    A seleção usa a aproximação equirretangular em float32 (só subtrações e
+    multiplicações, em blocos de linhas para limitar a memória); a distância
+    das arestas escolhidas é então calculada pela haversine.
+    """
+    import numpy as np
+    k = min(k, len(driver_lat))
+    d_lat = np.asarray(driver_lat, dtype=np.float32)
+    d_lng = np.asarray(driver_lng, dtype=np.float32)
+    all_rows, all_cols = [], []
+    for start in range(0, len(ride_lat), _CHUNK_ROWS):
+        r_lat = np.asarray(ride_lat[start:start + _CHUNK_ROWS], dtype=np.float32)[:, None]
+        r_lng = np.asarray(ride_lng[start:start + _CHUNK_ROWS], dtype=np.float32)[:, None]
+        dx = (d_lng - r_lng) * np.cos(np.radians(r_lat))
+        dy = d_lat - r_lat
+        squared = dx * dx
+        squared += dy * dy
+        if k < len(d_lat):
+            top = np.argpartition(squared, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(d_lat)), squared.shape)
+        all_rows.append(np.repeat(np.arange(start, start + len(r_lat)), k))
+        all_cols.append(top.ravel())
+    rows, cols = np.concatenate(all_rows), np.concatenate(all_cols)
+    costs = haversine_km_array(np.asarray(ride_lat)[rows], np.asarray(ride_lng)[rows],
+                               np.asarray(driver_lat)[cols], np.asarray(driver_lng)[cols])
+    feasible = costs <= max_km
+    return costs[feasible], rows[feasible], cols[feasible]
+
+
+def _assign_exact(ride_lat, ride_lng, driver_lat, driver_lng, max_km: float) -> List[Tuple[int, int, float]]:
+    import numpy as np
+    cost = haversine_km_array(ride_lat[:, None], ride_lng[:, None], driver_lat[None, :], driver_lng[None, :])
+    feasible = cost <= max_km
+    pairs = solve_exact(np.where(feasible, cost, _INFEASIBLE))
+    return [(row, col, float(cost[row, col])) for row, col in pairs if feasible[row, col]]
+
+
+def assign(ride_lat, ride_lng, driver_lat, driver_lng, max_km: float,
+           exact_max_pairs: int = 90_000, candidates: int = 8) -> Tuple[List[Tuple[int, int, float]], str]:
+    """Atribui corridas (pontos de coleta) a motoristas minimizando a distância de coleta
+
+    Devolve triplas (corrida, motorista, distância_km) e a estratégia usada.
+    Lotes com até `exact_max_pairs` pares usam a matriz completa e a
+    solução ótima. Acima disso, rodadas gulosas sobre os `candidates`
+    motoristas mais próximos de cada corrida, cada uma com o que sobrou da
+    anterior; quando a sobra cabe no limite, ela é resolvida de forma ótima.
+    Pares além de max_km nunca são formados.
+    """
+    import numpy as np
+    ride_lat, ride_lng = np.asarray(ride_lat, dtype=float), np.asarray(ride_lng, dtype=float)
+    driver_lat, driver_lng = np.asarray(driver_lat, dtype=float), np.asarray(driver_lng, dtype=float)
+    if len(ride_lat) == 0 or len(driver_lat) == 0:
+        return [], "none"
+    if len(ride_lat) * len(driver_lat) <= exact_max_pairs:
+        return _assign_exact(ride_lat, ride_lng, driver_lat, driver_lng, max_km), "exact"
+
+    rides_left = np.arange(len(ride_lat))
+    drivers_left = np.arange(len(driver_lat))
+    result: List[Tuple[int, int, float]] = []
+    while len(rides_left) and len(drivers_left):
+        if len(rides_left) * len(drivers_left) <= exact_max_pairs:
+            pairs = _assign_exact(ride_lat[rides_left], ride_lng[rides_left],
+                                  driver_lat[drivers_left], driver_lng[drivers_left], max_km)
+            result.extend((int(rides_left[row]), int(drivers_left[col]), cost) for row, col, cost in pairs)
+            break
+        costs, rows, cols = candidate_edges(ride_lat[rides_left], ride_lng[rides_left],
+                                            driver_lat[drivers_left], driver_lng[drivers_left], max_km, candidates)
+        pairs = solve_greedy(costs, rows, cols)
+        if not pairs:
+            break
+        result.extend((int(rides_left[row]), int(drivers_left[col]), cost) for row, col, cost in pairs)
+        rides_left = np.delete(rides_left, [row for row, _, _ in pairs])
+        drivers_left = np.delete(drivers_left, [col for _, col, _ in pairs])
+    return result, "greedy"
+
+
+class DispatchTicket:
+    """Corrida aguardando motorista no despacho automático"""
+
+    __slots__ = ("id", "enterprise_id", "trip", "lat", "lng", "submitted_at", "status",
+                 "ride_request_id", "driver_id", "distance_km", "attempts")
+
+    def __init__(self, enterprise_id: str, trip: TripData, lat: float, lng: float):
+        self.id = f"DSP-{uuid.uuid4().hex[:8]}"
+        self.enterprise_id = enterprise_id
+        self.trip = trip
+        self.lat = lat
+        self.lng = lng
+        self.submitted_at = time.time()
+        self.status = DispatchStatus.AGUARDANDO
+        self.ride_request_id: Optional[str] = None
+        self.driver_id: Optional[str] = None
+        self.distance_km: Optional[float] = None
+        self.attempts = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "enterprise_id": self.enterprise_id,
+            "trip_id": self.trip.trip_id,
+            "pickup": {"lat": self.lat, "lng": self.lng},
+            "status": self.status,
+            "ride_request_id": self.ride_request_id,
+            "driver_id": self.driver_id,
+            "pickup_distance_km": round(self.distance_km, 3) if self.distance_km is not None else None,
+            "attempts": self.attempts,
+            "waiting_seconds": round(time.time() - self.submitted_at, 1),
+        }
+
+
+class Dispatcher:
+    """Despacho automático em lotes das corridas sem motorista
+
+    A cada `interval` segundos (ou em run_once()), junta as corridas
+    aguardando e os motoristas disponíveis com posição recente, resolve a
+    atribuição pela distância de coleta (assign(), numa thread para não
+    bloquear o event loop) e cria as corridas em lote no UserService. A
+    disponibilidade é conferida de novo na criação: motoristas que
+    ficaram ocupados durante o cálculo são pulados e a corrida volta ao
+    próximo lote.
+
+    A fila vive na memória do processo, como o índice de posições que ela
+    consulta; por isso o despacho só é habilitado com um único worker
+    (create_dispatcher).
+    """
+
+    def __init__(self, user_service, interval: float = 2.0, max_km: Optional[float] = None,
+                 exact_max_pairs: int = 90_000, candidates: int = 8, batch_max: int = 5000,
+                 max_wait: float = 600.0, history: int = 10_000):
+        self.user_service = user_service
+        self.interval = interval
+        self.max_km = max_km
+        self.exact_max_pairs = exact_max_pairs
+        self.candidates = candidates
+        self.batch_max = batch_max
+        self.max_wait = max_wait
+        self.history = history
+        self._pending: "OrderedDict[str, DispatchTicket]" = OrderedDict()
+        # Tickets encerrados (atribuídos/expirados), os mais antigos descartados após `history`
+        self._finished: "OrderedDict[str, DispatchTicket]" = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._pending:
+                continue
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Erro no despacho automático")
+
+    async def submit(self, enterprise_id: str, trip_data: TripData) -> DispatchTicket:
+        """Coloca uma corrida na fila; a coleta é o primeiro ponto da rota"""
+        enterprise = await self.user_service.get_user(enterprise_id)
+        if not enterprise or enterprise.role != UserRole.ENTERPRISE:
+            raise ValueError("Empresa não encontrada ou inválida")
+        coordinates = trip_data._coordinates
+        if coordinates is None or not len(coordinates) or math.isnan(coordinates[0]):
+            raise ValueError("O primeiro ponto da rota deve ser uma coordenada 'lat,lng' para o despacho automático")
+
+        ticket = DispatchTicket(enterprise_id, trip_data, coordinates[0], coordinates[1])
+        self._pending[ticket.id] = ticket
+        logger.info("Corrida na fila de despacho: %s (Enterprise: %s)", ticket.id, enterprise_id)
+        return ticket
+
+    def get(self, ticket_id: str) -> Optional[DispatchTicket]:
+        return self._pending.get(ticket_id) or self._finished.get(ticket_id)
+
+    def _finish(self, ticket: DispatchTicket, status: DispatchStatus):
+        ticket.status = status
+        del self._pending[ticket.id]
+        self._finished[ticket.id] = ticket
+        while len(self._finished) > self.history:
+            self._finished.popitem(last=False)
+
+    async def _expire(self, now: float) -> int:
+        expired = [ticket for ticket in self._pending.values() if now - ticket.submitted_at > self.max_wait]
+        for ticket in expired:
+            self._finish(ticket, DispatchStatus.EXPIRADO)
+            await self.user_service.notify(
+                ticket.enterprise_id,
+                "dispatch_expired",
+                "Nenhum Motorista Disponível",
+                f"Nenhum motorista disponível foi encontrado para a viagem {ticket.trip.trip_id}.",
+                {"dispatch_id": ticket.id, "trip_id": ticket.trip.trip_id}
+            )
+        return len(expired)
+
+    @traced("Dispatcher.run_once")
+    async def run_once(self) -> Dict[str, Any]:
+        """Executa um lote agora; rodadas simultâneas esperam umas pelas outras"""
+        async with self._lock:
+            start = time.perf_counter()
+            expired = await self._expire(time.time())
+            batch = [ticket for _, ticket in zip(range(self.batch_max), self._pending.values())]
+            drivers = self.user_service.available_driver_positions() if batch else []
+            max_km = self.max_km if self.max_km is not None else self.user_service.locations.max_km
+
+            pairs, method = await asyncio.to_thread(
+                assign,
+                [ticket.lat for ticket in batch], [ticket.lng for ticket in batch],
+                [lat for _, lat, _ in drivers], [lng for _, _, lng in drivers],
+                max_km, self.exact_max_pairs, self.candidates,
+            )
+            solve_ms = (time.perf_counter() - start) * 1000
+
+            rides = await self.user_service.create_ride_requests_bulk(
+                [(batch[row].enterprise_id, drivers[col][0], batch[row].trip) for row, col, _ in pairs]
+            )
+            assigned = 0
+            for (row, col, distance), ride_request in zip(pairs, rides):
+                ticket = batch[row]
+                if ride_request is None:
+                    continue
+                ticket.ride_request_id = ride_request.id
+                ticket.driver_id = ride_request.driver_id
+                ticket.distance_km = distance
+                self._finish(ticket, DispatchStatus.ATRIBUIDO)
+                assigned += 1
+            for ticket in batch:
+                ticket.attempts += 1
+
+            self.last_run = {
+                "batch": len(batch),
+                "drivers": len(drivers),
+                "assigned": assigned,
+                "expired": expired,
+                "pending": len(self._pending),
+                "method": method,
+                "total_pickup_km": round(sum(distance for _, _, distance in pairs), 3),
+                "solve_ms": round(solve_ms, 2),
+                "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+            }
+            set_attribute("dispatch.batch", len(batch))
+            set_attribute("dispatch.assigned", assigned)
+            if batch:
+                logger.info("Despacho: %d de %d corridas atribuídas (%d motoristas, %s) em %.1f ms",
+                            assigned, len(batch), len(drivers), method, self.last_run["elapsed_ms"])
+            return self.last_run
+
+
+def create_dispatcher(user_service) -> Optional[Dispatcher]:
+    """Cria o despacho automático conforme DISPATCH_ENABLED (requer numpy) e DISPATCH_*"""
+    if os.getenv("DISPATCH_ENABLED", "true").lower() != "true":
+        return None
+    if int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        # Tickets e posições ficariam espalhados pelos workers: a consulta de um
+        # ticket daria 404 em outro worker e cada um veria só seus motoristas
+        logger.warning("Despacho automático desabilitado: requer WEB_CONCURRENCY=1")
+        return None
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        logger.warning("DISPATCH_ENABLED=true mas numpy não está instalado; despacho automático desabilitado")
+        return None
+    max_km = os.getenv("DISPATCH_MAX_PICKUP_KM")
+    return Dispatcher(
+        user_service,
+        interval=float(os.getenv("DISPATCH_INTERVAL_SECONDS", 2)),
+        max_km=float(max_km) if max_km else None,
+        exact_max_pairs=int(os.getenv("DISPATCH_EXACT_MAX_PAIRS", 90_000)),
+        candidates=int(os.getenv("DISPATCH_CANDIDATES", 8)),
+        batch_max=int(os.getenv("DISPATCH_BATCH_MAX", 5000)),
+        max_wait=float(os.getenv("DISPATCH_MAX_WAIT_SECONDS", 600)),
+    )
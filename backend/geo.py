@@ -0,0 +1,121 @@
+import math
+import re
+from array import array
+from typing import Iterable, Iterator, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+# Quilômetros por grau de latitude (e de longitude no equador)
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# "lat,lng" com espaços opcionais (ex: "-23.550,-46.633")
+_COORDINATE = re.compile(r"^\s*([+-]?\d+(?:\.\d+)?)\s*,\s*([+-]?\d+(?:\.\d+)?)\s*$")
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+_GEOHASH_INDEX = {char: index for index, char in enumerate(_GEOHASH_ALPHABET)}
+
+
+def parse_point(text: str) -> Optional[Tuple[float, float]]:
+    """Converte "lat,lng" em (lat, lng)
+
+    Pontos em texto livre (ex: "Checkpoint Intermediário", aceitos pela API
+    desde o início) retornam None. Coordenadas fora da faixa válida
+    levantam ValueError.
+    """
+    match = _COORDINATE.match(text)
+    if match is None:
+        return None
+    lat, lng = float(match.group(1)), float(match.group(2))
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise ValueError(f"Coordenada fora da faixa válida: {text!r}")
+    return lat, lng
+
+
+def parse_route(points: Iterable[str]) -> array:
+    """Rota como array('d') plano [lat0, lng0, lat1, lng1, ...]
+
+    8 bytes por valor, sem um objeto por número; pontos em texto livre
+    ficam como NaN para manter o índice de cada ponto.
+    """
+    values = array("d")
+    for point in points:
+        coordinate = parse_point(point)
+        values.extend(coordinate if coordinate is not None else (math.nan, math.nan))
+    return values
+
+
+def route_coordinates(values: array) -> Iterator[Tuple[float, float]]:
+    """Pares (lat, lng) da rota parseada, ignorando pontos em texto livre"""
+    for index in range(0, len(values), 2):
+        lat, lng = values[index], values[index + 1]
+        if not math.isnan(lat):
+            yield lat, lng
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Distância em km pelo grande círculo"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+
+def haversine_km_array(lat1, lng1, lat2, lng2, dtype="float64"):
+    """haversine_km vetorizado sobre arrays numpy, com broadcasting
+
+    Pares elemento a elemento; para a matriz de todos contra todos passe
+    lat1[:, None], lng1[:, None]. Requer numpy.
+    """
+    import numpy as np
+    phi1, phi2 = np.radians(np.asarray(lat1, dtype=dtype)), np.radians(np.asarray(lat2, dtype=dtype))
+    d_lambda = np.radians(np.asarray(lng2, dtype=dtype) - np.asarray(lng1, dtype=dtype))
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    np.sqrt(a, out=a)
+    np.minimum(a, 1.0, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    return a
+
+
+def geohash_encode(lat: float, lng: float, precision: int) -> str:
+    """Geohash de (lat, lng) com `precision` caracteres (5 bits cada, começando pela longitude)"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return "".join(chars)
+
+
+def geohash_bounds(geohash: str) -> Tuple[float, float, float, float]:
+    """Caixa (min_lat, min_lng, max_lat, max_lng) da célula do geohash"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _GEOHASH_INDEX[char]
+        for shift in range(4, -1, -1):
+            interval = lng_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            interval[0 if (value >> shift) & 1 else 1] = middle
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """(altura, largura) em graus das células de um geohash com `precision` caracteres"""
+    bits = precision * 5
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** (bits - bits // 2)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from array import array
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from geo import KM_PER_DEGREE, haversine_km
+from state_backend import StateBackend
+
+logger = logging.getLogger(__name__)
+
+# Evento e status de cada checkpoint, como nas rotas /contract/{trip_id}/saida, /meio e /chegada.
+# Os pontos seguem o contrato: route[0] = saída, route[1] = meio, route[2] = chegada
+CHECKPOINTS = (("saida", "ok"), ("meio", "checkpoint"), ("chegada", "completed"))
+
+
+class _Fence:
+    """Checkpoints da viagem de um motorista; os de índice >= `next` estão armados
+
+    Cada etapa é (evento, status, lat, lng, min_lat, max_lat, min_lng,
+    max_lng), com a caixa que contém o círculo do checkpoint.
+    """
+
+    __slots__ = ("trip_id", "stages", "next", "left_start", "failures", "retry_at")
+
+    def __init__(self, trip_id: str, stages: List[Tuple[str, str, float, float, float, float, float, float]]):
+        self.trip_id = trip_id
+        self.stages = stages
+        self.next = 0
+        # O motorista já esteve fora do geofence de saída depois de ela ser resolvida
+        self.left_start = False
+        # Falhas seguidas de on_enter e quando o checkpoint volta a ser verificado (monotonic)
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class GeofenceMonitor:
+    """Checkpoints automáticos a partir dos pings de posição
+
+    Cada viagem em andamento tem um geofence circular (raio `radius_m`) em
+    cada ponto de checkpoint com coordenadas; pontos em texto livre não
+    têm geofence e continuam sendo marcados pelas rotas manuais. Todos os
+    checkpoints ainda não disparados são verificados, mas o contrato só
+    aceita saída -> meio -> chegada: entrar num posterior dispara antes,
+    em ordem, os anteriores pelos quais o motorista não passou. A
+    chegada só fica armada no geofence de saída depois que o motorista sai
+    dele, então uma rota que volta à origem não dispara a chegada na partida.
+
+    Um ping só pode acionar a viagem do próprio motorista, então o índice
+    dos geofences ativos é o driver_id: check() é uma consulta ao
+    dicionário e comparações com as caixas dos círculos, e a haversine só
+    roda perto dos pontos.
+
+    A primeira entrada dispara `on_enter(trip_id, evento, status)` em
+    background, uma única vez: com backend compartilhado o evento é
+    reivindicado por add() (vale entre workers e reinícios); se a chamada
+    falhar, o checkpoint volta a ficar armado, mas só é verificado de novo
+    depois de um intervalo que dobra a cada falha seguida (até
+    RETRY_MAX_SECONDS). O progresso vem dessas reivindicações: arm() parte das já gravadas, e
+    observe() aplica as feitas (ou desfeitas) por outros workers.
+    """
+
+    NAMESPACE = "geofence_events"
+    # Reivindicações ficam no backend por mais tempo que qualquer viagem e depois são compactadas
+    EVENT_TTL = 7 * 24 * 3600
+    RETRY_SECONDS = 5.0
+    RETRY_MAX_SECONDS = 300.0
+
+    def __init__(self, on_enter: Optional[Callable[[str, str, str], Awaitable[Any]]] = None,
+                 radius_m: float = 150.0, backend: Optional[StateBackend] = None):
+        self.on_enter = on_enter
+        self.radius_km = radius_m / 1000
+        self.backend = backend
+        self._fences: Dict[str, _Fence] = {}
+        self._trip_drivers: Dict[str, str] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self._fences)
+
+    def arm(self, driver_id: str, trip_id: str, coordinates: array):
+        """Arma os checkpoints da viagem do motorista (idempotente para a mesma viagem)"""
+        current = self._fences.get(driver_id)
+        if current is not None and current.trip_id == trip_id:
+            return
+        if current is not None:
+            self._trip_drivers.pop(current.trip_id, None)
+        # Mesmo preenchimento de create_transport_contract: rotas curtas repetem o último ponto
+        points = [(coordinates[index], coordinates[index + 1]) for index in range(0, len(coordinates), 2)]
+        while points and len(points) < len(CHECKPOINTS):
+            points.append(points[-1])
+        stages = [
+            (event, status, lat, lng, *self._box(lat, lng))
+            for (event, status), (lat, lng) in zip(CHECKPOINTS, points)
+            if not math.isnan(lat)
+        ]
+        if not stages:
+            self._fences.pop(driver_id, None)
+            return
+        fence = _Fence(trip_id, stages)
+        # Checkpoints já reivindicados (por outro worker ou antes de um reinício)
+        if self.backend is not None:
+            for index, stage in enumerate(stages):
+                if self.backend.get(self.NAMESPACE, f"{trip_id}/{stage[0]}") is not None:
+                    fence.next = index + 1
+        self._fences[driver_id] = fence
+        self._trip_drivers[trip_id] = driver_id
+
+    def disarm(self, driver_id: str, trip_id: str):
+        current = self._fences.get(driver_id)
+        if current is not None and current.trip_id == trip_id:
+            del self._fences[driver_id]
+            self._trip_drivers.pop(trip_id, None)
+
+    def skip(self, trip_id: str, event: str):
+        """Checkpoint marcado manualmente: não dispara mais pelo geofence"""
+        self._claim(trip_id, event)
+        self.observe(trip_id, event, True)
+
+    def observe(self, trip_id: str, event: str, claimed: bool):
+        """Reivindicação de um checkpoint gravada (ou desfeita) fora deste monitor"""
+        fence = self._fences.get(self._trip_drivers.get(trip_id, ""))
+        if fence is None or fence.trip_id != trip_id:
+            return
+        for index, stage in enumerate(fence.stages):
+            if stage[0] == event:
+                if claimed and fence.next <= index:
+                    fence.next = index + 1
+                elif not claimed and fence.next > index:
+                    fence.next = index
+                return
+
+    def _box(self, lat: float, lng: float) -> Tuple[float, float, float, float]:
+        # Caixa que contém o círculo do checkpoint: descarta a maioria dos pings sem trigonometria
+        lat_delta = self.radius_km / KM_PER_DEGREE
+        lng_delta = lat_delta / max(math.cos(math.radians(min(89.0, abs(lat) + lat_delta))), 1e-6)
+        return lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+
+    def _inside(self, stage: Tuple[str, str, float, float, float, float, float, float], lat: float, lng: float) -> bool:
+        _, _, stage_lat, stage_lng, min_lat, max_lat, min_lng, max_lng = stage
+        return (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng
+                and haversine_km(stage_lat, stage_lng, lat, lng) <= self.radius_km)
+
+    def _claim(self, trip_id: str, event: str) -> bool:
+        if self.backend is None:
+            return True
+        return self.backend.add(self.NAMESPACE, f"{trip_id}/{event}", {"trip_id": trip_id, "event": event}, ttl=self.EVENT_TTL)
+
+    def _release(self, trip_id: str, event: str):
+        if self.backend is not None:
+            self.backend.delete(self.NAMESPACE, f"{trip_id}/{event}")
+
+    def check(self, driver_id: str, lat: float, lng: float) -> List[Tuple[str, str]]:
+        """Verifica um ping; retorna os (trip_id, evento) disparados por ele"""
+        fence = self._fences.get(driver_id)
+        if fence is None or fence.next >= len(fence.stages):
+            return []
+        stages = fence.stages
+        has_start = stages[0][0] == "saida"
+        outside_start = not has_start or not self._inside(stages[0], lat, lng)
+        if outside_start and fence.next > 0:
+            fence.left_start = True
+        if fence.retry_at and time.monotonic() < fence.retry_at:
+            return []
+        # Checkpoints no mesmo ponto (rota curta preenchida) disparam no mesmo ping
+        entered = [
+            index for index in range(fence.next, len(stages))
+            if self._inside(stages[index], lat, lng)
+            and (stages[index][0] != "chegada" or outside_start or fence.left_start)
+        ]
+        if not entered:
+            return []
+        # Os anteriores ao checkpoint de entrada também disparam, na ordem do contrato
+        reached = list(range(fence.next, entered[-1] + 1))
+        fence.next = entered[-1] + 1
+        # Reivindicação perdida: outro worker já disparou; o progresso avança do mesmo jeito
+        fired = [index for index in reached if self._claim(fence.trip_id, stages[index][0])]
+        if not fired:
+            return []
+
+        if self.on_enter is None:
+            self.fired += len(fired)
+        for index in fired:
+            logger.info("Geofence: %s da viagem %s (motorista %s)", stages[index][0], fence.trip_id, driver_id)
+        if self.on_enter is not None:
+            task = asyncio.get_running_loop().create_task(self._run(driver_id, fence, fired))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return [(fence.trip_id, stages[index][0]) for index in fired]
+
+    async def _run(self, driver_id: str, fence: _Fence, indexes: List[int]):
+        # Em ordem: a saída precisa estar no contrato antes do meio
+        for position, index in enumerate(indexes):
+            event, status = fence.stages[index][:2]
+            try:
+                await self.on_enter(fence.trip_id, event, status)
+            except Exception:
+                fence.failures += 1
+                delay = min(self.RETRY_SECONDS * 2 ** (fence.failures - 1), self.RETRY_MAX_SECONDS)
+                fence.retry_at = time.monotonic() + delay
+                logger.exception("Falha ao marcar %s da viagem %s pelo geofence; checkpoint rearmado em %.0fs",
+                                 event, fence.trip_id, delay)
+                for pending in indexes[position:]:
+                    self._release(fence.trip_id, fence.stages[pending][0])
+                # Rearma a partir deste checkpoint, se a viagem ainda estiver em andamento
+                if self._fences.get(driver_id) is fence and fence.next > index:
+                    fence.next = index
+                return
+            self.fired += 1
+            fence.failures = 0
+            fence.retry_at = 0.0
+
+    def stats(self) -> Dict[str, int]:
+        armed = sum(1 for fence in self._fences.values() if fence.next < len(fence.stages))
+        return {"trips": len(self._fences), "armed": armed, "fired": self.fired, "in_flight": len(self._tasks)}
+
+
+def create_geofence_monitor(on_enter: Callable[[str, str, str], Awaitable[Any]],
+                            backend: Optional[StateBackend] = None) -> Optional[GeofenceMonitor]:
+    """Monitor conforme GEOFENCE_ENABLED e GEOFENCE_RADIUS_METERS"""
+    if os.getenv("GEOFENCE_ENABLED", "true").lower() != "true":
+        return None
+    return GeofenceMonitor(on_enter, radius_m=float(os.getenv("GEOFENCE_RADIUS_METERS", 150)), backend=backend)
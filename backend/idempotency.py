@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from state_backend import StateBackend
+import logging
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = b"idempotent-replayed"
+
+
+class CachedResponse:
+    """Resposta HTTP completa guardada para uma chave de idempotência"""
+
+    __slots__ = ("fingerprint", "status", "headers", "body", "expires_at")
+
+    def __init__(self, fingerprint: str, status: int, headers: List[Tuple[bytes, bytes]], body: bytes, expires_at: float):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+
+def _encode_entry(key: str, entry: CachedResponse) -> Dict[str, Any]:
+    return {
+        "key": key,
+        "fingerprint": entry.fingerprint,
+        "status": entry.status,
+        "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in entry.headers],
+        "body": entry.body.decode("latin-1"),
+        "expires_at": entry.expires_at,
+    }
+
+
+def _decode_entry(item: Dict[str, Any]) -> CachedResponse:
+    return CachedResponse(
+        item["fingerprint"],
+        item["status"],
+        [(name.encode("latin-1"), value.encode("latin-1")) for name, value in item["headers"]],
+        item["body"].encode("latin-1"),
+        item["expires_at"],
+    )
+
+
+class IdempotencyStore:
+    """Cache limitado (LRU + TTL) de respostas indexadas por Idempotency-Key
+
+    Com um backend compartilhado as respostas concluídas também são gravadas
+    nele, e uma chave em execução em um worker é "reivindicada" para que
+    retentativas roteadas para outro worker aguardem o mesmo resultado.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None, backend: Optional[StateBackend] = None):
+        self.max_entries = max_entries or int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 10000))
+        self.ttl_seconds = ttl_seconds or float(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
+        self.claim_timeout = float(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS", 30))
+        self.backend = backend
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        # Execuções em andamento: duplicatas concorrentes aguardam o mesmo resultado
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Obtém uma resposta válida do cache, descartando-a se expirou"""
+        entry = self._entries.get(key)
+        if entry is None and self.backend:
+            item = self.backend.get("idempotency", key)
+            if item is not None and not item.get("pending"):
+                entry = _decode_entry(item)
+                self._remember(key, entry)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, fingerprint: str, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        """Armazena uma resposta concluída, removendo as menos usadas se necessário"""
+        entry = CachedResponse(fingerprint, status, headers, body, time.time() + self.ttl_seconds)
+        self._remember(key, entry)
+        if self.backend:
+            # Expira no backend junto com a entrada; compact() remove a linha
+            self.backend.put("idempotency", key, _encode_entry(key, entry), ttl=self.ttl_seconds)
+
+    def _remember(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _claim(self, key: str) -> bool:
+        """Reivindica a execução da chave no backend compartilhado
+
+        add() trata entradas expiradas como ausentes, então assumir uma
+        resposta expirada ou uma reivindicação abandonada (worker
+        reiniciado, por exemplo) é a mesma operação atômica: só um worker
+        consegue.
+        """
+        claim = {"pending": True, "expires_at": time.time() + self.claim_timeout}
+        return self.backend.add("idempotency", key, claim, ttl=self.claim_timeout)
+
+    async def acquire(self, key: str) -> Optional[CachedResponse]:
+        """Aguarda a execução da chave em outro worker
+
+        Retorna a resposta produzida por outro worker ou None quando este
+        worker deve executar a requisição.
+        """
+        if not self.backend:
+            return None
+        deadline = time.time() + self.claim_timeout
+        while not self._claim(key):
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            if time.time() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+        return None
+
+    def release(self, key: str):
+        """Libera a reivindicação de uma execução que não foi armazenada"""
+        if self.backend:
+            self.backend.delete("idempotency", key)
+
+    def purge_expired(self) -> int:
+        """Remove entradas expiradas e retorna quantas foram removidas"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    def in_flight(self, key: str) -> Optional[asyncio.Future]:
+        return self._in_flight.get(key)
+
+    def begin(self, key: str) -> asyncio.Future:
+        """Registra uma execução em andamento para a chave"""
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        return future
+
+    def finish(self, key: str, response: Optional[CachedResponse]):
+        """Libera as duplicatas que aguardam a execução em andamento"""
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+
+class IdempotencyMiddleware:
+    """Middleware ASGI que honra o header Idempotency-Key em rotas POST
+
+    A primeira requisição com uma chave executa normalmente; duplicatas
+    concorrentes aguardam o resultado em andamento e repetições posteriores
+    recebem a resposta armazenada, sem reexecutar o handler.
+    """
+
+    def __init__(self, app, store: IdempotencyStore, max_body_bytes: int = 1024 * 1024):
+        self.app = app
+        self.store = store
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        idempotency_key = None
+        for name, value in scope["headers"]:
+            if name == IDEMPOTENCY_HEADER:
+                idempotency_key = value.decode("latin-1").strip()
+                break
+
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+
+        # A chave é escopada pela rota para evitar colisões entre endpoints
+        key = f"{scope['path']}:{idempotency_key}"
+        body, more_messages = await self._read_body(receive)
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        while True:
+            cached = self.store.get(key)
+            pending = self.store.in_flight(key) if cached is None else None
+            if pending is None:
+                break
+            cached = await asyncio.shield(pending)
+            if cached is not None:
+                break
+            # A execução terminou sem resposta (exceção ou corpo grande demais): verifica
+            # de novo; a primeira duplicata a acordar executa e as demais aguardam por ela
+
+        if cached is None:
+            self.store.begin(key)
+            try:
+                cached = await self.store.acquire(key)
+            except BaseException:
+                self.store.finish(key, None)
+                raise
+            if cached is not None:
+                self.store.finish(key, cached)
+
+        if cached is not None:
+            if cached.fingerprint != fingerprint:
+                await self._send_json(send, 422, {"detail": "Idempotency-Key já utilizada com outro corpo de requisição"})
+                return
+            await self._replay(send, cached)
+            return
+
+        response = None
+        try:
+            response = await self._execute(scope, body, more_messages, receive, send, fingerprint)
+        finally:
+            # Erros 5xx e 429 não são armazenados para que o cliente possa tentar novamente
+            if response is not None and response.status < 500 and response.status != 429:
+                self.store.put(key, fingerprint, response.status, response.headers, response.body)
+            else:
+                self.store.release(key)
+            self.store.finish(key, response)
+
+    async def _read_body(self, receive) -> Tuple[bytes, List[Dict[str, Any]]]:
+        """Lê o corpo completo da requisição para calcular a impressão digital"""
+        chunks = []
+        extra = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                extra.append(message)
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks), extra
+
+    async def _execute(self, scope, body: bytes, extra: List[Dict[str, Any]], receive, send, fingerprint: str) -> Optional[CachedResponse]:
+        """Executa a aplicação reproduzindo o corpo lido e capturando a resposta"""
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            if extra:
+                return extra.pop(0)
+            return await receive()
+
+        status = None
+        headers: List[Tuple[bytes, bytes]] = []
+        chunks: List[bytes] = []
+        size = 0
+
+        async def capture_send(message):
+            nonlocal status, headers, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size <= self.max_body_bytes:
+                    chunks.append(chunk)
+            await send(message)
+
+        await self.app(scope, replay_receive, capture_send)
+
+        if status is None or size > self.max_body_bytes:
+            return None
+        return CachedResponse(fingerprint, status, headers, b"".join(chunks), 0.0)
+
+    async def _replay(self, send, cached: CachedResponse):
+        await send({
+            "type": "http.response.start",
+            "status": cached.status,
+            "headers": cached.headers + [(REPLAYED_HEADER, b"true")],
+        })
+        await send({"type": "http.response.body", "body": cached.body})
+
+    async def _send_json(self, send, status: int, content: Dict[str, Any]):
+        body = json.dumps(content).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerWatcher:
+    """Mantém em memória o último ledger e o estado da conexão com a rede
+
+    Uma task consulta `check` a cada `interval` segundos; o /health responde
+    a partir desse estado, sem I/O. O estado é considerado velho (stale)
+    quando a última verificação bem-sucedida tem mais de `stale_after`
+    segundos.
+
+    Uma verificação que passa do `timeout` não é abandonada: as seguintes
+    aguardam a mesma em vez de iniciar outra, para que um Horizon lento não
+    acumule chamadas presas.
+    """
+
+    def __init__(self, check: Callable[[], Awaitable[Dict[str, Any]]], interval: float = 5.0,
+                 stale_after: Optional[float] = None, timeout: float = 5.0):
+        self.check = check
+        self.interval = interval
+        self.stale_after = stale_after if stale_after is not None else 3 * interval
+        self.timeout = timeout
+        self._task: Optional[asyncio.Task] = None
+        self._status: Dict[str, Any] = {"connected": False, "error": "Nenhuma verificação realizada"}
+        self._checked_at: Optional[float] = None
+        self._success_at: Optional[float] = None
+        self._checked_at_wall: Optional[datetime] = None
+        self._pending: Optional[asyncio.Future] = None
+        self.consecutive_failures = 0
+        # Verificações profundas simultâneas compartilham uma consulta
+        self._refreshes = SingleFlight()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._pending is not None:
+            self._pending.cancel()
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self) -> Dict[str, Any]:
+        """Executa uma verificação agora e atualiza o estado"""
+        return await self._refreshes.do("refresh", self._refresh)
+
+    async def _refresh(self) -> Dict[str, Any]:
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.ensure_future(self.check())
+        try:
+            status = await asyncio.wait_for(asyncio.shield(self._pending), self.timeout)
+        except asyncio.TimeoutError:
+            status = {"connected": False, "error": f"Timeout após {self.timeout:g}s"}
+        except Exception as e:
+            status = {"connected": False, "error": str(e)}
+
+        now = time.monotonic()
+        was_connected = self._status.get("connected")
+        self._status = status
+        self._checked_at = now
+        self._checked_at_wall = datetime.utcnow()
+        if status.get("connected"):
+            if self.consecutive_failures and self._success_at is not None:
+                logger.info("Conexão com a rede Stellar restabelecida após %d falhas", self.consecutive_failures)
+            self._success_at = now
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            if was_connected:
+                logger.warning("Conexão com a rede Stellar perdida: %s", status.get("error"))
+        return status
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado atual sem I/O, com idade e indicador de estado velho"""
+        now = time.monotonic()
+        age = now - self._success_at if self._success_at is not None else None
+        return {
+            **self._status,
+            "checked_at": self._checked_at_wall.isoformat() if self._checked_at_wall else None,
+            "age_seconds": round(age, 3) if age is not None else None,
+            "stale": age is None or age > self.stale_after,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+def create_ledger_watcher(check: Callable[[], Awaitable[Dict[str, Any]]]) -> Optional[LedgerWatcher]:
+    """Cria o watcher conforme STELLAR_HEALTH_WATCHER_ENABLED, STELLAR_HEALTH_POLL_SECONDS e STELLAR_HEALTH_TIMEOUT_SECONDS"""
+    if os.getenv("STELLAR_HEALTH_WATCHER_ENABLED", "true").lower() != "true":
+        return None
+    return LedgerWatcher(
+        check,
+        interval=float(os.getenv("STELLAR_HEALTH_POLL_SECONDS", 5)),
+        timeout=float(os.getenv("STELLAR_HEALTH_TIMEOUT_SECONDS", 5)),
+    )
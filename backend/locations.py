@@ -0,0 +1,182 @@
+import heapq
+import math
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from geo import EARTH_RADIUS_KM, KM_PER_DEGREE
+
+# Margem para a aproximação plana usada no limite inferior de distância
+_BOUND_SAFETY = 0.99
+
+
+class DriverLocationIndex:
+    """Última posição de cada motorista em uma grade de células lat/lng
+
+    update() é O(1): a posição é substituída e o motorista só muda de
+    célula quando cruza a borda. nearest() percorre anéis de células a
+    partir da célula da origem e para assim que nenhuma célula ainda não
+    visitada pode conter alguém mais perto que o k-ésimo encontrado.
+
+    O índice vive na memória do processo; com vários workers, cada um
+    conhece apenas os pings que recebeu.
+    """
+
+    def __init__(self, cell_degrees: float = 0.01, max_age: float = 120.0, max_km: float = 50.0):
+        self.cell_degrees = cell_degrees
+        self.max_age = max_age
+        self.max_km = max_km
+        # driver_id -> (lat, lng, recebido_em, célula, lat_rad, lng_rad, cos_lat);
+        # a trigonometria da posição é feita no ping, não em cada busca
+        self._positions: Dict[str, Tuple[float, float, float, Tuple[int, int], float, float, float]] = {}
+        self._cells: Dict[Tuple[int, int], Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def update(self, driver_id: str, lat: float, lng: float, at: Optional[float] = None) -> bool:
+        """Registra a posição; pings mais antigos que o atual são ignorados (retorna False)"""
+        at = at if at is not None else time.time()
+        current = self._positions.get(driver_id)
+        if current is not None and at < current[2]:
+            return False
+
+        cell = self._cell(lat, lng)
+        if current is not None and current[3] != cell:
+            self._discard(driver_id, current[3])
+        if current is None or current[3] != cell:
+            self._cells.setdefault(cell, set()).add(driver_id)
+        lat_rad = math.radians(lat)
+        self._positions[driver_id] = (lat, lng, at, cell, lat_rad, math.radians(lng), math.cos(lat_rad))
+        return True
+
+    def remove(self, driver_id: str):
+        current = self._positions.pop(driver_id, None)
+        if current is not None:
+            self._discard(driver_id, current[3])
+
+    def _discard(self, driver_id: str, cell: Tuple[int, int]):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def get(self, driver_id: str) -> Optional[Tuple[float, float, float]]:
+        current = self._positions.get(driver_id)
+        return current[:3] if current is not None else None
+
+    def fresh(self, now: Optional[float] = None) -> Iterator[Tuple[str, float, float]]:
+        """(driver_id, lat, lng) de todas as posições com menos de max_age segundos"""
+        oldest = (now if now is not None else time.time()) - self.max_age
+        for driver_id, (lat, lng, at, *_) in self._positions.items():
+            if at >= oldest:
+                yield driver_id, lat, lng
+
+    def _ring(self, row: int, col: int, radius: int):
+        if radius == 0:
+            yield row, col
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield row - radius, c
+            yield row + radius, c
+        for r in range(row - radius + 1, row + radius):
+            yield r, col - radius
+            yield r, col + radius
+
+    def _bound(self, lat: float, lng: float, radius: int) -> float:
+        """Distância mínima (km) de (lat, lng) até células a mais de `radius` células da sua
+
+        É a distância até a borda mais próxima do quadrado de anéis já
+        visitados. Em longitude a célula encolhe com a latitude; usa a maior
+        latitude alcançada (válido para as distâncias limitadas por max_km).
+        """
+        size = self.cell_degrees
+        row, col = self._cell(lat, lng)
+        lat_gap = min(lat - row * size, (row + 1) * size - lat) + radius * size
+        lng_gap = min(lng - col * size, (col + 1) * size - lng) + radius * size
+        edge_lat = min(90.0, abs(lat) + (radius + 1) * size)
+        return min(lat_gap, lng_gap * math.cos(math.radians(edge_lat))) * KM_PER_DEGREE * _BOUND_SAFETY
+
+    def nearest(self, lat: float, lng: float, k: int = 5, accept: Optional[Callable[[str], bool]] = None,
+                max_km: Optional[float] = None, now: Optional[float] = None) -> List[Tuple[float, str]]:
+        """Até k pares (distância_km, driver_id) mais próximos, do mais perto ao mais longe
+
+        `accept` filtra motoristas (ex: disponibilidade); posições mais velhas
+        que max_age e além de max_km (padrão: o do índice) são ignoradas.
+        """
+        if k <= 0:
+            return []
+        max_km = max_km if max_km is not None else self.max_km
+        now = now if now is not None else time.time()
+        oldest = now - self.max_age
+        # Heap de máximo (distância negativa) com os k melhores até aqui
+        best: List[Tuple[float, str]] = []
+        positions = self._positions
+        q_lat, q_lng = math.radians(lat), math.radians(lng)
+        q_cos = math.cos(q_lat)
+        sin, asin, sqrt = math.sin, math.asin, math.sqrt
+
+        def consider(members: Set[str]):
+            for driver_id in members:
+                _, _, at, _, d_lat, d_lng, d_cos = positions[driver_id]
+                if at < oldest:
+                    continue
+                # Haversine (geo.haversine_km) com os termos da origem e do motorista já calculados
+                a = sin((d_lat - q_lat) / 2) ** 2 + q_cos * d_cos * sin((d_lng - q_lng) / 2) ** 2
+                distance = 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+                if distance > max_km or (len(best) == k and distance >= -best[0][0]):
+                    continue
+                if accept is not None and not accept(driver_id):
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, driver_id))
+                else:
+                    heapq.heapreplace(best, (-distance, driver_id))
+
+        def done(radius: int) -> bool:
+            bound = self._bound(lat, lng, radius)
+            return bound > max_km or (len(best) == k and -best[0][0] <= bound)
+
+        row, col = self._cell(lat, lng)
+        cells = self._cells
+        radius = 0
+        lookups = 0
+        while True:
+            for cell in self._ring(row, col, radius):
+                members = cells.get(cell)
+                if members:
+                    consider(members)
+            lookups += max(1, 8 * radius)
+            if done(radius):
+                break
+            radius += 1
+            # Em áreas vazias os anéis crescem sem achar ninguém: a partir do
+            # ponto em que já custaram mais que percorrer as células ocupadas,
+            # percorre as que faltam em ordem de distância
+            if lookups > len(cells):
+                remaining = sorted(
+                    (max(abs(cell_row - row), abs(cell_col - col)), cell_row, cell_col)
+                    for cell_row, cell_col in cells
+                )
+                for distance, cell_row, cell_col in remaining:
+                    if distance < radius:
+                        continue
+                    if done(distance - 1):
+                        break
+                    consider(cells[(cell_row, cell_col)])
+                break
+
+        return sorted((-negative, driver_id) for negative, driver_id in best)
+
+
+def create_location_index() -> DriverLocationIndex:
+    """Índice conforme DRIVER_LOCATION_CELL_DEGREES (0.01 ≈ 1,1 km), DRIVER_LOCATION_MAX_AGE_SECONDS (120)
+    e DRIVER_SEARCH_MAX_KM (50, raio padrão das buscas)"""
+    return DriverLocationIndex(
+        cell_degrees=float(os.getenv("DRIVER_LOCATION_CELL_DEGREES", 0.01)),
+        max_age=float(os.getenv("DRIVER_LOCATION_MAX_AGE_SECONDS", 120)),
+        max_km=float(os.getenv("DRIVER_SEARCH_MAX_KM", 50)),
+    )
@@ -0,0 +1,149 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+# ID da requisição corrente, propagado para tasks criadas durante a requisição
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+# Atributos padrão de LogRecord; o resto veio de extra={...} e vai para o JSON
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formata registros como uma linha JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            payload["request_id"] = record.request_id
+        for name, value in record.__dict__.items():
+            if name not in _RESERVED_ATTRS:
+                payload[name] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+class RequestContextFilter(logging.Filter):
+    """Anexa o request_id do contexto atual ao registro"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class InfoSamplingFilter(logging.Filter):
+    """Amostra registros INFO (e abaixo) de loggers de alto volume
+
+    WARNING e acima sempre passam.
+    """
+
+    def __init__(self, rate: float, prefixes):
+        super().__init__()
+        self.rate = rate
+        self.prefixes = tuple(prefixes)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno > logging.INFO:
+            return True
+        if not record.name.startswith(self.prefixes):
+            return True
+        return random.random() < self.rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que não formata a mensagem na thread do chamador
+
+    O QueueHandler padrão chama format() em prepare(); aqui o registro vai
+    para a fila intacto e toda a formatação acontece na thread do listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging():
+    """Configura logging assíncrono: fila na thread do event loop, escrita em thread própria
+
+    Variáveis de ambiente: LOG_LEVEL (INFO), LOG_FORMAT (json|text),
+    LOG_INFO_SAMPLE_RATE (1.0 = sem amostragem) e LOG_SAMPLED_LOGGERS
+    (prefixos separados por vírgula dos loggers amostrados).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if os.getenv("LOG_FORMAT", "json").lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter())
+    handler.addFilter(InfoSamplingFilter(
+        float(os.getenv("LOG_INFO_SAMPLE_RATE", 1.0)),
+        [prefix.strip() for prefix in os.getenv("LOG_SAMPLED_LOGGERS", "stellar_service,user_service").split(",") if prefix.strip()],
+    ))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class RequestIdMiddleware:
+    """Middleware ASGI que define o request_id (header X-Request-ID ou gerado)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id:
+            request_id = uuid.uuid4().hex[:16]
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(REQUEST_ID_HEADER, request_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_seconds", "Atraso no agendamento do event loop",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_BLOCKED = REGISTRY.counter(
+    "event_loop_blocked_total", "Callbacks que bloquearam o event loop acima do limite", ("route",)
+)
+
+
+def _current_route(frame) -> Optional[str]:
+    """Procura na pilha o scope ASGI da requisição em execução"""
+    while frame is not None:
+        if "scope" in frame.f_code.co_varnames:
+            scope = frame.f_locals.get("scope")
+            if isinstance(scope, dict) and scope.get("type") == "http":
+                route = scope.get("route")
+                template = route.path if route is not None else "unmatched"
+                return f"{scope.get('method')} {template}"
+        frame = frame.f_back
+    return None
+
+
+class LoopLagMonitor:
+    """Mede continuamente o atraso do event loop e detecta callbacks bloqueantes
+
+    Uma task acorda a cada `interval` segundos e registra quanto acordou
+    atrasada. Uma thread watchdog acompanha o último batimento dessa task:
+    se o loop passar de `threshold` sem rodar, ela captura a pilha da
+    thread do loop (e a rota da requisição, se houver) e registra um
+    WARNING enquanto o código bloqueante ainda está executando.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        # Rota capturada pelo watchdog no bloqueio atual; lida pela task do loop
+        self._blocked_route: Optional[str] = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            LOOP_LAG.observe(lag)
+
+            if lag >= self.threshold:
+                route = self._blocked_route or "unknown"
+                self._blocked_route = None
+                LOOP_BLOCKED.inc(route)
+                logger.warning("Event loop bloqueado por %.0f ms (%s)", lag * 1000, route,
+                               extra={"lag_ms": round(lag * 1000, 1), "route": route})
+
+    def _watch(self):
+        reported = None
+        check_every = min(self.interval, self.threshold) / 2
+        while not self._stopped.wait(check_every):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            route = _current_route(frame)
+            self._blocked_route = route
+            stack = "".join(traceback.format_stack(frame, limit=40))
+            logger.warning("Event loop bloqueado há %.0f ms (%s)\n%s", stalled * 1000, route or "sem requisição", stack,
+                           extra={"blocked_ms": round(stalled * 1000, 1), "route": route})
+
+
+def create_loop_monitor() -> Optional[LoopLagMonitor]:
+    """Cria o monitor conforme LOOP_MONITOR_ENABLED, LOOP_MONITOR_INTERVAL_MS e LOOP_BLOCK_THRESHOLD_MS"""
+    if os.getenv("LOOP_MONITOR_ENABLED", "true").lower() != "true":
+        return None
+    return LoopLagMonitor(
+        interval=float(os.getenv("LOOP_MONITOR_INTERVAL_MS", 100)) / 1000,
+        threshold=float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", 250)) / 1000,
+    )
@@ -1,27 +1,133 @@
+# Primeira importação: o relógio das fases de inicialização começa aqui
+from startup import startup_timer
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 import os
 from dotenv import load_dotenv
-import uvicorn
 from models import (
     TripData, ContractUpdate, ContractResponse, User, UserRole, 
-    RideRequest, RideAcceptRequest, RideRejectRequest, RideStatus, CreateRideRequestBody,  StartRideRequest
+    RideRequest, RideAcceptRequest, RideRejectRequest, RideStatus, CreateRideRequestBody,  StartRideRequest, DriverLocationUpdate,
+    DispatchRequestBody, DriverLocationBatch
 )
 from stellar_service import StellarContractService
-from user_service import UserService
+from user_service import UserService, RideConflictError
+from idempotency import IdempotencyStore, IdempotencyMiddleware
+from state_backend import create_state_backend
+from rate_limit import RateLimitMiddleware, SharedTokenBucketStore
+from logging_config import setup_logging, RequestIdMiddleware
+from metrics import REGISTRY, MetricsMiddleware
+from profiler import profile, ProfilerBusyError
+from loop_monitor import create_loop_monitor
+from tracing import setup_tracing, TracingMiddleware
+from ledger_watcher import create_ledger_watcher
+from memory import MemoryAccountant, process_memory
+from columnar import create_columnar_store
+from locations import create_location_index
+from geofences import create_geofence_monitor
+from route_metrics import create_route_metrics
+from traces import create_trace_store, encode_polyline
+from demand import create_demand_heatmap
+from dispatch import create_dispatcher
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from typing import Optional, List
+import asyncio
+import json
+import logging
+import secrets
+import time
+
+startup_timer.mark("imports")
 
 load_dotenv()
+setup_logging()
+setup_tracing()
+
+logger = logging.getLogger(__name__)
+startup_timer.mark("config")
+
+# Atraso do event loop e detecção de callbacks bloqueantes (LOOP_MONITOR_ENABLED)
+loop_monitor = create_loop_monitor()
+
+async def warm_up_chain():
+    """Prepara a camada Stellar (SDK, conta) e registra a duração"""
+    start = time.perf_counter()
+    await stellar_service.warm_up()
+    startup_timer.record("chain_warmup", time.perf_counter() - start)
+    logger.info("Camada Stellar: %s em %.2fs", stellar_service.chain_status, time.perf_counter() - start)
+
+async def compact_state_backend(interval: float):
+    """Apaga periodicamente as linhas expiradas do backend (tombstones, reivindicações, buckets)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await asyncio.to_thread(state_backend.compact)
+            if removed:
+                logger.info("Backend compactado: %d linhas expiradas removidas", removed)
+        except Exception:
+            logger.exception("Falha ao compactar o backend compartilhado")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if loop_monitor:
+        loop_monitor.start()
+    
+    # STARTUP_MODE=lazy (padrão) aceita requisições enquanto a camada Stellar
+    # é preparada em background; eager só começa a servir com ela pronta
+    warm_up_task = None
+    if os.getenv("STARTUP_MODE", "lazy").lower() == "eager":
+        await warm_up_chain()
+    else:
+        warm_up_task = asyncio.create_task(warm_up_chain())
+    
+    if ledger_watcher:
+        ledger_watcher.start()
+    if dispatcher is not None:
+        dispatcher.start()
+    compact_task = None
+    if state_backend is not None:
+        compact_task = asyncio.create_task(
+            compact_state_backend(float(os.getenv("STATE_BACKEND_COMPACT_INTERVAL_SECONDS", 300)))
+        )
+    startup_timer.mark("lifespan")
+    logger.info("API pronta em %.2fs", startup_timer.report()["serving_after_seconds"], extra={"startup": startup_timer.report()})
+    yield
+    if warm_up_task and not warm_up_task.done():
+        warm_up_task.cancel()
+    if compact_task is not None:
+        compact_task.cancel()
+    if ledger_watcher:
+        await ledger_watcher.stop()
+    if dispatcher is not None:
+        await dispatcher.stop()
+    if loop_monitor:
+        await loop_monitor.stop()
 
 app = FastAPI(
     title="Stellar Transport Contracts API",
     description="API para gestão de contratos inteligentes de transporte na blockchain Stellar",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
+# Estado compartilhado entre workers (STATE_BACKEND_URL); sem ele, apenas memória
+state_backend = create_state_backend()
+
+# Rate limiting por usuário e por rota nas rotas que geram taxas na blockchain
+if os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true":
+    if state_backend and os.getenv("RATE_LIMIT_SHARED", "false").lower() == "true":
+        app.add_middleware(RateLimitMiddleware, store=SharedTokenBucketStore(state_backend))
+    else:
+        app.add_middleware(RateLimitMiddleware)
+
+# Idempotency-Key em rotas POST (retentativas de clientes móveis não reexecutam
+# operações como start_ride, que cria transações na blockchain). Fica por fora
+# do rate limiting: a resposta repetida de uma retentativa não consome token
+idempotency_store = IdempotencyStore(backend=state_backend)
+app.add_middleware(IdempotencyMiddleware, store=idempotency_store)
+
 # Configuração CORS para o frontend
 app.add_middleware(
     CORSMiddleware,
@@ -31,30 +137,136 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ID (X-Request-ID) para correlacionar os logs de uma requisição
+app.add_middleware(RequestIdMiddleware)
+
+# Span raiz de cada requisição (TRACING_EXPORTER); aceita e devolve traceparent
+app.add_middleware(TracingMiddleware)
+
+# Métricas por rota (contagem, latência, em andamento) expostas em /metrics
+app.add_middleware(MetricsMiddleware)
+
 # Servir arquivos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+startup_timer.mark("app")
+
+# Jinja2 só é importado na primeira página renderizada
+_templates = None
+
+def get_templates():
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory="templates")
+    return _templates
 
 # Inicializa os serviços
-stellar_service = StellarContractService()
-user_service = UserService()
+stellar_service = StellarContractService(
+    backend=state_backend, sync_interval=float(os.getenv("STATE_SYNC_INTERVAL_SECONDS", 0.1))
+)
+# Checkpoints marcados automaticamente quando o motorista entra no raio de cada ponto da rota
+geofence_monitor = create_geofence_monitor(stellar_service.update_contract_status, backend=state_backend)
+user_service = UserService(
+    backend=state_backend, columns=create_columnar_store(), locations=create_location_index(),
+    routes=create_route_metrics(), geofences=geofence_monitor, traces=create_trace_store(backend=state_backend),
+    demand=create_demand_heatmap(), sync_interval=float(os.getenv("STATE_SYNC_INTERVAL_SECONDS", 0.1))
+)
+
+# Despacho automático em lotes das corridas sem motorista (DISPATCH_ENABLED)
+dispatcher = create_dispatcher(user_service)
+
+# Último ledger e conectividade mantidos em memória para o /health
+ledger_watcher = create_ledger_watcher(stellar_service.check_connection)
+
+# Memória aproximada por estrutura (amostrada, em cache) e snapshots do tracemalloc
+memory_accountant = MemoryAccountant(
+    user_service, stellar_service, ttl=float(os.getenv("MEMORY_REPORT_TTL_SECONDS", 30))
+)
+startup_timer.mark("services")
+
+# Métricas calculadas no momento da coleta
+REGISTRY.gauge(
+    "user_service_store_size", "Entradas em cada estrutura do UserService", ("store",),
+    collect=lambda: {(name,): size for name, size in user_service.store_sizes().items()}
+)
+REGISTRY.gauge(
+    "stellar_contracts_cached", "Contratos no cache do StellarContractService",
+    collect=lambda: {(): len(stellar_service.contracts_data)}
+)
+REGISTRY.gauge(
+    "contract_lookups", "Consultas de contrato agrupadas (single-flight)", ("stat",),
+    collect=lambda: {(name,): value for name, value in stellar_service.lookups.stats().items()}
+)
+REGISTRY.gauge(
+    "route_metrics_cache", "Cache de distância/ETA por rota", ("stat",),
+    collect=lambda: {(name,): value for name, value in user_service.routes.stats().items()}
+)
+if geofence_monitor is not None:
+    REGISTRY.gauge(
+        "geofence_checkpoints", "Viagens monitoradas, geofences armados e checkpoints disparados", ("stat",),
+        collect=lambda: {(name,): value for name, value in geofence_monitor.stats().items()}
+    )
+if user_service.traces is not None:
+    REGISTRY.gauge(
+        "gps_traces", "Trajetos GPS ativos e encerrados, pings recebidos e pontos/bytes guardados", ("stat",),
+        collect=lambda: {(name,): value for name, value in user_service.traces.stats().items()}
+    )
+if user_service.demand is not None:
+    REGISTRY.gauge(
+        "demand_heatmap", "Buckets de tempo, células e corridas contadas no heatmap de demanda", ("stat",),
+        collect=lambda: {(name,): value for name, value in user_service.demand.stats().items()}
+    )
+if ledger_watcher:
+    REGISTRY.gauge(
+        "stellar_connected", "Conexão com o Horizon na última verificação (1/0)",
+        collect=lambda: {(): 1.0 if ledger_watcher.snapshot().get("connected") else 0.0}
+    )
+    REGISTRY.gauge(
+        "stellar_latest_ledger", "Último ledger visto pelo watcher",
+        collect=lambda: {(): float(ledger_watcher.snapshot().get("latest_ledger") or 0)}
+    )
+REGISTRY.gauge(
+    "memory_structure_bytes", "Memória aproximada de cada estrutura em memória", ("structure",),
+    collect=lambda: {(name,): stats["bytes"] for name, stats in memory_accountant.structures().items()}
+)
+REGISTRY.gauge(
+    "memory_structure_bytes_per_entry", "Memória aproximada por entrada de cada estrutura", ("structure",),
+    collect=lambda: {(name,): stats["bytes_per_entry"] for name, stats in memory_accountant.structures().items()}
+)
+REGISTRY.gauge(
+    "process_resident_memory_bytes", "Memória residente do processo",
+    collect=lambda: {(): process_memory()["rss_bytes"] or 0}
+)
+if dispatcher is not None:
+    REGISTRY.gauge(
+        "dispatch_queue_size", "Corridas aguardando o despacho automático",
+        collect=lambda: {(): len(dispatcher)}
+    )
+REGISTRY.gauge(
+    "startup_phase_seconds", "Duração de cada fase da inicialização", ("phase",),
+    collect=lambda: {(name,): seconds for name, seconds in startup_timer.phases.items()}
+)
+REGISTRY.gauge(
+    "idempotency_cache_entries", "Respostas armazenadas para Idempotency-Key",
+    collect=lambda: {(): len(idempotency_store)}
+)
 
 # =================== ROTAS DE INTERFACE ===================
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Tela inicial - seleção entre Driver e Enterprise Mode"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    return get_templates().TemplateResponse("index.html", {"request": request})
 
 @app.get("/driver", response_class=HTMLResponse)
 async def driver_interface(request: Request):
     """Interface do motorista"""
-    return templates.TemplateResponse("driver.html", {"request": request})
+    return get_templates().TemplateResponse("driver.html", {"request": request})
 
 @app.get("/enterprise", response_class=HTMLResponse)
 async def enterprise_interface(request: Request):
     """Interface da empresa"""
-    return templates.TemplateResponse("enterprise.html", {"request": request})
+    return get_templates().TemplateResponse("enterprise.html", {"request": request})
 
 # =================== ROTAS DE USUÁRIOS ===================
 
@@ -65,7 +277,7 @@ async def get_users(role: Optional[UserRole] = None):
         if role:
             users = await user_service.get_users_by_role(role)
         else:
-            users = list(user_service.users.values())
+            users = await user_service.list_users()
         
         return ContractResponse(
             success=True,
@@ -121,16 +333,24 @@ async def create_user(user_data: dict):
 
 # =================== ROTAS DE RIDE REQUESTS ===================
 
+def ride_dicts(rides, include_metrics: bool = False) -> List[dict]:
+    """Serializa corridas; com include_metrics, inclui distância e ETA da rota (route_metrics)"""
+    items = [ride.to_dict() for ride in rides]
+    if include_metrics:
+        for item, metrics in zip(items, user_service.route_metrics(rides)):
+            item["route_metrics"] = metrics.to_dict()
+    return items
+
 @app.get("/api/ride-requests")
-async def get_ride_requests(user_id: str, status: Optional[RideStatus] = None):
-    """Lista ride requests para um usuário"""
+async def get_ride_requests(user_id: str, status: Optional[RideStatus] = None, include_metrics: bool = False):
+    """Lista ride requests para um usuário (include_metrics: distância e ETA calculadas da rota)"""
     try:
         requests = await user_service.get_ride_requests_for_user(user_id, status)
         
         return ContractResponse(
             success=True,
             message="Solicitações recuperadas",
-            data={"ride_requests": [req.dict() for req in requests]}
+            data={"ride_requests": ride_dicts(requests, include_metrics)}
         )
     except Exception as e:
         raise HTTPException(
@@ -142,11 +362,14 @@ async def get_ride_requests(user_id: str, status: Optional[RideStatus] = None):
 async def create_ride_request(request_body: CreateRideRequestBody):
     """Empresa cria uma solicitação de corrida"""
     try:
-        print("=========== TENTATIVO DE CRIAR ROTA ==============")
-        print(f"Request body recebido: {request_body}")
-        print(f"Enterprise ID: {request_body.enterprise_id}")
-        print(f"Driver ID: {request_body.driver_id}")
-        print(f"Trip Data: {request_body.trip_data}")
+        logger.debug(
+            "Criando solicitação de corrida",
+            extra={
+                "enterprise_id": request_body.enterprise_id,
+                "driver_id": request_body.driver_id,
+                "trip_id": request_body.trip_data.trip_id
+            }
+        )
         
         ride_request = await user_service.create_ride_request(
             enterprise_id=request_body.enterprise_id,
@@ -157,27 +380,23 @@ async def create_ride_request(request_body: CreateRideRequestBody):
         return ContractResponse(
             success=True,
             message="Solicitação de corrida criada",
-            data={"ride_request": ride_request.dict()}
+            data={"ride_request": ride_request.to_dict()}
         )
     except ValueError as e:
-        print("=========== ERRO DE VALIDAÇÃO ==============")
-        print(f"Erro: {str(e)}")
+        logger.info("Solicitação de corrida inválida: %s", e)
         raise HTTPException(
             status_code=400,
             detail=str(e)
         )
     except Exception as e:
-        print("=========== ERRO GERAL ==============")
-        print(f"Erro: {str(e)}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Erro ao criar solicitação de corrida")
         raise HTTPException(
             status_code=500,
             detail=f"Erro ao criar solicitação: {str(e)}"
         )
 
 @app.get("/api/ride-requests/{request_id}")
-async def get_ride_request(request_id: str):
+async def get_ride_request(request_id: str, include_metrics: bool = False):
     """Obtém detalhes de uma solicitação específica"""
     try:
         ride_request = await user_service.get_ride_request(request_id)
@@ -190,7 +409,7 @@ async def get_ride_request(request_id: str):
         return ContractResponse(
             success=True,
             message="Solicitação encontrada",
-            data={"ride_request": ride_request.dict()}
+            data={"ride_request": ride_dicts([ride_request], include_metrics)[0]}
         )
     except HTTPException:
         raise
@@ -206,13 +425,19 @@ async def accept_ride_request(request_id: str, accept_data: RideAcceptRequest):
     try:
         ride_request = await user_service.accept_ride_request(
             request_id=request_id,
-            driver_id=accept_data.driver_id
+            driver_id=accept_data.driver_id,
+            version=accept_data.version
         )
         
         return ContractResponse(
             success=True,
             message="Corrida aceita com sucesso",
-            data={"ride_request": ride_request.dict()}
+            data={"ride_request": ride_request.to_dict()}
+        )
+    except RideConflictError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
         )
     except ValueError as e:
         raise HTTPException(
@@ -232,13 +457,19 @@ async def reject_ride_request(request_id: str, reject_data: RideRejectRequest):
         ride_request = await user_service.reject_ride_request(
             request_id=request_id,
             driver_id=reject_data.driver_id,
-            reason=reject_data.reason
+            reason=reject_data.reason,
+            version=reject_data.version
         )
         
         return ContractResponse(
             success=True,
             message="Corrida rejeitada",
-            data={"ride_request": ride_request.dict()}
+            data={"ride_request": ride_request.to_dict()}
+        )
+    except RideConflictError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
         )
     except ValueError as e:
         raise HTTPException(
@@ -257,22 +488,23 @@ async def start_ride(request_id: str, start_data: StartRideRequest):
     try:
         ride_request = await user_service.start_ride(
             request_id=request_id,
-            enterprise_id=start_data.enterprise_id  # Mudança aqui
+            enterprise_id=start_data.enterprise_id,  # Mudança aqui
+            version=start_data.version
         )
         
         # Também cria o contrato na blockchain quando a corrida inicia
         if ride_request.status == RideStatus.EM_ANDAMENTO:
             contract_result = await stellar_service.create_transport_contract(
-                trip_id=ride_request.trip_data.trip_id,
+                trip_id=ride_request.trip.trip_id,
                 driver=ride_request.driver_id,
-                route=ride_request.trip_data.route
+                route=ride_request.trip.route
             )
             
             return ContractResponse(
                 success=True,
                 message="Corrida iniciada e contrato criado na blockchain",
                 data={
-                    "ride_request": ride_request.dict(),
+                    "ride_request": ride_request.to_dict(),
                     "contract": contract_result
                 }
             )
@@ -280,7 +512,12 @@ async def start_ride(request_id: str, start_data: StartRideRequest):
         return ContractResponse(
             success=True,
             message="Corrida iniciada",
-            data={"ride_request": ride_request.dict()}
+            data={"ride_request": ride_request.to_dict()}
+        )
+    except RideConflictError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
         )
     except ValueError as e:
         raise HTTPException(
@@ -304,7 +541,7 @@ async def get_notifications(user_id: str, unread_only: bool = False):
         return ContractResponse(
             success=True,
             message="Notificações recuperadas",
-            data={"notifications": [notif.dict() for notif in notifications]}
+            data={"notifications": [notif.to_dict() for notif in notifications]}
         )
     except Exception as e:
         raise HTTPException(
@@ -329,6 +566,161 @@ async def mark_notification_read(user_id: str, notification_id: str):
             detail=f"Erro ao marcar notificação: {str(e)}"
         )
 
+# =================== ROTAS DE MOTORISTAS ===================
+
+@app.post("/api/drivers/{driver_id}/location")
+async def update_driver_location(driver_id: str, location: DriverLocationUpdate):
+    """Recebe o ping de posição de um motorista (alta frequência); pode disparar checkpoints da corrida"""
+    try:
+        result = await user_service.update_driver_location(driver_id, location.lat, location.lng, location.recorded_at)
+        return ContractResponse(
+            success=True,
+            message="Posição registrada" if result["accepted"] else "Posição mais antiga que a última registrada",
+            data=result
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.exception("Erro ao registrar posição")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro ao registrar posição: {str(e)}"
+        )
+
+@app.post("/api/drivers/locations")
+async def update_driver_locations(batch: DriverLocationBatch):
+    """Recebe pings de vários motoristas em uma requisição"""
+    try:
+        result = await user_service.update_driver_locations(
+            [(ping.driver_id, ping.lat, ping.lng, ping.recorded_at) for ping in batch.pings]
+        )
+        return ContractResponse(
+            success=True,
+            message=f"{result['accepted']} posições registradas",
+            data=result
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.exception("Erro ao registrar posições")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro ao registrar posições: {str(e)}"
+        )
+
+@app.get("/api/drivers/nearest")
+async def nearest_drivers(lat: float, lng: float, k: int = 5, max_km: Optional[float] = None):
+    """
+    Os k motoristas disponíveis mais próximos da origem, com posição recente
+
+    O índice de posições fica na memória de cada worker e só contém os
+    pings que ele recebeu: com vários workers (WEB_CONCURRENCY > 1) a
+    resposta depende do worker que atendeu a requisição.
+    """
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas fora da faixa válida")
+    if not 1 <= k <= 100:
+        raise HTTPException(status_code=400, detail="k deve estar entre 1 e 100")
+    
+    try:
+        drivers = await user_service.nearest_available_drivers(lat, lng, k, max_km)
+        return ContractResponse(
+            success=True,
+            message=f"{len(drivers)} motoristas disponíveis encontrados",
+            data={"drivers": drivers}
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.exception("Erro ao buscar motoristas próximos")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro ao buscar motoristas próximos: {str(e)}"
+        )
+
+def require_demand_heatmap():
+    if user_service.demand is None:
+        raise HTTPException(status_code=503, detail="Heatmap de demanda desabilitado")
+    return user_service.demand
+
+@app.get("/api/demand/heatmap")
+async def demand_heatmap(
+    min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+    created_from: Optional[datetime] = None, created_to: Optional[datetime] = None, precision: int = 5
+):
+    """
+    Origens das corridas por célula de geohash, para posicionar a frota
+
+    Conta as células que intersectam a caixa, nos buckets de tempo (1 hora
+    por padrão) entre created_from e created_to (exclusivo; padrão: as
+    últimas 24 horas).
+    """
+    require_demand_heatmap()
+    if not (-90 <= min_lat <= 90 and -90 <= max_lat <= 90 and -180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas fora da faixa válida")
+    created_to = created_to or datetime.utcnow()
+    created_from = created_from or created_to - timedelta(hours=24)
+    try:
+        heatmap = await user_service.demand_heatmap(
+            min_lat, min_lng, max_lat, max_lng, created_from, created_to, precision
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    return ContractResponse(
+        success=True,
+        message=f"{heatmap['total']} corridas em {len(heatmap['cells'])} células",
+        data=heatmap
+    )
+
+# =================== ROTAS DE DESPACHO ===================
+
+def require_dispatcher():
+    if dispatcher is None:
+        raise HTTPException(status_code=503, detail="Despacho automático desabilitado")
+    return dispatcher
+
+@app.post("/api/dispatch/requests")
+async def create_dispatch_request(request_body: DispatchRequestBody):
+    """Empresa solicita uma corrida sem escolher o motorista; o despacho atribui o mais adequado"""
+    require_dispatcher()
+    try:
+        ticket = await dispatcher.submit(request_body.enterprise_id, request_body.trip_data)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    return ContractResponse(
+        success=True,
+        message="Corrida na fila de despacho",
+        data={"dispatch": ticket.to_dict()}
+    )
+
+@app.get("/api/dispatch/requests/{ticket_id}")
+async def get_dispatch_request(ticket_id: str):
+    """Situação de uma corrida na fila de despacho (inclui a corrida criada, quando atribuída)"""
+    require_dispatcher()
+    ticket = dispatcher.get(ticket_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="Solicitação de despacho não encontrada")
+    return ContractResponse(
+        success=True,
+        message="Solicitação de despacho recuperada",
+        data={"dispatch": ticket.to_dict()}
+    )
+
 # =================== ROTAS ORIGINAIS DE CONTRATOS (COMPATIBILIDADE) ===================
 
 @app.post("/contract/create")
@@ -352,7 +744,7 @@ async def create_contract(trip_data: TripData):
                 "transaction_hash": result.get("transaction_hash"),
                 "status": "created",
                 "driver": trip_data.driver,
-                "route": trip_data.route,
+                "route": result.get("route", trip_data.route),
                 "created_at": result.get("created_at")
             }
         )
@@ -479,6 +871,8 @@ async def marcar_saida(trip_id: str):
     """Marca a saída de uma viagem"""
     try:
         result = await stellar_service.update_contract_status(trip_id, "saida", "ok")
+        if geofence_monitor is not None:
+            geofence_monitor.skip(trip_id, "saida")
         
         return ContractResponse(
             success=True,
@@ -496,6 +890,8 @@ async def marcar_meio(trip_id: str):
     """Marca chegada ao checkpoint intermediário"""
     try:
         result = await stellar_service.update_contract_status(trip_id, "meio", "checkpoint")
+        if geofence_monitor is not None:
+            geofence_monitor.skip(trip_id, "meio")
         
         return ContractResponse(
             success=True,
@@ -513,6 +909,10 @@ async def marcar_chegada(trip_id: str):
     """Marca a chegada final da viagem"""
     try:
         result = await stellar_service.update_contract_status(trip_id, "chegada", "completed")
+        if geofence_monitor is not None:
+            geofence_monitor.skip(trip_id, "chegada")
+        if user_service.traces is not None:
+            user_service.traces.finish(trip_id)
         
         return ContractResponse(
             success=True,
@@ -525,6 +925,40 @@ async def marcar_chegada(trip_id: str):
             detail=f"Erro ao marcar chegada: {str(e)}"
         )
 
+@app.get("/contract/{trip_id}/trace")
+async def get_contract_trace(trip_id: str, format: str = "geojson"):
+    """
+    Trajeto GPS da viagem (em andamento ou encerrada), enviado em streaming
+
+    format=geojson retorna um Feature LineString ([lng, lat] e os horários
+    em properties.times); format=polyline, o polyline codificado (precisão 5).
+    """
+    if format not in ("geojson", "polyline"):
+        raise HTTPException(status_code=400, detail="format deve ser geojson ou polyline")
+    points = user_service.traces.points(trip_id) if user_service.traces is not None else None
+    if points is None:
+        raise HTTPException(status_code=404, detail="Trajeto não encontrado")
+    
+    if format == "polyline":
+        return StreamingResponse(encode_polyline(points), media_type="text/plain")
+    
+    def geojson():
+        # Coordenadas em pedaços; os horários vêm depois, acumulados durante a passagem
+        yield '{"type":"Feature","geometry":{"type":"LineString","coordinates":['
+        times: List[int] = []
+        chunk: List[str] = []
+        for lat, lng, t in points:
+            chunk.append(f"[{lng},{lat}]")
+            times.append(t)
+            if len(chunk) == 256:
+                yield ("," if len(times) > 256 else "") + ",".join(chunk)
+                chunk = []
+        if chunk:
+            yield ("," if len(times) > len(chunk) else "") + ",".join(chunk)
+        yield f']}},"properties":{{"trip_id":{json.dumps(trip_id)},"times":[{",".join(map(str, times))}]}}}}'
+    
+    return StreamingResponse(geojson(), media_type="application/geo+json")
+
 @app.get("/contract/{trip_id}/history")
 async def get_contract_history(trip_id: str):
     """
@@ -548,17 +982,174 @@ async def get_contract_history(trip_id: str):
             detail=f"Erro ao buscar histórico: {str(e)}"
         )
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Métricas no formato texto do Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+# =================== ROTAS ADMINISTRATIVAS ===================
+
+def require_admin(request: Request):
+    """Valida o header X-Admin-Token contra ADMIN_TOKEN; sem ADMIN_TOKEN as rotas ficam desabilitadas"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("x-admin-token", ""), admin_token):
+        raise HTTPException(status_code=403, detail="Token de administrador inválido")
+
+@app.get("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(request: Request, seconds: float = 10, interval_ms: float = 5):
+    """
+    Amostra as pilhas de todas as threads deste worker por `seconds` segundos
+
+    Retorna pilhas colapsadas (uma por linha, "thread;raiz;...;folha contagem"),
+    compatíveis com flamegraph.pl e speedscope. Com vários workers, o perfil
+    é do processo que atendeu a requisição.
+    """
+    require_admin(request)
+    try:
+        result = await asyncio.to_thread(profile, seconds, interval_ms / 1000)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    logger.info("Perfil coletado: %d amostras em %.1fs", result.sample_count, result.elapsed)
+    return PlainTextResponse(
+        result.collapsed(),
+        headers={
+            "X-Profile-Samples": str(result.sample_count),
+            "X-Profile-Seconds": f"{result.elapsed:.3f}",
+        },
+    )
+
+@app.get("/admin/memory")
+async def admin_memory(request: Request, refresh: bool = False):
+    """Memória aproximada por estrutura, memória do processo e estado do tracemalloc"""
+    require_admin(request)
+    structures = memory_accountant.structures(refresh=refresh)
+    return {
+        "process": process_memory(),
+        "structures": structures,
+        "structures_total_bytes": sum(stats["bytes"] for stats in structures.values()),
+        "tracemalloc": memory_accountant.tracemalloc_status()
+    }
+
+@app.post("/admin/memory/snapshot")
+async def admin_memory_snapshot(request: Request, key_type: str = "lineno", limit: int = 25, frames: int = 1):
+    """
+    Tira um snapshot do tracemalloc e o compara com o anterior
+
+    A primeira chamada inicia o tracemalloc (com `frames` quadros por
+    alocação) e serve de baseline; as seguintes trazem o diff. O rastreamento
+    tem custo de CPU e memória enquanto ativo: encerre com DELETE.
+    """
+    require_admin(request)
+    try:
+        return await asyncio.to_thread(memory_accountant.snapshot, key_type, limit, frames)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/admin/memory/snapshot")
+async def admin_memory_stop(request: Request):
+    """Encerra o tracemalloc e descarta a baseline"""
+    require_admin(request)
+    memory_accountant.stop()
+    return {"tracing": False}
+
+@app.get("/admin/rides")
+async def admin_rides(
+    request: Request,
+    status: Optional[RideStatus] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    driver_id: Optional[str] = None,
+    enterprise_id: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0,
+    include_metrics: bool = False
+):
+    """
+    Varre todas as corridas com filtros de status, período de criação e usuário
+
+    Retorna o total, a contagem por status no período e uma página das
+    corridas mais recentes. Com RIDE_COLUMNAR_STORE=true a varredura é
+    vetorizada sobre colunas; caso contrário percorre os registros.
+    """
+    require_admin(request)
+    if not 0 <= limit <= 1000 or offset < 0:
+        raise HTTPException(status_code=400, detail="limit deve estar entre 0 e 1000 e offset não pode ser negativo")
+    
+    start = time.perf_counter()
+    result = await user_service.scan_rides(status, created_from, created_to, driver_id, enterprise_id, limit, offset)
+    return {
+        "total": result["total"],
+        "by_status": result["by_status"],
+        "ride_requests": ride_dicts(result["ride_requests"], include_metrics),
+        "columnar": user_service.columns is not None,
+        "scan_ms": round((time.perf_counter() - start) * 1000, 3)
+    }
+
+@app.post("/admin/dispatch/run")
+async def admin_dispatch_run(request: Request):
+    """Executa um lote do despacho automático agora, sem esperar o intervalo"""
+    require_admin(request)
+    require_dispatcher()
+    return await dispatcher.run_once()
+
+@app.get("/admin/dispatch")
+async def admin_dispatch(request: Request):
+    """Tamanho da fila e resultado do último lote do despacho automático"""
+    require_admin(request)
+    require_dispatcher()
+    return {"pending": len(dispatcher), "last_run": dispatcher.last_run}
+
+@app.get("/ready")
+async def readiness():
+    """API pronta para servir; a camada Stellar é reportada à parte"""
+    return {
+        "api": "ready",
+        "chain": stellar_service.chain_status,
+        "chain_error": stellar_service.chain_error,
+        "startup": startup_timer.report()
+    }
+
+@app.get("/ready/chain")
+async def chain_readiness():
+    """200 apenas quando a camada Stellar está pronta (SDK carregado e, no modo rpc, conta conectada)"""
+    ready = stellar_service.chain_status == "ready"
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"chain": stellar_service.chain_status, "chain_error": stellar_service.chain_error}
+    )
+
 @app.get("/health")
-async def health_check():
-    """Verifica a saúde da API e conexão com Stellar"""
+async def health_check(deep: bool = False):
+    """
+    Verifica a saúde da API e conexão com Stellar
+
+    Por padrão responde do estado mantido pelo ledger watcher, sem I/O;
+    com deep=true consulta o Horizon na hora (e atualiza esse estado).
+    """
     try:
-        stellar_status = await stellar_service.check_connection()
+        if ledger_watcher is None:
+            stellar_status = await stellar_service.check_connection()
+        elif deep:
+            await ledger_watcher.refresh()
+            stellar_status = ledger_watcher.snapshot()
+        else:
+            stellar_status = ledger_watcher.snapshot()
         return {
             "status": "healthy",
             "stellar_network": stellar_status.get("network"),
             "stellar_connected": stellar_status.get("connected", False),
+            "stellar_latest_ledger": stellar_status.get("latest_ledger"),
+            "stellar_checked_at": stellar_status.get("checked_at"),
+            "stellar_status_age_seconds": stellar_status.get("age_seconds"),
+            "stellar_status_stale": stellar_status.get("stale"),
             "users_count": len(user_service.users),
-            "ride_requests_count": len(user_service.ride_requests)
+            "ride_requests_count": len(user_service.ride_requests),
+            "contract_lookups": stellar_service.lookups.stats()
         }
     except Exception as e:
         return JSONResponse(
@@ -570,10 +1161,20 @@ async def health_check():
         )
 
 if __name__ == "__main__":
+    import uvicorn
+    
     port = int(os.getenv("PORT", 3000))
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    
+    # Cada worker tem seu próprio espelho em memória; sem backend compartilhado
+    # eles dariam respostas diferentes para as mesmas corridas
+    if workers > 1 and not os.getenv("STATE_BACKEND_URL"):
+        raise SystemExit("WEB_CONCURRENCY > 1 requer STATE_BACKEND_URL (ex: sqlite:///./sentra_state.db)")
+    
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
-        reload=os.getenv("ENVIRONMENT") == "development"
+        workers=workers,
+        reload=os.getenv("ENVIRONMENT") == "development" and workers == 1
     )
\ No newline at end of file
@@ -0,0 +1,211 @@
+import enum
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional
+
+# Objetos compartilhados entre instâncias não entram na conta de cada uma
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, enum.Enum)
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """Tamanho aproximado de um objeto e de tudo que ele referencia exclusivamente
+
+    Percorre containers, __dict__ e __slots__ (inclui modelos Pydantic).
+    Objetos já vistos em `seen` não são contados de novo.
+    """
+    if seen is None:
+        seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        current = stack.pop()
+        if current is None or isinstance(current, (bool, _SHARED_TYPES)) or id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif isinstance(current, (str, bytes, int, float)):
+            continue
+
+        instance_dict = getattr(current, "__dict__", None)
+        if isinstance(instance_dict, dict):
+            stack.append(instance_dict)
+        for cls in type(current).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                if slot not in ("__dict__", "__weakref__"):
+                    value = getattr(current, slot, None)
+                    if value is not None:
+                        stack.append(value)
+    return total
+
+
+def estimate_entries(entries: Iterable[tuple], count: int, container_bytes: int, sample: int = 200) -> Dict[str, Any]:
+    """Estima a memória de `count` entradas a partir das primeiras `sample`
+
+    Cada entrada é uma tupla com os objetos que ela mantém (ex: chave e
+    valor de um dict). A amostragem mantém o custo por coleta constante
+    mesmo com milhões de entradas; as entradas de uma mesma estrutura têm
+    formato homogêneo. Objetos compartilhados entre estruturas (ex: IDs
+    usados como chave e como índice) são contados em cada uma.
+    """
+    sampled = list(islice(entries, sample))
+    total = 0
+    for entry in sampled:
+        seen: set = set()
+        total += sum(deep_sizeof(part, seen) for part in entry)
+    per_entry = total / len(sampled) if sampled else 0.0
+    return {
+        "entries": count,
+        "bytes_per_entry": round(per_entry, 1),
+        "bytes": int(container_bytes + per_entry * count),
+        "sampled": len(sampled),
+    }
+
+
+def _flatten(lists: Iterable[List[Any]]) -> Iterable[tuple]:
+    for items in lists:
+        for item in items:
+            yield (item,)
+
+
+def structure_report(user_service, stellar_service, sample: int = 200) -> Dict[str, Dict[str, Any]]:
+    """Memória aproximada de cada estrutura do UserService e do StellarContractService"""
+    notifications = user_service.notifications
+    report = {
+        "users": estimate_entries(user_service.users.items(), len(user_service.users),
+                                  sys.getsizeof(user_service.users), sample),
+        "ride_requests": estimate_entries(user_service.ride_requests.items(), len(user_service.ride_requests),
+                                          sys.getsizeof(user_service.ride_requests), sample),
+        "notifications": estimate_entries(_flatten(notifications.values()), sum(len(items) for items in notifications.values()),
+                                          sys.getsizeof(notifications) + sum(sys.getsizeof(items) for items in notifications.values()),
+                                          sample),
+        "index_rides_by_user": estimate_entries(user_service._ride_ids_by_user.items(), len(user_service._ride_ids_by_user),
+                                                sys.getsizeof(user_service._ride_ids_by_user), sample),
+        "index_active_ride_by_driver": estimate_entries(user_service._active_ride_by_driver.items(),
+                                                        len(user_service._active_ride_by_driver),
+                                                        sys.getsizeof(user_service._active_ride_by_driver), sample),
+        "contracts_data": estimate_entries(stellar_service.contracts_data.items(), len(stellar_service.contracts_data),
+                                           sys.getsizeof(stellar_service.contracts_data), sample),
+    }
+    columns = user_service.columns
+    if columns is not None:
+        # Arrays numpy (capacidade alocada); a lista de IDs aponta para as chaves de ride_requests
+        report["ride_columns"] = {
+            "entries": columns.size,
+            "bytes_per_entry": round(columns.memory_bytes() / len(columns.status), 1),
+            "bytes": columns.memory_bytes() + sys.getsizeof(columns.ride_ids) + sys.getsizeof(columns._row_by_id),
+            "sampled": columns.size,
+        }
+    return report
+
+
+def process_memory() -> Dict[str, Optional[int]]:
+    """RSS atual (Linux, /proc) e pico de RSS do processo"""
+    rss = None
+    try:
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = None
+    try:
+        import resource
+        # ru_maxrss é KiB no Linux e bytes no macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    return {"rss_bytes": rss, "peak_rss_bytes": peak}
+
+
+class MemoryAccountant:
+    """Relatório de memória com cache e snapshots do tracemalloc sob demanda
+
+    O relatório por estrutura é recalculado no máximo a cada `ttl` segundos,
+    para que coletas frequentes de métricas não custem uma varredura cada.
+    """
+
+    def __init__(self, user_service, stellar_service, ttl: float = 30.0, sample: int = 200):
+        self.user_service = user_service
+        self.stellar_service = stellar_service
+        self.ttl = ttl
+        self.sample = sample
+        self._report: Optional[Dict[str, Dict[str, Any]]] = None
+        self._report_at = 0.0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_lock = threading.Lock()
+
+    def structures(self, refresh: bool = False) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        if refresh or self._report is None or now - self._report_at > self.ttl:
+            self._report = structure_report(self.user_service, self.stellar_service, self.sample)
+            self._report_at = now
+        return self._report
+
+    def tracemalloc_status(self) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            return {"tracing": False}
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing": True,
+            "frames": tracemalloc.get_traceback_limit(),
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "has_baseline": self._snapshot is not None,
+        }
+
+    def snapshot(self, key_type: str = "lineno", limit: int = 25, frames: int = 1) -> Dict[str, Any]:
+        """Tira um snapshot e compara com o anterior (que passa a ser este)
+
+        Na primeira chamada inicia o tracemalloc: só alocações feitas a
+        partir daí são rastreadas, então o primeiro snapshot é a baseline.
+        Bloqueante; chame fora do event loop.
+        """
+        if key_type not in ("lineno", "filename", "traceback"):
+            raise ValueError("key_type deve ser lineno, filename ou traceback")
+        with self._snapshot_lock:
+            started = False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(max(1, frames))
+                started = True
+
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            ))
+            previous, self._snapshot = self._snapshot, snapshot
+
+            result: Dict[str, Any] = {"started_tracing": started, **self.tracemalloc_status()}
+            result["top"] = [_format_stat(stat) for stat in snapshot.statistics(key_type)[:limit]]
+            if previous is not None:
+                result["diff"] = [_format_stat(stat) for stat in snapshot.compare_to(previous, key_type)[:limit]]
+            return result
+
+    def stop(self):
+        with self._snapshot_lock:
+            self._snapshot = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+def _format_stat(stat) -> Dict[str, Any]:
+    entry = {
+        "location": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+        "size_bytes": stat.size,
+        "count": stat.count,
+    }
+    if hasattr(stat, "size_diff"):
+        entry["size_diff_bytes"] = stat.size_diff
+        entry["count_diff"] = stat.count_diff
+    return entry
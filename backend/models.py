@@ -1,7 +1,8 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
 from typing import List, Optional, Any, Dict
 from datetime import datetime
 from enum import Enum
+from geo import parse_route
 
 class UserRole(str, Enum):
     DRIVER = "driver"
@@ -16,6 +17,11 @@ class RideStatus(str, Enum):
     FINALIZADO = "Finalizado"
     CANCELADO = "Cancelado"
 
+class DispatchStatus(str, Enum):
+    AGUARDANDO = "Aguardando"
+    ATRIBUIDO = "Atribuido"
+    EXPIRADO = "Expirado"
+
 class User(BaseModel):
     """Modelo para usuários do sistema"""
     id: str = Field(..., description="ID único do usuário")
@@ -49,6 +55,7 @@ class RideRequest(BaseModel):
     started_at: Optional[datetime] = Field(None, description="Data de início")
     finished_at: Optional[datetime] = Field(None, description="Data de finalização")
     rejection_reason: Optional[str] = Field(None, description="Motivo da rejeição")
+    version: int = Field(default=1, description="Versão, incrementada a cada transição de status")
     
     class Config:
         json_schema_extra = {
@@ -77,6 +84,17 @@ class TripData(BaseModel):
     destination_address: Optional[str] = Field(None, description="Endereço de destino")
     estimated_duration: Optional[int] = Field(None, description="Duração estimada em minutos")
     
+    # Rota parseada na validação (geo.parse_route), reaproveitada pelo UserService
+    _coordinates: Any = PrivateAttr(default=None)
+    
+    @model_validator(mode="after")
+    def parse_route_points(self) -> "TripData":
+        # Rota vazia ou coordenada fora da faixa viram erro de validação (422 na API)
+        if not self.route:
+            raise ValueError("A rota deve ter ao menos um ponto")
+        self._coordinates = parse_route(self.route)
+        return self
+    
     class Config:
         json_schema_extra = {
             "example": {
@@ -118,11 +136,13 @@ class ContractResponse(BaseModel):
 class RideAcceptRequest(BaseModel):
     """Modelo para aceite de corrida"""
     driver_id: str = Field(..., description="ID do motorista que está aceitando")
+    version: Optional[int] = Field(None, description="Versão da corrida vista pelo cliente; se já mudou, 409")
     
 class RideRejectRequest(BaseModel):
     """Modelo para rejeição de corrida"""
     driver_id: str = Field(..., description="ID do motorista que está rejeitando")
     reason: Optional[str] = Field(None, description="Motivo da rejeição")
+    version: Optional[int] = Field(None, description="Versão da corrida vista pelo cliente; se já mudou, 409")
 
 class NotificationData(BaseModel):
     """Modelo para notificações"""
@@ -173,6 +193,25 @@ class CreateRideRequestBody(BaseModel):
     
 class StartRideRequest(BaseModel):
     enterprise_id: str
+    version: Optional[int] = Field(None, description="Versão da corrida vista pelo cliente; se já mudou, 409")
+
+class DriverLocationUpdate(BaseModel):
+    """Ping de posição enviado pelo app do motorista"""
+    lat: float = Field(..., ge=-90, le=90, description="Latitude")
+    lng: float = Field(..., ge=-180, le=180, description="Longitude")
+    recorded_at: Optional[datetime] = Field(None, description="Momento da leitura no dispositivo (padrão: recebimento)")
+
+class DriverPing(DriverLocationUpdate):
+    driver_id: str = Field(..., description="ID do motorista")
+
+class DriverLocationBatch(BaseModel):
+    """Pings de vários motoristas (ex: gateway de telemetria), processados em ordem"""
+    pings: List[DriverPing] = Field(..., max_length=1000, description="Até 1000 pings")
+
+class DispatchRequestBody(BaseModel):
+    """Corrida sem motorista definido; o despacho automático escolhe um"""
+    enterprise_id: str = Field(..., description="ID da empresa solicitante")
+    trip_data: TripData = Field(..., description="Dados da viagem (o primeiro ponto da rota é a coleta, em 'lat,lng')")
 
 # Fix forward reference
 RideRequest.model_rebuild()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+# Uma única execução por processo; perfis concorrentes dobrariam o overhead
+_running = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    """Já existe uma execução do profiler em andamento"""
+
+
+def _frame_label(code, cache: Dict) -> str:
+    label = cache.get(code)
+    if label is None:
+        parts = code.co_filename.replace("\\", "/").rsplit("/", 2)
+        filename = "/".join(parts[-2:])
+        label = cache[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    return label
+
+
+class SamplingProfiler:
+    """Profiler por amostragem de todas as threads do processo
+
+    Uma thread própria lê sys._current_frames() a cada intervalo e conta as
+    pilhas (thread;raiz;...;folha). Nada é instrumentado nas threads
+    amostradas, então o custo fica restrito à thread do profiler e ao
+    tempo em que ela segura o GIL, proporcional a threads x profundidade.
+    Como a amostra só é tirada quando o profiler obtém o GIL, threads
+    ocupadas com código Python aparecem nos pontos em que liberam o GIL.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.elapsed = 0.0
+        self._labels: Dict = {}
+
+    def run(self, seconds: float) -> "SamplingProfiler":
+        """Amostra por `seconds` segundos na thread atual (bloqueante)"""
+        if not _running.acquire(blocking=False):
+            raise ProfilerBusyError("Profiler já está em execução")
+        try:
+            self._sample_for(seconds)
+        finally:
+            _running.release()
+        return self
+
+    def _sample_for(self, seconds: float):
+        own_ident = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_tick = start
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_label(frame.f_code, self._labels))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+            next_tick += self.interval
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            # Atrasos (ex: GIL disputado) não acumulam rajadas de amostras
+            if next_tick < now:
+                next_tick = now
+            time.sleep(min(next_tick, deadline) - now)
+        self.elapsed = time.perf_counter() - start
+
+    def collapsed(self) -> str:
+        """Perfil no formato de pilhas colapsadas (flamegraph.pl, speedscope)"""
+        lines = [f"{stack} {count}" for stack, count in self.samples.most_common()]
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def profile(seconds: float, interval: Optional[float] = None) -> SamplingProfiler:
+    """Executa o profiler com os limites configurados por ambiente
+
+    PROFILER_MAX_SECONDS (60) limita a duração e PROFILER_MIN_INTERVAL_MS
+    (1) o intervalo mínimo entre amostras.
+    """
+    max_seconds = float(os.getenv("PROFILER_MAX_SECONDS", 60))
+    min_interval = float(os.getenv("PROFILER_MIN_INTERVAL_MS", 1)) / 1000
+    if not 0 < seconds <= max_seconds:
+        raise ValueError(f"Duração deve estar entre 0 e {max_seconds:g} segundos")
+    interval = max(min_interval, interval if interval is not None else 0.005)
+    return SamplingProfiler(interval).run(seconds)
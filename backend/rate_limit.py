@@ -0,0 +1,293 @@
+import ipaddress
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from state_backend import StateBackend
+from metrics import REGISTRY
+import logging
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = REGISTRY.counter("rate_limited_requests_total", "Requisições rejeitadas pelo rate limiting", ("rule",))
+
+FORWARDED_FOR_HEADER = b"x-forwarded-for"
+
+# Corpo lido para extrair o usuário; corpos maiores caem no IP do cliente
+MAX_IDENTITY_BODY_BYTES = 64 * 1024
+
+
+class RateLimitRule:
+    """Limite aplicado a um método + padrão de rota
+
+    Cada usuário tem seu próprio bucket por regra (burst / refill_per_second)
+    e, opcionalmente, a rota tem um bucket global somando todos os usuários.
+    Regras com o mesmo nome compartilham os buckets.
+
+    O usuário é o IP do cliente, combinado com o ID que a requisição
+    declara afetar: o grupo `actor` do padrão (ID na rota) ou o campo
+    `body_field` do corpo JSON (ex: enterprise_id). O ID vem do cliente,
+    então não basta sozinho: combinado ao IP, ninguém esgota o bucket de
+    outro cliente, e o bucket do IP (ip_burst / ip_refill_per_second),
+    somando todos os IDs, impede que um ID novo a cada requisição
+    contorne o limite.
+    """
+
+    __slots__ = ("name", "method", "pattern", "burst", "refill_per_second", "route_burst", "route_refill_per_second",
+                 "body_field", "ip_burst", "ip_refill_per_second")
+
+    def __init__(self, name: str, method: str, pattern: str, burst: float, refill_per_second: float,
+                 route_burst: Optional[float] = None, route_refill_per_second: Optional[float] = None,
+                 body_field: Optional[str] = None, ip_burst: Optional[float] = None,
+                 ip_refill_per_second: Optional[float] = None):
+        self.name = name
+        self.method = method
+        self.pattern = re.compile(pattern)
+        self.burst = burst
+        self.refill_per_second = refill_per_second
+        self.route_burst = route_burst
+        self.route_refill_per_second = route_refill_per_second
+        self.body_field = body_field
+        self.ip_burst = ip_burst if ip_burst is not None else burst
+        self.ip_refill_per_second = ip_refill_per_second if ip_refill_per_second is not None else refill_per_second
+
+
+def default_rules() -> List[RateLimitRule]:
+    """Regras padrão para as rotas que geram taxas na blockchain"""
+    burst = float(os.getenv("RATE_LIMIT_BURST", 10))
+    refill = float(os.getenv("RATE_LIMIT_REFILL_PER_SECOND", 1))
+    # Bucket global da rota ligado por padrão: teto das taxas pagas, quaisquer que sejam os clientes
+    route_burst = float(os.getenv("RATE_LIMIT_ROUTE_BURST", 100))
+    route_refill = float(os.getenv("RATE_LIMIT_ROUTE_REFILL_PER_SECOND", 20))
+    route = (route_burst, route_refill) if route_burst > 0 else (None, None)
+    ip_burst = float(os.getenv("RATE_LIMIT_IP_BURST", 30))
+    ip_refill = float(os.getenv("RATE_LIMIT_IP_REFILL_PER_SECOND", 3))
+
+    limits = dict(burst=burst, refill_per_second=refill, route_burst=route[0], route_refill_per_second=route[1],
+                  ip_burst=ip_burst, ip_refill_per_second=ip_refill)
+    return [
+        RateLimitRule("ride_requests", "POST", r"^/api/ride-requests(/[^/]+/start)?$", body_field="enterprise_id", **limits),
+        RateLimitRule("contract_writes", "POST", r"^/contract/create$", body_field="driver", **limits),
+        RateLimitRule("contract_writes", "POST", r"^/contract/manage$", body_field="trip_id", **limits),
+        RateLimitRule("contract_writes", "POST", r"^/contract/(?P<actor>[^/]+)/(saida|meio|chegada)$", **limits),
+        RateLimitRule("contract_writes", "POST", r"^/contract/", **limits),
+    ]
+
+
+def trusted_proxies() -> List[Any]:
+    """Redes de RATE_LIMIT_TRUSTED_PROXIES (ex: "127.0.0.1,10.0.0.0/8")"""
+    value = os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "")
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
+
+class TokenBucketStore:
+    """Buckets em memória com limite de entradas e remoção de buckets ociosos
+
+    Um bucket que ficou ocioso tempo suficiente para encher novamente é
+    equivalente a um bucket inexistente, então pode ser descartado. As
+    entradas ficam em ordem de último acesso, o que torna a varredura de
+    ociosos proporcional apenas ao que é removido.
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        # chave -> [tokens, último acesso, instante em que estará cheio]
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, burst: float, refill_per_second: float, now: float) -> float:
+        """Consome um token; retorna 0 se permitido ou os segundos até o próximo token"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = burst
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * refill_per_second)
+            self._buckets.move_to_end(key)
+
+        if tokens < 1:
+            retry_after = (1 - tokens) / refill_per_second
+        else:
+            tokens -= 1
+            retry_after = 0.0
+
+        full_at = now + (burst - tokens) / refill_per_second
+        if bucket is None:
+            self._buckets[key] = [tokens, now, full_at]
+        else:
+            bucket[0], bucket[1], bucket[2] = tokens, now, full_at
+
+        self._evict(now)
+        return retry_after
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket[2] > now and len(buckets) <= self.max_entries:
+                break
+            buckets.popitem(last=False)
+
+
+class SharedTokenBucketStore:
+    """Buckets no backend compartilhado, consistentes entre workers
+
+    Cada consumo é uma transação no backend, portanto bem mais lento que
+    o TokenBucketStore local; use apenas quando o limite precisa ser
+    exato com vários workers.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+
+    def take(self, key: str, burst: float, refill_per_second: float, now: float) -> float:
+        retry_after = 0.0
+
+        def consume(bucket):
+            nonlocal retry_after
+            tokens = burst if bucket is None else min(burst, bucket["tokens"] + (now - bucket["at"]) * refill_per_second)
+            if tokens < 1:
+                retry_after = (1 - tokens) / refill_per_second
+            else:
+                tokens -= 1
+            return {"tokens": tokens, "at": now}
+
+        # Depois de burst / refill segundos sem uso o bucket estaria cheio, o que
+        # equivale a não existir: a linha expira e a compactação do backend a remove
+        self.backend.update("rate_limits", key, consume, ttl=burst / refill_per_second + 1.0)
+        return retry_after
+
+
+class RateLimitMiddleware:
+    """Middleware ASGI de rate limiting por usuário e por rota (token bucket)
+
+    O usuário é o IP do cliente combinado com o ID declarado na rota ou no
+    corpo (ver RateLimitRule), e o IP tem ainda um bucket próprio. Atrás de proxies
+    listados em RATE_LIMIT_TRUSTED_PROXIES o IP é o do X-Forwarded-For,
+    lido da direita para a esquerda até o primeiro endereço não confiável;
+    o header de clientes fora dessa lista é ignorado. Requisições acima do
+    limite recebem 429 com Retry-After.
+    """
+
+    def __init__(self, app, rules: Optional[List[RateLimitRule]] = None, store=None, proxies: Optional[List[Any]] = None):
+        self.app = app
+        self.rules = rules if rules is not None else default_rules()
+        self.store = store if store is not None else TokenBucketStore(int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 100000)))
+        self.proxies = proxies if proxies is not None else trusted_proxies()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        matched = self._match(scope["method"], scope["path"])
+        if matched is None:
+            await self.app(scope, receive, send)
+            return
+        rule, match = matched
+
+        declared = None
+        if "actor" in rule.pattern.groupindex:
+            declared = f"actor={match.group('actor')}"
+        elif rule.body_field:
+            body, receive = await self._buffer(receive)
+            value = self._body_value(body, rule.body_field)
+            if value is not None:
+                declared = f"{rule.body_field}={value}"
+        client = f"ip={self._client_ip(scope)}"
+
+        now = self.store.clock()
+        if declared is None:
+            retry_after = self.store.take(f"{rule.name}:{client}", rule.burst, rule.refill_per_second, now)
+        else:
+            retry_after = self.store.take(f"{rule.name}:{client}:{declared}", rule.burst, rule.refill_per_second, now)
+            if not retry_after:
+                retry_after = self.store.take(f"{rule.name}:{client}", rule.ip_burst, rule.ip_refill_per_second, now)
+        if not retry_after and rule.route_burst:
+            retry_after = self.store.take(f"{rule.name}:*", rule.route_burst, rule.route_refill_per_second, now)
+
+        if retry_after:
+            RATE_LIMITED.inc(rule.name)
+            await self._reject(send, retry_after)
+            return
+
+        await self.app(scope, receive, send)
+
+    def _match(self, method: str, path: str) -> Optional[Tuple[RateLimitRule, Any]]:
+        for rule in self.rules:
+            if rule.method == method:
+                match = rule.pattern.match(path)
+                if match:
+                    return rule, match
+        return None
+
+    async def _buffer(self, receive) -> Tuple[bytes, Any]:
+        """Lê o corpo (até MAX_IDENTITY_BODY_BYTES) e devolve um receive que o reproduz"""
+        messages: List[Dict[str, Any]] = []
+        size = 0
+        while size <= MAX_IDENTITY_BODY_BYTES:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            size += len(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        complete = messages and messages[-1]["type"] == "http.request" and not messages[-1].get("more_body", False)
+        body = b"".join(message.get("body", b"") for message in messages) if complete else b""
+
+        async def replay_receive():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        return body, replay_receive
+
+    @staticmethod
+    def _body_value(body: bytes, field: str) -> Optional[str]:
+        try:
+            value = json.loads(body).get(field) if body else None
+        except (ValueError, AttributeError):
+            return None
+        return value if isinstance(value, str) and value else None
+
+    def _client_ip(self, scope) -> str:
+        client = scope.get("client")
+        address = client[0] if client else "anonymous"
+        if not self.proxies or not self._trusted(address):
+            return address
+        for name, value in scope["headers"]:
+            if name == FORWARDED_FOR_HEADER:
+                for hop in reversed([item.strip() for item in value.decode("latin-1").split(",")]):
+                    address = hop
+                    if not self._trusted(hop):
+                        break
+                break
+        return address
+
+    def _trusted(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.proxies)
+
+    async def _reject(self, send, retry_after: float):
+        body = json.dumps({"detail": "Limite de requisições excedido. Tente novamente em instantes."}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, int(retry_after + 0.999))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
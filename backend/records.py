@@ -0,0 +1,183 @@
+import sys
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from geo import parse_route
+from models import RideRequest, RideStatus, TripData, NotificationData
+
+# Datas ficam como microssegundos desde a época (UTC, sem fuso) e voltam
+# para datetime só quando o registro vira modelo da API
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(value: Optional[datetime]) -> Optional[int]:
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def from_micros(value: Optional[int]) -> Optional[datetime]:
+    return None if value is None else _EPOCH + timedelta(microseconds=value)
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # IDs de usuário e tipos se repetem em milhares de registros: uma cópia só
+    return None if value is None else sys.intern(value)
+
+
+class TripRecord:
+    """Dados da viagem armazenados internamente (ver models.TripData)
+
+    `route` mantém os pontos como recebidos pela API; `coordinates` é a
+    mesma rota já parseada (geo.parse_route), que é o que os recursos de
+    geometria leem.
+    """
+
+    __slots__ = ("trip_id", "driver", "route", "coordinates", "saida_checkpoint", "meio_checkpoint",
+                 "chegada_checkpoint", "origin_address", "destination_address", "estimated_duration")
+
+    def __init__(self, trip_id: str, driver: str, route: Tuple[str, ...],
+                 saida_checkpoint: Optional[str] = None, meio_checkpoint: Optional[str] = None,
+                 chegada_checkpoint: Optional[str] = None, origin_address: Optional[str] = None,
+                 destination_address: Optional[str] = None, estimated_duration: Optional[int] = None,
+                 coordinates: Optional[array] = None):
+        self.trip_id = trip_id
+        self.driver = _intern(driver)
+        self.route = tuple(route)
+        self.coordinates = coordinates if coordinates is not None else parse_route(self.route)
+        self.saida_checkpoint = _intern(saida_checkpoint)
+        self.meio_checkpoint = _intern(meio_checkpoint)
+        self.chegada_checkpoint = _intern(chegada_checkpoint)
+        self.origin_address = origin_address
+        self.destination_address = destination_address
+        self.estimated_duration = estimated_duration
+
+    @classmethod
+    def from_model(cls, trip: TripData) -> "TripRecord":
+        # A validação do TripData já parseou a rota; model_construct não passa por ela
+        return cls(trip.trip_id, trip.driver, trip.route, trip.saida_checkpoint, trip.meio_checkpoint,
+                   trip.chegada_checkpoint, trip.origin_address, trip.destination_address, trip.estimated_duration,
+                   trip._coordinates)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Mesmo conteúdo de TripData.model_dump(), sem criar o modelo"""
+        return {
+            "trip_id": self.trip_id,
+            "driver": self.driver,
+            "route": list(self.route),
+            "saida_checkpoint": self.saida_checkpoint,
+            "meio_checkpoint": self.meio_checkpoint,
+            "chegada_checkpoint": self.chegada_checkpoint,
+            "origin_address": self.origin_address,
+            "destination_address": self.destination_address,
+            "estimated_duration": self.estimated_duration,
+        }
+
+    def to_model(self) -> TripData:
+        # Os dados já foram validados na entrada; model_construct evita revalidar
+        return TripData.model_construct(**self.to_dict())
+
+
+class RideRecord:
+    """Corrida armazenada pelo UserService
+
+    Representação compacta de models.RideRequest: slots em vez de
+    __dict__, status como membro do enum (compartilhado), IDs de usuário
+    internados e datas como inteiros. Os modelos Pydantic só são criados
+    quando a corrida entra pela API ou é replicada (from_model); nas
+    respostas, to_dict() gera direto o dicionário que o modelo produziria.
+    """
+
+    __slots__ = ("id", "enterprise_id", "driver_id", "trip", "status", "created_at", "accepted_at",
+                 "rejected_at", "started_at", "finished_at", "rejection_reason", "version")
+
+    def __init__(self, id: str, enterprise_id: str, driver_id: str, trip: TripRecord,
+                 status: RideStatus = RideStatus.PENDENTE, created_at: Optional[int] = None,
+                 accepted_at: Optional[int] = None, rejected_at: Optional[int] = None,
+                 started_at: Optional[int] = None, finished_at: Optional[int] = None,
+                 rejection_reason: Optional[str] = None, version: int = 1):
+        self.id = id
+        self.enterprise_id = _intern(enterprise_id)
+        self.driver_id = _intern(driver_id)
+        self.trip = trip
+        self.status = RideStatus(status)
+        self.created_at = created_at if created_at is not None else to_micros(datetime.utcnow())
+        self.accepted_at = accepted_at
+        self.rejected_at = rejected_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.rejection_reason = rejection_reason
+        self.version = version
+
+    @classmethod
+    def from_model(cls, ride: RideRequest) -> "RideRecord":
+        return cls(
+            ride.id, ride.enterprise_id, ride.driver_id, TripRecord.from_model(ride.trip_data), ride.status,
+            to_micros(ride.created_at), to_micros(ride.accepted_at), to_micros(ride.rejected_at),
+            to_micros(ride.started_at), to_micros(ride.finished_at), ride.rejection_reason, ride.version,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Mesmo conteúdo de RideRequest.model_dump(), sem criar o modelo"""
+        return {
+            "id": self.id,
+            "enterprise_id": self.enterprise_id,
+            "driver_id": self.driver_id,
+            "trip_data": self.trip.to_dict(),
+            "status": self.status,
+            "created_at": from_micros(self.created_at),
+            "accepted_at": from_micros(self.accepted_at),
+            "rejected_at": from_micros(self.rejected_at),
+            "started_at": from_micros(self.started_at),
+            "finished_at": from_micros(self.finished_at),
+            "rejection_reason": self.rejection_reason,
+            "version": self.version,
+        }
+
+    def to_model(self) -> RideRequest:
+        values = self.to_dict()
+        values["trip_data"] = self.trip.to_model()
+        return RideRequest.model_construct(**values)
+
+
+class NotificationRecord:
+    """Notificação armazenada pelo UserService (ver models.NotificationData)"""
+
+    __slots__ = ("id", "user_id", "type", "title", "message", "data", "read", "created_at")
+
+    def __init__(self, id: str, user_id: str, type: str, title: str, message: str,
+                 data: Optional[Dict[str, Any]] = None, read: bool = False, created_at: Optional[int] = None):
+        self.id = id
+        self.user_id = _intern(user_id)
+        # Tipo e título vêm de um conjunto fixo; a mensagem é única por notificação
+        self.type = _intern(type)
+        self.title = _intern(title)
+        self.message = message
+        # Dicionário vazio não é guardado (~64 bytes por notificação)
+        self.data = data or None
+        self.read = read
+        self.created_at = created_at if created_at is not None else to_micros(datetime.utcnow())
+
+    @classmethod
+    def from_model(cls, notification: NotificationData) -> "NotificationRecord":
+        return cls(notification.id, notification.user_id, notification.type, notification.title,
+                   notification.message, notification.data, notification.read, to_micros(notification.created_at))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Mesmo conteúdo de NotificationData.model_dump(), sem criar o modelo"""
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "type": self.type,
+            "title": self.title,
+            "message": self.message,
+            "data": dict(self.data) if self.data else {},
+            "read": self.read,
+            "created_at": from_micros(self.created_at),
+        }
+
+    def to_model(self) -> NotificationData:
+        return NotificationData.model_construct(**self.to_dict())
@@ -0,0 +1,166 @@
+import bisect
+import logging
+import os
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+from geo import haversine_km, haversine_km_array, route_coordinates
+
+logger = logging.getLogger(__name__)
+
+# Velocidade (km/h) por comprimento do trecho: trechos curtos são urbanos e lentos
+DEFAULT_SPEED_PROFILE = "1:15,5:30,20:50,80"
+
+
+def parse_speed_profile(text: str) -> Tuple[List[float], List[float]]:
+    """Converte "limite_km:kmh,...,kmh" em (limites, velocidades)
+
+    Cada par vale para trechos de até `limite_km`; o último valor, sem
+    limite, para os trechos mais longos.
+    """
+    limits: List[float] = []
+    speeds: List[float] = []
+    for part in text.split(","):
+        limit, _, speed = part.strip().rpartition(":")
+        if limit:
+            limits.append(float(limit))
+        speeds.append(float(speed))
+    if len(speeds) != len(limits) + 1 or any(speed <= 0 for speed in speeds) or limits != sorted(limits):
+        raise ValueError(f"Perfil de velocidade inválido: {text!r}")
+    return limits, speeds
+
+
+class RouteMetrics:
+    """Distância pelo grande círculo e tempo estimado de uma rota
+
+    `points` conta apenas os pontos com coordenadas; pontos em texto livre
+    ficam fora do cálculo (o trecho liga as coordenadas vizinhas).
+    """
+
+    __slots__ = ("distance_km", "eta_minutes", "points")
+
+    def __init__(self, distance_km: float, eta_minutes: float, points: int):
+        self.distance_km = distance_km
+        self.eta_minutes = eta_minutes
+        self.points = points
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "distance_km": round(self.distance_km, 3),
+            "eta_minutes": round(self.eta_minutes, 1),
+            "points": self.points,
+        }
+
+
+class RouteMetricsCalculator:
+    """Calcula RouteMetrics de várias rotas de uma vez, com cache por rota
+
+    As rotas do lote são concatenadas num único array de pontos: as
+    distâncias de todos os trechos saem de uma chamada vetorizada da
+    haversine, e as somas por rota de somas acumuladas. O tempo de cada
+    trecho usa a velocidade da faixa do perfil, sobre a distância
+    multiplicada por `detour` (rua não é linha reta).
+
+    O cache (LRU, `cache_size` rotas) usa como chave a rota como recebida;
+    rotas repetidas entre corridas são calculadas uma vez.
+    """
+
+    def __init__(self, speed_profile: str = DEFAULT_SPEED_PROFILE, detour: float = 1.3, cache_size: int = 10_000):
+        self.limits, self.speeds = parse_speed_profile(speed_profile)
+        self.detour = detour
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Hashable, RouteMetrics]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def metrics(self, routes: Sequence[Tuple[Hashable, array]]) -> List[RouteMetrics]:
+        """RouteMetrics de cada (chave, coordenadas) na ordem recebida
+
+        As coordenadas são o array plano de geo.parse_route
+        (TripRecord.coordinates); só as rotas fora do cache são calculadas.
+        """
+        results: List[Optional[RouteMetrics]] = []
+        missing: Dict[Hashable, List[int]] = {}
+        missing_routes: List[array] = []
+        for index, (key, coordinates) in enumerate(routes):
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            elif key in missing:
+                missing[key].append(index)
+            else:
+                missing[key] = [index]
+                missing_routes.append(coordinates)
+            results.append(cached)
+
+        if missing:
+            self.misses += len(missing)
+            for (key, indexes), computed in zip(missing.items(), self.compute(missing_routes)):
+                for index in indexes:
+                    results[index] = computed
+                self._cache[key] = computed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return results
+
+    def compute(self, routes: Sequence[array]) -> List[RouteMetrics]:
+        """RouteMetrics sem cache; vetorizado com numpy, laço simples sem ele"""
+        try:
+            import numpy as np
+        except ImportError:
+            return [self._compute_one(coordinates) for coordinates in routes]
+
+        # Todas as rotas num só array; cada ponto sabe a que rota pertence
+        raw = np.frombuffer(b"".join(routes), dtype=np.float64).reshape(-1, 2)
+        route_of_point = np.repeat(np.arange(len(routes)), [len(coordinates) // 2 for coordinates in routes])
+        located = ~np.isnan(raw[:, 0])
+        coords = raw[located]
+        counts = np.bincount(route_of_point[located], minlength=len(routes))
+        if len(coords) < 2:
+            return [RouteMetrics(0.0, 0.0, int(count)) for count in counts]
+
+        legs = haversine_km_array(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+        minutes = legs * self.detour / np.asarray(self.speeds)[np.searchsorted(self.limits, legs)] * 60
+        # O trecho i liga os pontos i e i+1; o que liga o fim de uma rota ao início da próxima não conta
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        boundaries = starts[1:][(starts[1:] > 0) & (starts[1:] < len(coords))] - 1
+        legs[boundaries] = 0.0
+        minutes[boundaries] = 0.0
+
+        # Soma dos trechos de cada rota: índices [início, início + pontos - 1)
+        # (rotas vazias no fim do lote começariam além do último ponto)
+        starts = np.minimum(starts, len(coords) - 1)
+        distance_sums = np.concatenate(([0.0], np.cumsum(legs)))
+        minute_sums = np.concatenate(([0.0], np.cumsum(minutes)))
+        ends = starts + np.maximum(counts - 1, 0)
+        distances = distance_sums[ends] - distance_sums[starts]
+        etas = minute_sums[ends] - minute_sums[starts]
+        return [
+            RouteMetrics(float(distance), float(eta), int(count))
+            for distance, eta, count in zip(distances.tolist(), etas.tolist(), counts.tolist())
+        ]
+
+    def _compute_one(self, coordinates: array) -> RouteMetrics:
+        points = list(route_coordinates(coordinates))
+        distance = eta = 0.0
+        for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+            leg = haversine_km(lat1, lng1, lat2, lng2)
+            distance += leg
+            eta += leg * self.detour / self.speeds[bisect.bisect_left(self.limits, leg)] * 60
+        return RouteMetrics(distance, eta, len(points))
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def create_route_metrics() -> RouteMetricsCalculator:
+    """Calculadora conforme ROUTE_SPEED_PROFILE, ROUTE_DETOUR_FACTOR e ROUTE_METRICS_CACHE_SIZE"""
+    return RouteMetricsCalculator(
+        speed_profile=os.getenv("ROUTE_SPEED_PROFILE", DEFAULT_SPEED_PROFILE),
+        detour=float(os.getenv("ROUTE_DETOUR_FACTOR", 1.3)),
+        cache_size=int(os.getenv("ROUTE_METRICS_CACHE_SIZE", 10_000)),
+    )
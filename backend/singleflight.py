@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Agrupa chamadas concorrentes idênticas em uma única execução
+
+    Enquanto uma chamada para uma chave está em andamento, as demais
+    aguardam o mesmo resultado em vez de executar novamente. A execução
+    roda em uma task própria, de modo que o cancelamento de um dos
+    chamadores (cliente desconectado) não afeta os outros.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.requests = 0
+        self.executions = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.requests += 1
+        task = self._calls.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Evita o aviso "exception was never retrieved" quando todos os
+        # chamadores foram cancelados
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas de agrupamento: coalescing_ratio = chamadas atendidas sem nova execução"""
+        coalesced = self.requests - self.executions
+        return {
+            "requests": self.requests,
+            "executions": self.executions,
+            "coalesced": coalesced,
+            "in_flight": len(self._calls),
+            "coalescing_ratio": coalesced / self.requests if self.requests else 0.0,
+        }
@@ -0,0 +1,42 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+
+class StartupTimer:
+    """Duração de cada fase da inicialização do processo
+
+    mark(fase) registra o tempo desde a marca anterior; record() guarda
+    fases medidas à parte (ex: warm-up em background).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "serving_after_seconds": round(self._last - self.started, 4),
+        }
+
+
+# Criado na importação: main.py importa este módulo antes de todos os outros
+startup_timer = StartupTimer()
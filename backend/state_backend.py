@@ -0,0 +1,279 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """Armazenamento chave/valor compartilhado entre processos (workers)
+
+    Cada escrita recebe um número de sequência global, o que permite que
+    cada worker mantenha um espelho local em memória e aplique apenas as
+    mudanças feitas pelos outros workers desde a última sincronização.
+
+    Escritas com `ttl` (segundos) expiram: depois disso a chave conta como
+    ausente (get, add, compare_and_put) e compact() apaga a linha. Remoções
+    viram tombstones com TTL, para que os outros workers as vejam no feed.
+    """
+
+    def get(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def put(self, namespace: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> int:
+        """Grava (ou substitui) um valor e retorna sua sequência"""
+        raise NotImplementedError
+
+    def add(self, namespace: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        """Grava um valor apenas se a chave ainda não existir (ou tiver expirado)"""
+        raise NotImplementedError
+
+    def update(self, namespace: str, key: str, fn: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]],
+               ttl: Optional[float] = None) -> Dict[str, Any]:
+        """Lê, transforma e grava um valor atomicamente entre processos"""
+        raise NotImplementedError
+
+    def compare_and_put(self, namespace: str, key: str, value: Dict[str, Any],
+                        check: Callable[[Optional[Dict[str, Any]]], bool], ttl: Optional[float] = None) -> Optional[int]:
+        """Grava apenas se `check(valor atual)` for verdadeiro, atomicamente entre processos
+
+        Retorna a sequência da escrita ou None se o valor atual não passou
+        no teste (ex: versão diferente da esperada).
+        """
+        raise NotImplementedError
+
+    def add_many(self, namespace: str, values: Dict[str, Dict[str, Any]], ttl: Optional[float] = None) -> List[str]:
+        """add() de várias chaves de uma vez; retorna as chaves gravadas"""
+        return [key for key, value in values.items() if self.add(namespace, key, value, ttl)]
+
+    def put_many(self, writes: List[Tuple[str, str, Optional[Dict[str, Any]]]]) -> List[int]:
+        """Grava (ou remove, com valor None) várias chaves; retorna as sequências na ordem"""
+        return [
+            self.put(namespace, key, value) if value is not None else self.delete(namespace, key)
+            for namespace, key, value in writes
+        ]
+
+    def delete(self, namespace: str, key: str) -> int:
+        raise NotImplementedError
+
+    def items(self, namespace: str) -> List[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def changes_since(self, cursor: int, namespaces: Iterable[str]) -> Tuple[int, List[Tuple[int, str, str, Optional[Dict[str, Any]]]]]:
+        """Retorna (novo_cursor, [(seq, namespace, chave, valor ou None se removido)])"""
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        """Apaga as linhas expiradas (incluindo tombstones) e retorna quantas"""
+        return 0
+
+    def close(self):
+        pass
+
+
+class SQLiteStateBackend(StateBackend):
+    """Backend compartilhado em um arquivo SQLite (modo WAL)
+
+    Adequado para N workers uvicorn na mesma máquina. Remoções são
+    gravadas como tombstones (valor NULL) que expiram após
+    `tombstone_ttl` segundos, tempo de sobra para todo worker sincronizar.
+
+    As chamadas rodam no event loop: leituras no WAL não esperam por
+    escritores e a espera por outro escritor é limitada a `busy_timeout`
+    segundos (sqlite3.OperationalError depois disso).
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 1.0, tombstone_ttl: float = 3600.0):
+        self.path = path
+        self.tombstone_ttl = tombstone_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                seq INTEGER NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS kv_seq ON kv (seq);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('seq', 0);
+            """
+        )
+        # Arquivos criados antes da coluna de expiração
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(kv)")]
+        if "expires_at" not in columns:
+            self._conn.execute("ALTER TABLE kv ADD COLUMN expires_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at) WHERE expires_at IS NOT NULL")
+        logger.info(f"State backend SQLite em {path}")
+
+    def _next_seq(self) -> int:
+        return self._conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'seq' RETURNING value").fetchone()[0]
+
+    def _current(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        # Valor vigente (nem removido nem expirado), dentro da transação aberta
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None or row[0] is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _write(self, namespace: str, key: str, encoded: Optional[str], ttl: Optional[float]) -> int:
+        seq = self._next_seq()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, seq, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, encoded, seq, time.time() + ttl if ttl is not None else None),
+        )
+        return seq
+
+    def _delete(self, namespace: str, key: str) -> int:
+        seq = self._next_seq()
+        self._conn.execute(
+            "UPDATE kv SET value = NULL, seq = ?, expires_at = ? WHERE namespace = ? AND key = ?",
+            (seq, time.time() + self.tombstone_ttl, namespace, key),
+        )
+        return seq
+
+    def _transaction(self, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def get(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._current(namespace, key)
+
+    def put(self, namespace: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> int:
+        encoded = json.dumps(value, default=str)
+        return self._transaction(lambda: self._write(namespace, key, encoded, ttl))
+
+    def add(self, namespace: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        encoded = json.dumps(value, default=str)
+
+        def add() -> bool:
+            if self._current(namespace, key) is not None:
+                return False
+            self._write(namespace, key, encoded, ttl)
+            return True
+
+        return self._transaction(add)
+
+    def update(self, namespace: str, key: str, fn: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]],
+               ttl: Optional[float] = None) -> Dict[str, Any]:
+        def update() -> Dict[str, Any]:
+            value = fn(self._current(namespace, key))
+            self._write(namespace, key, json.dumps(value, default=str), ttl)
+            return value
+
+        return self._transaction(update)
+
+    def compare_and_put(self, namespace: str, key: str, value: Dict[str, Any],
+                        check: Callable[[Optional[Dict[str, Any]]], bool], ttl: Optional[float] = None) -> Optional[int]:
+        encoded = json.dumps(value, default=str)
+
+        def compare_and_put() -> Optional[int]:
+            if not check(self._current(namespace, key)):
+                return None
+            return self._write(namespace, key, encoded, ttl)
+
+        return self._transaction(compare_and_put)
+
+    def add_many(self, namespace: str, values: Dict[str, Dict[str, Any]], ttl: Optional[float] = None) -> List[str]:
+        encoded = {key: json.dumps(value, default=str) for key, value in values.items()}
+
+        def add_many() -> List[str]:
+            added = []
+            for key, value in encoded.items():
+                if self._current(namespace, key) is None:
+                    self._write(namespace, key, value, ttl)
+                    added.append(key)
+            return added
+
+        return self._transaction(add_many)
+
+    def put_many(self, writes: List[Tuple[str, str, Optional[Dict[str, Any]]]]) -> List[int]:
+        encoded = [
+            (namespace, key, json.dumps(value, default=str) if value is not None else None)
+            for namespace, key, value in writes
+        ]
+        return self._transaction(lambda: [
+            self._write(namespace, key, value, None) if value is not None else self._delete(namespace, key)
+            for namespace, key, value in encoded
+        ])
+
+    def delete(self, namespace: str, key: str) -> int:
+        return self._transaction(lambda: self._delete(namespace, key))
+
+    def items(self, namespace: str) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM kv WHERE namespace = ? AND value IS NOT NULL"
+                " AND (expires_at IS NULL OR expires_at > ?)", (namespace, time.time())
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def changes_since(self, cursor: int, namespaces: Iterable[str]) -> Tuple[int, List[Tuple[int, str, str, Optional[Dict[str, Any]]]]]:
+        namespaces = list(namespaces)
+        placeholders = ",".join("?" for _ in namespaces)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT seq, namespace, key, value FROM kv WHERE seq > ? AND namespace IN ({placeholders}) ORDER BY seq",
+                (cursor, *namespaces),
+            ).fetchall()
+        if not rows:
+            return cursor, []
+        changes = [
+            (seq, namespace, key, json.loads(value) if value is not None else None)
+            for seq, namespace, key, value in rows
+        ]
+        return rows[-1][0], changes
+
+    def compact(self) -> int:
+        return self._transaction(
+            lambda: self._conn.execute(
+                "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            ).rowcount
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_state_backend(url: Optional[str] = None) -> Optional[StateBackend]:
+    """Cria o backend a partir de STATE_BACKEND_URL (ex: sqlite:///./sentra_state.db)
+
+    Sem URL configurada retorna None e os serviços mantêm o estado apenas
+    em memória, como em um único processo.
+    """
+    url = url if url is not None else os.getenv("STATE_BACKEND_URL")
+    if not url:
+        return None
+
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(
+            url[len("sqlite:///"):],
+            busy_timeout=float(os.getenv("STATE_BACKEND_BUSY_TIMEOUT_SECONDS", 1.0)),
+            tombstone_ttl=float(os.getenv("STATE_BACKEND_TOMBSTONE_TTL_SECONDS", 3600)),
+        )
+
+    raise ValueError(f"STATE_BACKEND_URL não suportada: {url}")
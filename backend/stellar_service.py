@@ -1,41 +1,114 @@
+import copy
 import os
+from concurrent.futures import ThreadPoolExecutor
 import json
 from datetime import datetime
-from typing import Dict, List, Optional, Any
-from stellar_sdk import Server, Keypair, Network, TransactionBuilder, Account
-from stellar_sdk.exceptions import Ed25519PublicKeyInvalidError, BadResponseError
-from stellar_sdk.contract import AssembledTransaction
-from stellar_sdk import scval, xdr, Address
+from typing import Dict, List, Optional, Any, Sequence, TYPE_CHECKING
 import asyncio
+import importlib
 import logging
+from state_backend import StateBackend
+from singleflight import SingleFlight
+from metrics import REGISTRY
+from tracing import traced, span, set_attribute
+from contextlib import contextmanager
+import time
+
+if TYPE_CHECKING:
+    from stellar_sdk import Account, xdr
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# stellar_sdk é importado sob demanda (warm_up ou primeiro uso): só a
+# importação leva ~0,3s, que pesava no cold start mesmo no modo simulado
+
+CONTRACT_CALL_LATENCY = REGISTRY.histogram(
+    "stellar_contract_call_seconds", "Latência das chamadas ao smart contract", ("function", "kind")
+)
+CONTRACT_CALL_ERRORS = REGISTRY.counter(
+    "stellar_contract_call_errors_total", "Erros nas chamadas ao smart contract", ("function", "kind")
+)
+RPC_STAGE_LATENCY = REGISTRY.histogram(
+    "stellar_rpc_stage_seconds", "Latência de cada etapa das chamadas via Soroban RPC", ("stage",)
+)
+
+
+@contextmanager
+def _rpc_stage(stage: str, **attributes):
+    """Mede uma etapa da chamada via RPC (histograma + span)"""
+    with span(f"stellar.{stage}", **attributes), RPC_STAGE_LATENCY.time(stage):
+        yield
+
 class StellarContractService:
     """Serviço para interagir com contratos inteligentes na rede Stellar"""
     
-    def __init__(self):
+    def __init__(self, backend: Optional[StateBackend] = None, sync_interval: float = 0.0):
         self.server = None
         self.keypair = None
         self.account = None
         self.contracts_data = {}  # Cache para dados dos contratos
         
+        # Consultas concorrentes ao mesmo contrato compartilham uma execução
+        self.lookups = SingleFlight()
+        
+        # Com backend compartilhado, contracts_data é um espelho local por worker,
+        # consultado no máximo a cada `sync_interval` segundos (como no UserService)
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self._cursor = 0
+        self._synced_at = 0.0
+        self._sync(force=True)
+        
         # Configurações da rede
         self.network = os.getenv("STELLAR_NETWORK", "testnet")
         self.horizon_url = self._get_horizon_url()
         self.contract_id = os.getenv("STELLAR_CONTRACT_ID")
         self.soroban_rpc_url = self._get_soroban_rpc_url()
         
+        # "simulated" (padrão) apenas simula as chamadas ao contrato; "rpc" envia
+        # transações via Soroban RPC (rede real ou benchmarks/fake_stellar.py)
+        self.rpc_mode = os.getenv("STELLAR_RPC_MODE", "simulated").lower()
+        self.soroban_server = None
+        self.tx_poll_interval = float(os.getenv("STELLAR_TX_POLL_INTERVAL", 1.0))
+        self.tx_timeout = float(os.getenv("STELLAR_TX_TIMEOUT_SECONDS", 30))
+        
+        # Verificação de saúde: cliente Horizon próprio, com timeout e sem
+        # retentativas, numa única thread (um Horizon lento não acumula threads)
+        self.health_timeout = float(os.getenv("STELLAR_HEALTH_TIMEOUT_SECONDS", 5))
+        self._health_server = None
+        self._health_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="horizon-health")
+        self._rpc_setup_lock = asyncio.Lock()
+        
+        # Prontidão da camada de blockchain: pending -> warming -> ready | failed
+        self.chain_status = "pending"
+        self.chain_error: Optional[str] = None
+        
     def _get_horizon_url(self) -> str:
         """Retorna a URL do Horizon baseada na rede"""
+        if os.getenv("HORIZON_URL"):
+            return os.getenv("HORIZON_URL")
         if self.network == "mainnet":
             return "https://horizon.stellar.org"
         else:
             return "https://horizon-testnet.stellar.org"
     
+    async def warm_up(self):
+        """Importa o SDK fora do event loop e, no modo rpc, conecta a conta"""
+        self.chain_status = "warming"
+        try:
+            await asyncio.to_thread(importlib.import_module, "stellar_sdk")
+            if self.rpc_mode == "rpc" and self.contract_id:
+                await self._ensure_rpc()
+            self.chain_status = "ready"
+            self.chain_error = None
+        except Exception as e:
+            self.chain_status = "failed"
+            self.chain_error = str(e)
+            logger.error("Falha ao preparar a camada Stellar: %s", e)
+    
     async def initialize(self):
         """Inicializa a conexão com a rede Stellar"""
+        from stellar_sdk import Server, Keypair, Account, SorobanServer
         try:
             # Configura servidor Horizon
             self.server = Server(self.horizon_url)
@@ -48,19 +121,17 @@ class StellarContractService:
             self.keypair = Keypair.from_secret(secret_key)
             
             # Carrega informações da conta
-            account_response = self.server.accounts().account_id(
-                self.keypair.public_key
-            ).call()
+            account_response = await asyncio.to_thread(
+                self.server.accounts().account_id(self.keypair.public_key).call
+            )
             self.account = Account(
                 account_response["account_id"], 
-                account_response["sequence"]
+                int(account_response["sequence"])
             )
             
-            # Configura rede
-            if self.network == "mainnet":
-                Network.use_public_network()
-            else:
-                Network.use_test_network()
+            # A rede é definida pelo passphrase usado em cada transação
+            if self.rpc_mode == "rpc":
+                self.soroban_server = SorobanServer(self.soroban_rpc_url)
             
             logger.info(f"Stellar service inicializado - Rede: {self.network}")
             logger.info(f"Conta pública: {self.keypair.public_key}")
@@ -73,8 +144,36 @@ class StellarContractService:
             logger.error(f"Erro ao inicializar Stellar service: {e}")
             raise
     
+    def _sync(self, force: bool = False):
+        """Aplica ao cache local os contratos gravados por outros workers
+        
+        Sem `force`, não consulta o backend se a última sincronização foi há
+        menos de `sync_interval` segundos; quem não encontra o contrato no
+        cache (criado em outro worker) sincroniza com force.
+        """
+        if not self.backend:
+            return
+        now = time.monotonic()
+        if not force and now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        
+        self._cursor, changes = self.backend.changes_since(self._cursor, ("contracts",))
+        for seq, namespace, trip_id, value in changes:
+            if value is None:
+                self.contracts_data.pop(trip_id, None)
+            else:
+                self.contracts_data[trip_id] = value
+    
+    def _save_contract(self, trip_id: str):
+        """Grava o contrato no backend compartilhado, se houver"""
+        if self.backend:
+            self.backend.put("contracts", trip_id, self.contracts_data[trip_id])
+    
     def _get_soroban_rpc_url(self) -> str:
         """Retorna URL do RPC Soroban"""
+        if os.getenv("SOROBAN_RPC_URL"):
+            return os.getenv("SOROBAN_RPC_URL")
         if self.network == "mainnet":
             return "https://soroban-rpc.stellar.org"
         else:
@@ -82,18 +181,24 @@ class StellarContractService:
     
     def _get_network_passphrase(self) -> str:
         """Retorna o passphrase da rede"""
+        from stellar_sdk import Network
+        if os.getenv("SOROBAN_NETWORK_PASSPHRASE"):
+            return os.getenv("SOROBAN_NETWORK_PASSPHRASE")
         if self.network == "mainnet":
             return Network.PUBLIC_NETWORK_PASSPHRASE
         else:
             return Network.TESTNET_NETWORK_PASSPHRASE
     
-    async def create_transport_contract(self, trip_id: str, driver: str, route: List[str]) -> Dict[str, Any]:
+    @traced()
+    async def create_transport_contract(self, trip_id: str, driver: str, route: Sequence[str]) -> Dict[str, Any]:
         """Cria um novo contrato de transporte usando criar_viagem do smart contract"""
         try:
             current_time = datetime.utcnow()
             
             # Extrai endereços dos checkpoints da rota
             # Assume que route[0] = saída, route[1] = meio, route[2] = chegada
+            # Cópia: a lista recebida pertence a quem chamou
+            route = list(route)
             if len(route) < 3:
                 # Se não temos 3 pontos, duplicamos alguns para completar
                 while len(route) < 3:
@@ -123,6 +228,7 @@ class StellarContractService:
                 
                 # Armazena no cache
                 self.contracts_data[trip_id] = contract_data
+                self._save_contract(trip_id)
                 
                 return contract_data
             
@@ -153,16 +259,19 @@ class StellarContractService:
             }
             
             self.contracts_data[trip_id] = contract_data
+            self._save_contract(trip_id)
             return contract_data
             
         except Exception as e:
             logger.error(f"Erro ao criar contrato: {e}")
             raise
     
+    @traced()
     async def update_contract_status(self, trip_id: str, event: str, status: str) -> Dict[str, Any]:
         """Atualiza o status de um contrato usando as funções específicas do smart contract"""
         try:
             current_time = datetime.utcnow()
+            self._sync(force=trip_id not in self.contracts_data)
             
             # Verifica se o contrato existe
             if trip_id not in self.contracts_data:
@@ -185,21 +294,16 @@ class StellarContractService:
                 "delivered": "Finalizada"
             }
             
-            # Atualiza dados do contrato
-            contract_data = self.contracts_data[trip_id]
-            
-            # Adiciona novo checkpoint
+            # Novo checkpoint; só entra no contrato depois da chamada à blockchain
             checkpoint = {
                 "event": event,
                 "status": status,
                 "timestamp": current_time.isoformat()
             }
             
-            contract_data["checkpoints"].append(checkpoint)
-            
             # Determina qual função chamar no smart contract
             contract_function = contract_function_map.get(event.lower())
-            new_contract_status = contract_data["status"]  # Status atual
+            new_contract_status = None  # Mantém o status atual
             
             # Se temos contrato inteligente, invoca função específica
             if self.contract_id and contract_function:
@@ -216,14 +320,31 @@ class StellarContractService:
                 elif contract_function == "marcar_chegada":
                     new_contract_status = "Finalizada"
                 
-                contract_data["transaction_hash"] = result.get("transaction_hash")
+                transaction_hash = result.get("transaction_hash")
             else:
                 # Simula transação se não temos contrato
-                contract_data["transaction_hash"] = f"SIMULATED_TX_{trip_id}_{event}_{int(current_time.timestamp())}"
-                new_contract_status = status_map.get(status, contract_data["status"])
+                transaction_hash = f"SIMULATED_TX_{trip_id}_{event}_{int(current_time.timestamp())}"
+                new_contract_status = status_map.get(status)
+            
+            def apply(contract_data: Dict[str, Any]) -> Dict[str, Any]:
+                contract_data["checkpoints"].append(checkpoint)
+                if new_contract_status is not None:
+                    contract_data["status"] = new_contract_status
+                contract_data["transaction_hash"] = transaction_hash
+                contract_data["updated_at"] = current_time.isoformat()
+                return contract_data
             
-            contract_data["status"] = new_contract_status
-            contract_data["updated_at"] = current_time.isoformat()
+            # Aplica sobre o estado atual, relido depois do await: outro worker (ou
+            # um geofence e uma marcação manual ao mesmo tempo) pode ter gravado
+            # um checkpoint enquanto a transação era enviada
+            if self.backend:
+                contract_data = self.backend.update(
+                    "contracts", trip_id,
+                    lambda current: apply(current if current is not None else copy.deepcopy(self.contracts_data[trip_id]))
+                )
+            else:
+                contract_data = apply(self.contracts_data[trip_id])
+            self.contracts_data[trip_id] = contract_data
             
             return {
                 "transaction_hash": contract_data["transaction_hash"],
@@ -235,9 +356,15 @@ class StellarContractService:
             logger.error(f"Erro ao atualizar contrato: {e}")
             raise
     
+    @traced()
     async def get_contract_status(self, trip_id: str) -> Optional[Dict[str, Any]]:
         """Consulta o estado atual de um contrato usando get_viagem"""
+        return await self.lookups.do(trip_id, lambda: self._fetch_contract_status(trip_id))
+    
+    async def _fetch_contract_status(self, trip_id: str) -> Optional[Dict[str, Any]]:
         try:
+            self._sync(force=trip_id not in self.contracts_data)
+            
             # Se temos contrato inteligente, consulta na blockchain primeiro
             if self.contract_id:
                 try:
@@ -292,6 +419,7 @@ class StellarContractService:
             logger.error(f"Erro ao buscar histórico: {e}")
             return []
     
+    @traced()
     async def initialize_contract(self, admin_address: str) -> Dict[str, Any]:
         """Inicializa o smart contract com um endereço admin"""
         try:
@@ -329,19 +457,19 @@ class StellarContractService:
         except Exception as e:
             logger.error(f"Erro ao obter admin: {e}")
             return None
+    
+    async def check_connection(self) -> Dict[str, Any]:
         """Verifica a conexão com a rede Stellar"""
         try:
-            if not self.server:
-                return {"connected": False, "error": "Servidor não inicializado"}
-            
-            # Testa conexão com Horizon
-            ledger_response = self.server.ledgers().limit(1).call()
+            # Testa conexão com Horizon (ledger mais recente; a ordem padrão é ascendente)
+            ledger_response = await asyncio.get_running_loop().run_in_executor(self._health_executor, self._latest_ledger)
             
             return {
                 "connected": True,
                 "network": self.network,
                 "horizon_url": self.horizon_url,
-                "latest_ledger": ledger_response["_embedded"]["records"][0]["sequence"]
+                "latest_ledger": ledger_response["_embedded"]["records"][0]["sequence"],
+                "ledger_closed_at": ledger_response["_embedded"]["records"][0].get("closed_at")
             }
             
         except Exception as e:
@@ -351,21 +479,35 @@ class StellarContractService:
                 "error": str(e)
             }
     
+    def _latest_ledger(self) -> Dict[str, Any]:
+        # Consultar o Horizon não exige conta; o cliente é criado sob demanda
+        if not self._health_server:
+            from stellar_sdk import Server
+            from stellar_sdk.client.requests_client import RequestsClient
+            client = RequestsClient(pool_size=1, num_retries=0, request_timeout=self.health_timeout)
+            self._health_server = Server(self.horizon_url, client=client)
+        return self._health_server.ledgers().order(desc=True).limit(1).call()
+    
+    @traced("stellar.invoke")
     async def _invoke_contract_function(self, function_name: str, params: Dict[str, Any]) -> Dict[str, Any]:
         """Invoca uma função do contrato inteligente usando Stellar SDK"""
+        start = time.perf_counter()
+        set_attribute("contract.function", function_name)
+        set_attribute("trip.id", params.get("trip_id"))
         try:
             if not self.contract_id:
                 raise ValueError("Contract ID não configurado")
             
-            logger.info(f"Chamando função {function_name} com parâmetros: {params}")
-            
-            # Para demonstração, simula a chamada
-            # Em produção, você usaria o Stellar SDK para chamar o contrato real
-            await asyncio.sleep(0.1)  # Simula latência da rede
+            logger.info("Chamando função %s com parâmetros: %s", function_name, params)
             
-            transaction_hash = f"TX_{function_name}_{int(datetime.utcnow().timestamp())}"
+            if self.rpc_mode == "rpc":
+                transaction_hash = await self._invoke_via_rpc(function_name, params)
+            else:
+                # Para demonstração, simula a chamada
+                await asyncio.sleep(0.1)  # Simula latência da rede
+                transaction_hash = f"TX_{function_name}_{int(datetime.utcnow().timestamp())}"
             
-            logger.info(f"Função {function_name} executada com sucesso. TX: {transaction_hash}")
+            logger.info("Função %s executada com sucesso. TX: %s", function_name, transaction_hash)
             
             return {
                 "transaction_hash": transaction_hash,
@@ -375,16 +517,26 @@ class StellarContractService:
             }
             
         except Exception as e:
+            CONTRACT_CALL_ERRORS.inc(function_name, "invoke")
             logger.error(f"Erro ao invocar função {function_name}: {e}")
             raise
+        finally:
+            CONTRACT_CALL_LATENCY.observe(time.perf_counter() - start, function_name, "invoke")
     
+    @traced("stellar.query")
     async def _query_contract_function(self, function_name: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Consulta uma função read-only do contrato"""
+        start = time.perf_counter()
+        set_attribute("contract.function", function_name)
+        set_attribute("trip.id", params.get("trip_id"))
         try:
             if not self.contract_id:
                 return None
             
-            logger.info(f"Consultando função {function_name} com parâmetros: {params}")
+            logger.info("Consultando função %s com parâmetros: %s", function_name, params)
+            
+            if self.rpc_mode == "rpc":
+                return await self._query_via_rpc(function_name, params)
             
             # Implementação simplificada para consulta
             await asyncio.sleep(0.05)  # Simula latência da rede
@@ -401,5 +553,122 @@ class StellarContractService:
             return None
             
         except Exception as e:
+            CONTRACT_CALL_ERRORS.inc(function_name, "query")
             logger.error(f"Erro ao consultar função {function_name}: {e}")
-            raise
\ No newline at end of file
+            raise
+        finally:
+            CONTRACT_CALL_LATENCY.observe(time.perf_counter() - start, function_name, "query")
+    
+    # =================== SOROBAN RPC ===================
+    
+    async def _ensure_rpc(self):
+        """Inicializa a conexão e recarrega a conta quando necessário"""
+        if self.soroban_server is not None and self.account is not None:
+            return
+        async with self._rpc_setup_lock:
+            if self.soroban_server is None or self.keypair is None:
+                await self.initialize()
+            elif self.account is None:
+                self.account = await asyncio.to_thread(self.server.load_account, self.keypair.public_key)
+    
+    def _address_arg(self, value: str) -> "xdr.SCVal":
+        """Converte um endereço Stellar; IDs internos (ex: DRV-001) usam a conta do serviço"""
+        from stellar_sdk import scval, Address
+        try:
+            return scval.to_address(Address(value))
+        except ValueError:
+            return scval.to_address(Address(self.keypair.public_key))
+    
+    def _contract_args(self, function_name: str, params: Dict[str, Any]) -> List["xdr.SCVal"]:
+        """Monta os argumentos da função do contrato na ordem da assinatura"""
+        from stellar_sdk import scval
+        if function_name == "criar_viagem":
+            return [
+                scval.to_string(params["trip_id"]),
+                self._address_arg(params["saida_checkpoint"]),
+                self._address_arg(params["meio_checkpoint"]),
+                self._address_arg(params["chegada_checkpoint"]),
+            ]
+        if function_name == "initialize":
+            return [self._address_arg(params["admin"])]
+        if "trip_id" in params:
+            return [scval.to_string(params["trip_id"])]
+        return []
+    
+    def _build_transaction(self, source: "Account", function_name: str, params: Dict[str, Any]):
+        from stellar_sdk import TransactionBuilder
+        return (
+            TransactionBuilder(source, self._get_network_passphrase(), base_fee=100)
+            .append_invoke_contract_function_op(self.contract_id, function_name, self._contract_args(function_name, params))
+            .set_timeout(int(self.tx_timeout))
+            .build()
+        )
+    
+    async def _simulate(self, transaction):
+        with _rpc_stage("simulate"):
+            simulation = await asyncio.to_thread(self.soroban_server.simulate_transaction, transaction)
+        if simulation.error:
+            raise ValueError(f"Simulação falhou: {simulation.error}")
+        return simulation
+    
+    async def _invoke_via_rpc(self, function_name: str, params: Dict[str, Any]) -> str:
+        """Simula, assina, envia e aguarda a confirmação de uma transação do contrato"""
+        from stellar_sdk.soroban_rpc import GetTransactionStatus, SendTransactionStatus
+        await self._ensure_rpc()
+        try:
+            # O builder incrementa a sequência da conta local a cada transação
+            transaction = self._build_transaction(self.account, function_name, params)
+            simulation = await self._simulate(transaction)
+            
+            with _rpc_stage("sign"):
+                transaction = self.soroban_server.prepare_transaction(transaction, simulation)
+                transaction.sign(self.keypair)
+            
+            with _rpc_stage("submit"):
+                sent = await asyncio.to_thread(self.soroban_server.send_transaction, transaction)
+            if sent.status != SendTransactionStatus.PENDING:
+                raise ValueError(f"Transação rejeitada ({sent.status}): {sent.error_result_xdr}")
+        except Exception:
+            # Sequência local pode ter divergido da rede; recarrega na próxima chamada
+            self.account = None
+            raise
+        
+        with _rpc_stage("confirm", **{"tx.hash": sent.hash}):
+            deadline = time.monotonic() + self.tx_timeout
+            while True:
+                response = await asyncio.to_thread(self.soroban_server.get_transaction, sent.hash)
+                if response.status == GetTransactionStatus.SUCCESS:
+                    return sent.hash
+                if response.status == GetTransactionStatus.FAILED:
+                    raise ValueError(f"Transação {sent.hash} falhou no ledger {response.ledger}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Transação {sent.hash} não confirmada em {self.tx_timeout}s")
+                await asyncio.sleep(self.tx_poll_interval)
+    
+    async def _query_via_rpc(self, function_name: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Consulta read-only: apenas simula a transação e decodifica o retorno"""
+        from stellar_sdk import Account, Address, scval
+        await self._ensure_rpc()
+        # Simulação não consome sequência; usa uma cópia da conta
+        source = Account(self.keypair.public_key, self.account.sequence if self.account else 0)
+        simulation = await self._simulate(self._build_transaction(source, function_name, params))
+        if not simulation.results:
+            return None
+        
+        value = scval.to_native(simulation.results[0].xdr)
+        if function_name == "get_admin":
+            return {"admin": value.address if isinstance(value, Address) else value}
+        if not isinstance(value, dict):
+            return None
+        
+        # Enums do contrato chegam como [nome]; endereços como Address
+        result = {}
+        for key, item in value.items():
+            if isinstance(item, list) and len(item) == 1:
+                item = item[0]
+            if isinstance(item, Address):
+                item = item.address
+            if isinstance(item, bytes):
+                item = item.decode()
+            result[key] = item
+        return result
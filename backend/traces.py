@@ -0,0 +1,363 @@
+import base64
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from geo import EARTH_RADIUS_KM, haversine_km
+from state_backend import StateBackend
+
+logger = logging.getLogger(__name__)
+
+# Coordenadas em unidades de 1e-5 grau (~1,1 m), a mesma precisão do polyline do Google
+_SCALE = 100_000
+
+Point = Tuple[float, float, int]
+
+
+# =================== CODIFICAÇÃO ===================
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+class TraceEncoder:
+    """Codifica pontos (lat, lng, t) em binário compacto, um de cada vez
+
+    Cada ponto é a diferença para o anterior: lat e lng em 1e-5 grau
+    (varint zigzag) e t em segundos (varint). Pontos próximos no tempo e no
+    espaço ocupam 3 a 6 bytes, contra 24 de três números de 8 bytes.
+    """
+
+    __slots__ = ("data", "count", "_lat", "_lng", "_t")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.count = 0
+        self._lat = self._lng = self._t = 0
+
+    def append(self, lat: float, lng: float, t: int):
+        lat_e5, lng_e5 = round(lat * _SCALE), round(lng * _SCALE)
+        _write_varint(self.data, _zigzag(lat_e5 - self._lat))
+        _write_varint(self.data, _zigzag(lng_e5 - self._lng))
+        _write_varint(self.data, _zigzag(t - self._t))
+        self._lat, self._lng, self._t = lat_e5, lng_e5, t
+        self.count += 1
+
+
+def encode_points(points: Sequence[Point]) -> bytes:
+    encoder = TraceEncoder()
+    for lat, lng, t in points:
+        encoder.append(lat, lng, t)
+    return bytes(encoder.data)
+
+
+def decode_points(data: bytes) -> Iterator[Point]:
+    """Pontos (lat, lng, t) de um trace codificado, na ordem gravada"""
+    values = [0, 0, 0]
+    field = shift = accumulated = 0
+    for byte in data:
+        accumulated |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values[field] += (accumulated >> 1) ^ -(accumulated & 1)
+        accumulated = shift = 0
+        field += 1
+        if field == 3:
+            field = 0
+            yield values[0] / _SCALE, values[1] / _SCALE, values[2]
+
+
+def encode_polyline(points: Iterator[Point], chunk_points: int = 256) -> Iterator[str]:
+    """Algoritmo de polyline do Google (precisão 5), em pedaços para streaming"""
+    previous_lat = previous_lng = 0
+    chunk: List[str] = []
+    for lat, lng, _ in points:
+        lat_e5, lng_e5 = round(lat * _SCALE), round(lng * _SCALE)
+        for delta in (lat_e5 - previous_lat, lng_e5 - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunk.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            chunk.append(chr(value + 63))
+        previous_lat, previous_lng = lat_e5, lng_e5
+        if len(chunk) >= chunk_points * 8:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+# =================== SIMPLIFICAÇÃO ===================
+
+def _bearing(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_lambda = math.radians(lng2 - lng1)
+    x = math.sin(d_lambda) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(d_lambda)
+    return math.degrees(math.atan2(x, y))
+
+
+def _turn(bearing1: float, bearing2: float) -> float:
+    return abs((bearing2 - bearing1 + 180) % 360 - 180)
+
+
+def douglas_peucker(points: Sequence[Point], epsilon_m: float) -> List[Point]:
+    """Douglas–Peucker iterativo (sem recursão) com distâncias em metros
+
+    Projeta os pontos num plano local (equirretangular na latitude média),
+    suficiente para as distâncias de um trajeto urbano.
+    """
+    if len(points) < 3:
+        return list(points)
+    meters_per_degree = EARTH_RADIUS_KM * 1000 * math.pi / 180
+    cos_lat = math.cos(math.radians(sum(point[0] for point in points) / len(points)))
+    xs = [point[1] * meters_per_degree * cos_lat for point in points]
+    ys = [point[0] * meters_per_degree for point in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1, x2, y2 = xs[first], ys[first], xs[last], ys[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        farthest, max_distance = -1, epsilon_m
+        for index in range(first + 1, last):
+            if length == 0:
+                distance = math.hypot(xs[index] - x1, ys[index] - y1)
+            else:
+                distance = abs(dy * xs[index] - dx * ys[index] + x2 * y1 - y2 * x1) / length
+            if distance > max_distance:
+                farthest, max_distance = index, distance
+        if farthest >= 0:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class _Trace:
+    """Trace de uma viagem em andamento: pontos confirmados (codificados) e o último recebido"""
+
+    __slots__ = ("trip_id", "driver_id", "encoder", "anchor", "anchor_bearing", "pending", "received", "touched_at")
+
+    def __init__(self, trip_id: str, driver_id: str):
+        self.trip_id = trip_id
+        self.driver_id = driver_id
+        self.encoder = TraceEncoder()
+        self.anchor: Optional[Point] = None
+        self.anchor_bearing: Optional[float] = None
+        self.pending: Optional[Point] = None
+        self.received = 0
+        self.touched_at = time.monotonic()
+
+    def commit(self, point: Point):
+        self.encoder.append(*point)
+        self.anchor = point
+        self.anchor_bearing = None
+
+    def points(self) -> Iterator[Point]:
+        yield from decode_points(bytes(self.encoder.data))
+        if self.pending is not None:
+            yield self.pending
+
+
+class TraceStore:
+    """Traces GPS das viagens em andamento, simplificados na chegada de cada ping
+
+    Simplificação online: pings a menos de `min_distance_m` do último ponto
+    são descartados (parado ou ruído); o último ping fica pendente e só é
+    confirmado quando a direção a partir do último ponto confirmado muda
+    mais que `angle_deg`, ou quando passam `max_interval_s` segundos. Ao fim
+    da viagem (finish) o trace passa por Douglas–Peucker com `epsilon_m` e
+    é guardado codificado (TraceEncoder); com backend compartilhado, no
+    namespace "traces", legível por qualquer worker.
+
+    Os traces em andamento ficam na memória do worker que recebe os pings,
+    como o índice de posições: com vários workers cada um tem um fragmento
+    da viagem, e finish() mescla o seu ao trace gravado (backend.update),
+    pela ordem do tempo. Fragmentos sem pings há `max_idle_s` segundos são
+    encerrados do mesmo jeito. Sem backend, os traces encerrados ficam num
+    LRU de `max_finished` viagens.
+    """
+
+    NAMESPACE = "traces"
+
+    def __init__(self, min_distance_m: float = 10.0, angle_deg: float = 15.0, max_interval_s: float = 60.0,
+                 epsilon_m: float = 5.0, backend: Optional[StateBackend] = None,
+                 max_idle_s: float = 3600.0, max_finished: int = 10_000):
+        self.min_distance_km = min_distance_m / 1000
+        self.angle_deg = angle_deg
+        self.max_interval_s = max_interval_s
+        self.epsilon_m = epsilon_m
+        self.backend = backend
+        self.max_idle_s = max_idle_s
+        self.max_finished = max_finished
+        self._active: Dict[str, _Trace] = {}
+        self._trip_drivers: Dict[str, str] = {}
+        self._finished: "OrderedDict[str, bytes]" = OrderedDict()
+        self._swept_at = time.monotonic()
+        self.received = 0
+        self.stored = 0
+        self.bytes_stored = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def start(self, driver_id: str, trip_id: str):
+        """Começa o trace da viagem (idempotente; viagens já encerradas não recomeçam)"""
+        current = self._active.get(driver_id)
+        if current is not None and current.trip_id == trip_id:
+            return
+        if current is not None:
+            self.finish(current.trip_id)
+        if self._load(trip_id) is not None:
+            return
+        self._active[driver_id] = _Trace(trip_id, driver_id)
+        self._trip_drivers[trip_id] = driver_id
+
+    def record(self, driver_id: str, lat: float, lng: float, at: Optional[float] = None):
+        trace = self._active.get(driver_id)
+        if trace is None:
+            return
+        self.received += 1
+        trace.received += 1
+        trace.touched_at = time.monotonic()
+        self._sweep(trace.touched_at)
+        point = (lat, lng, int(at if at is not None else time.time()))
+        anchor = trace.anchor
+        if anchor is None:
+            trace.commit(point)
+            return
+        reference = trace.pending or anchor
+        if haversine_km(reference[0], reference[1], lat, lng) < self.min_distance_km:
+            return
+        pending = trace.pending
+        if pending is None:
+            trace.pending = point
+            return
+
+        # Direção âncora -> pendente, fixada no primeiro pendente após cada ponto confirmado;
+        # curvas suaves acumulam desvio em relação a ela até passar do limite
+        if trace.anchor_bearing is None:
+            trace.anchor_bearing = _bearing(anchor[0], anchor[1], pending[0], pending[1])
+        if (_turn(trace.anchor_bearing, _bearing(anchor[0], anchor[1], lat, lng)) > self.angle_deg
+                or point[2] - anchor[2] > self.max_interval_s):
+            trace.commit(pending)
+            trace.anchor_bearing = _bearing(pending[0], pending[1], lat, lng)
+        trace.pending = point
+
+    def _sweep(self, now: float):
+        # No máximo uma varredura por max_idle_s: encerra fragmentos cuja viagem
+        # terminou sem que este worker soubesse (ou que pararam de receber pings)
+        if now - self._swept_at < self.max_idle_s:
+            return
+        self._swept_at = now
+        for trace in [trace for trace in self._active.values() if now - trace.touched_at > self.max_idle_s]:
+            self.expired += 1
+            self.finish(trace.trip_id)
+
+    def finish(self, trip_id: str) -> Optional[int]:
+        """Encerra o trace da viagem; retorna quantos pontos ficaram guardados"""
+        driver_id = self._trip_drivers.pop(trip_id, None)
+        trace = self._active.get(driver_id) if driver_id is not None else None
+        if trace is None or trace.trip_id != trip_id:
+            return None
+        del self._active[driver_id]
+
+        fragment = list(trace.points())
+        if self.backend is None:
+            data, points = self._merge(self._finished.get(trip_id), fragment)
+            self._remember(trip_id, data)
+            received = trace.received
+        else:
+            def merge(stored: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+                previous = base64.b64decode(stored["data"]) if stored is not None else None
+                merged, count = self._merge(previous, fragment)
+                return {
+                    "driver_id": driver_id,
+                    "points": count,
+                    "received": trace.received + (stored["received"] if stored is not None else 0),
+                    "data": base64.b64encode(merged).decode("ascii"),
+                }
+
+            stored = self.backend.update(self.NAMESPACE, trip_id, merge)
+            data = base64.b64decode(stored["data"])
+            points, received = stored["points"], stored["received"]
+
+        self.stored += points
+        self.bytes_stored += len(data)
+        logger.info("Trace da viagem %s: %d pings -> %d pontos (%d bytes)", trip_id, received, points, len(data))
+        return points
+
+    def _merge(self, previous: Optional[bytes], fragment: List[Point]) -> Tuple[bytes, int]:
+        # Fragmentos de workers diferentes se intercalam no tempo
+        points = fragment
+        if previous is not None:
+            points = sorted([*decode_points(previous), *fragment], key=lambda point: point[2])
+        points = douglas_peucker(points, self.epsilon_m)
+        return encode_points(points), len(points)
+
+    def _remember(self, trip_id: str, data: bytes):
+        self._finished[trip_id] = data
+        self._finished.move_to_end(trip_id)
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
+
+    def _load(self, trip_id: str) -> Optional[bytes]:
+        # Com backend, o trace gravado é a referência (pode ter fragmentos de outros workers)
+        if self.backend is not None:
+            stored = self.backend.get(self.NAMESPACE, trip_id)
+            return base64.b64decode(stored["data"]) if stored is not None else None
+        data = self._finished.get(trip_id)
+        if data is not None:
+            self._finished.move_to_end(trip_id)
+        return data
+
+    def points(self, trip_id: str) -> Optional[Iterator[Point]]:
+        """Pontos do trace (encerrado ou em andamento) ou None se a viagem não tiver trace
+
+        Em andamento, só o fragmento deste worker.
+        """
+        driver_id = self._trip_drivers.get(trip_id)
+        if driver_id is not None:
+            return self._active[driver_id].points()
+        data = self._load(trip_id)
+        return decode_points(data) if data is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self._active),
+            "finished": len(self._finished),
+            "expired": self.expired,
+            "pings_received": self.received,
+            "points_stored": self.stored,
+            "bytes_stored": self.bytes_stored,
+        }
+
+
+def create_trace_store(backend: Optional[StateBackend] = None) -> Optional[TraceStore]:
+    """Store conforme TRACE_ENABLED e TRACE_* (limiares da simplificação, fragmentos ociosos, LRU)"""
+    if os.getenv("TRACE_ENABLED", "true").lower() != "true":
+        return None
+    return TraceStore(
+        min_distance_m=float(os.getenv("TRACE_MIN_DISTANCE_METERS", 10)),
+        angle_deg=float(os.getenv("TRACE_ANGLE_DEGREES", 15)),
+        max_interval_s=float(os.getenv("TRACE_MAX_INTERVAL_SECONDS", 60)),
+        epsilon_m=float(os.getenv("TRACE_EPSILON_METERS", 5)),
+        backend=backend,
+        max_idle_s=float(os.getenv("TRACE_MAX_IDLE_SECONDS", 3600)),
+        max_finished=int(os.getenv("TRACE_MAX_FINISHED", 10_000)),
+    )
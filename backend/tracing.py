@@ -0,0 +1,380 @@
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SPANS_DROPPED = REGISTRY.counter("spans_dropped_total", "Spans descartados com a fila do exportador cheia")
+
+TRACEPARENT_HEADER = b"traceparent"
+
+# Argumentos reconhecidos automaticamente por @traced -> nome do atributo
+TRACED_ARGUMENTS = {
+    "request_id": "ride.id",
+    "ride_id": "ride.id",
+    "trip_id": "trip.id",
+    "driver_id": "driver.id",
+    "enterprise_id": "enterprise.id",
+    "user_id": "user.id",
+}
+
+
+class Span:
+    """Intervalo de uma operação dentro de um trace"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error", "sampled", "kind")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.sampled = sampled
+        # 1 = interno, 2 = servidor (span raiz da requisição HTTP)
+        self.kind = 1
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Representação no formato JSON do OTLP (ResourceSpans.scopeSpans.spans[])"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+# Span corrente; tasks e asyncio.to_thread herdam o contexto de quem as criou
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+# =================== EXPORTADORES ===================
+
+class SpanExporter:
+    """Interface dos exportadores; export() roda na thread do processador"""
+
+    def export(self, spans: List[Span]):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class JsonlFileExporter(SpanExporter):
+    """Grava um span OTLP/JSON por linha"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, spans: List[Span]):
+        self._file.write("".join(json.dumps(span.to_otlp(), ensure_ascii=False) + "\n" for span in spans))
+        self._file.flush()
+
+    def shutdown(self):
+        self._file.close()
+
+
+class OTLPHttpExporter(SpanExporter):
+    """Envia lotes para um coletor OTLP/HTTP em JSON (POST {endpoint}/v1/traces)"""
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def export(self, spans: List[Span]):
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "sentra"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except Exception as e:
+            logger.warning("Falha ao exportar %d spans: %s", len(spans), e)
+
+
+class BatchSpanProcessor:
+    """Acumula spans finalizados e exporta em lotes numa thread própria
+
+    A thread do event loop apenas enfileira o span; serialização e I/O
+    acontecem fora dela, como no logging (logging_config). A fila é
+    limitada a `max_queue_size`: com o exportador lento ou fora do ar, os
+    spans excedentes são descartados e contados em spans_dropped_total.
+    """
+
+    def __init__(self, exporter: SpanExporter, max_batch: int = 512, flush_interval: float = 2.0,
+                 max_queue_size: int = 2048):
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            SPANS_DROPPED.inc()
+            if self.dropped == 1:
+                logger.warning("Fila de spans cheia; descartando spans até o exportador se recuperar")
+
+    def _run(self):
+        batch: List[Span] = []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        while not stopping:
+            try:
+                span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if span is None:
+                    stopping = True
+                else:
+                    batch.append(span)
+                    if len(batch) < self.max_batch and time.monotonic() < deadline:
+                        continue
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                except Exception:
+                    logger.exception("Erro no exportador de spans")
+                batch = []
+            deadline = time.monotonic() + self.flush_interval
+
+    def shutdown(self):
+        try:
+            self._queue.put(None, timeout=5)
+        except queue.Full:
+            logger.warning("Exportador de spans não esvaziou a fila a tempo")
+        self._thread.join(timeout=5)
+        self.exporter.shutdown()
+
+
+# =================== TRACER ===================
+
+class Tracer:
+    """Cria spans encadeados pelo contexto; sem processador, os spans são no-op"""
+
+    def __init__(self, processor: Optional[BatchSpanProcessor] = None, sample_rate: float = 1.0):
+        self.processor = processor
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        return self.processor is not None
+
+    def start_span(self, name: str, parent: Optional[Span] = None, traceparent: Optional[str] = None,
+                   attributes: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+        if self.processor is None:
+            return None
+        if parent is None:
+            parent = current_span.get()
+        attributes = attributes if attributes is not None else {}
+        if parent is not None:
+            return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+        remote = _parse_traceparent(traceparent) if traceparent else None
+        if remote is not None:
+            trace_id, parent_id, sampled = remote
+            return Span(name, trace_id, parent_id, sampled, attributes)
+        # Amostragem na raiz; os filhos herdam a decisão
+        return Span(name, f"{random.getrandbits(128):032x}", None, random.random() < self.sample_rate, attributes)
+
+    def end_span(self, span: Span):
+        span.end_ns = time.time_ns()
+        if span.sampled:
+            self.processor.on_end(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Context manager que torna o span corrente durante o bloco"""
+        span = self.start_span(name, attributes=attributes)
+        if span is None:
+            yield None
+            return
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span)
+
+    def shutdown(self):
+        if self.processor is not None:
+            self.processor.shutdown()
+
+
+def _parse_traceparent(value: str):
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+# Tracer do processo; no-op até setup_tracing() configurar um exportador
+tracer = Tracer()
+
+
+def setup_tracing():
+    """Configura o exportador conforme TRACING_EXPORTER (none|jsonl|otlp)
+
+    jsonl grava em TRACING_FILE (traces.jsonl); otlp envia para
+    OTEL_EXPORTER_OTLP_ENDPOINT (http://localhost:4318). TRACING_SAMPLE_RATE
+    define a fração de traces amostrados na raiz e TRACING_MAX_QUEUE_SIZE o
+    limite de spans aguardando exportação.
+    """
+    if tracer.enabled:
+        return
+
+    kind = os.getenv("TRACING_EXPORTER", "none").lower()
+    if kind == "jsonl":
+        exporter: SpanExporter = JsonlFileExporter(os.getenv("TRACING_FILE", "traces.jsonl"))
+    elif kind == "otlp":
+        exporter = OTLPHttpExporter(
+            os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"),
+            os.getenv("OTEL_SERVICE_NAME", "sentra-backend"),
+        )
+    else:
+        return
+
+    tracer.sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", 1.0))
+    tracer.processor = BatchSpanProcessor(exporter, max_queue_size=int(os.getenv("TRACING_MAX_QUEUE_SIZE", 2048)))
+    atexit.register(tracer.shutdown)
+
+
+def span(name: str, **attributes):
+    """Atalho para tracer.span(); pode ser usado em código síncrono ou assíncrono"""
+    return tracer.span(name, **attributes)
+
+
+def set_attribute(key: str, value: Any):
+    """Define um atributo no span corrente, se houver (valores None são ignorados)"""
+    current = current_span.get()
+    if current is not None and value is not None:
+        current.set_attribute(key, value)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """Decorator para métodos assíncronos: um span por chamada
+
+    Argumentos com nomes em TRACED_ARGUMENTS (request_id, trip_id, ...)
+    viram atributos do span.
+    """
+    def decorator(fn):
+        span_name = name or fn.__qualname__
+        signature = inspect.signature(fn)
+        traced_args = [arg for arg in signature.parameters if arg in TRACED_ARGUMENTS]
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return await fn(*args, **kwargs)
+            attributes = {}
+            if traced_args:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                for arg in traced_args:
+                    if bound.get(arg) is not None:
+                        attributes[TRACED_ARGUMENTS[arg]] = bound[arg]
+            with tracer.span(span_name, **attributes):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingMiddleware:
+    """Middleware ASGI que abre o span raiz da requisição
+
+    Aceita o header W3C traceparent de quem chamou e devolve o traceparent
+    do span criado, para correlacionar com o cliente.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for header, value in scope["headers"]:
+            if header == TRACEPARENT_HEADER:
+                traceparent = value.decode("latin-1")
+                break
+
+        span = tracer.start_span(f"{scope['method']} {scope['path']}", traceparent=traceparent,
+                                 attributes={"http.method": scope["method"], "http.target": scope["path"]})
+        span.kind = 2
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+                message["headers"] = list(message.get("headers", [])) + [(TRACEPARENT_HEADER, span.traceparent.encode("latin-1"))]
+            await send(message)
+
+        token = current_span.set(span)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.set_attribute("http.route", route.path)
+            if span.attributes.get("http.status_code", 500) >= 500 and span.error is None:
+                span.error = f"HTTP {span.attributes.get('http.status_code', 500)}"
+            tracer.end_span(span)
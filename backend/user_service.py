@@ -1,20 +1,91 @@
+import asyncio
+import copy
+import math
+import time
 import uuid
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from models import User, UserRole, RideRequest, RideStatus, NotificationData
+from records import RideRecord, TripRecord, NotificationRecord, to_micros
+from columnar import ColumnarRideStore
+from locations import DriverLocationIndex
+from geofences import GeofenceMonitor
+from route_metrics import RouteMetrics, RouteMetricsCalculator
+from traces import TraceStore
+from demand import DemandHeatmap
+from state_backend import StateBackend
+from tracing import traced, set_attribute
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Status em que o motorista é considerado ocupado
+ACTIVE_RIDE_STATUSES = (RideStatus.PENDENTE, RideStatus.ACEITO, RideStatus.EM_ANDAMENTO)
+
+MAX_NOTIFICATIONS_PER_USER = 50
+
+# Intervalo mínimo (segundos) entre sincronizações disparadas por pings de posição
+PING_SYNC_INTERVAL = 1.0
+
+# Tentativas de uma transição de status que perde o compare-and-set para outra escrita
+MAX_TRANSITION_ATTEMPTS = 3
+
+# Reserva de motorista sem corrida gravada é considerada abandonada após este tempo (segundos)
+DRIVER_CLAIM_ORPHAN_SECONDS = 30.0
+
+
+class RideConflictError(ValueError):
+    """A corrida mudou (outra versão) entre a leitura e a escrita da transição"""
+
+
 class UserService:
     """Serviço para gestão de usuários e ride requests"""
     
-    def __init__(self):
+    def __init__(self, backend: Optional[StateBackend] = None, columns: Optional[ColumnarRideStore] = None,
+                 locations: Optional[DriverLocationIndex] = None, routes: Optional[RouteMetricsCalculator] = None,
+                 geofences: Optional[GeofenceMonitor] = None, traces: Optional[TraceStore] = None,
+                 demand: Optional[DemandHeatmap] = None, sync_interval: float = 0.0):
         # Cache em memória para demonstração
         # Em produção, usar banco de dados real
+        # Corridas e notificações ficam como registros compactos (records.py),
+        # também retornados pelos métodos públicos; os modelos Pydantic só
+        # existem na fronteira da API (entrada validada, to_dict na resposta)
         self.users: Dict[str, User] = {}
-        self.ride_requests: Dict[str, RideRequest] = {}
-        self.notifications: Dict[str, List[NotificationData]] = {}
+        self.ride_requests: Dict[str, RideRecord] = {}
+        self.notifications: Dict[str, List[NotificationRecord]] = {}
+        
+        # Índices secundários, mantidos em todo caminho de escrita/replicação
+        self._ride_ids_by_user: Dict[str, Set[str]] = {}
+        self._active_ride_by_driver: Dict[str, str] = {}
+        
+        # Colunas opcionais para varreduras administrativas (columnar.py)
+        self.columns = columns
+        
+        # Última posição de cada motorista (locations.py), local a este worker
+        self.locations = locations if locations is not None else DriverLocationIndex()
+        
+        # Distância e ETA por rota, calculadas sob demanda e em cache (route_metrics.py)
+        self.routes = routes if routes is not None else RouteMetricsCalculator()
+        
+        # Checkpoints automáticos das corridas em andamento pelos pings (geofences.py)
+        self.geofences = geofences
+        
+        # Trajeto GPS simplificado das corridas em andamento (traces.py)
+        self.traces = traces
+        
+        # Origens das corridas por geohash e hora, contadas na primeira vez que cada uma aparece (demand.py)
+        self.demand = demand
+        
+        # Com backend compartilhado, os dicionários acima são um espelho local
+        # sincronizado pelo feed de mudanças (um por worker), consultado no
+        # máximo a cada `sync_interval` segundos nas leituras comuns
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self._cursor = 0
+        self._own_writes: Dict[Tuple[str, str], int] = {}
+        self._synced_at = 0.0
+        self._pings_synced_at = 0.0
+        self._sync(force=True)
         
         # Inicializar com dados de demonstração
         self._initialize_demo_data()
@@ -53,19 +124,273 @@ class UserService:
         ]
         
         for user in demo_users:
-            self.users[user.id] = user
-            self.notifications[user.id] = []
+            if self.backend:
+                # Vários workers inicializam ao mesmo tempo; só o primeiro grava
+                self.backend.add("users", user.id, user.model_dump(mode="json"))
+            else:
+                self._apply_user(user)
+        self._sync(force=True)
             
         logger.info(f"Inicializado com {len(demo_users)} usuários de demonstração")
     
+    # =================== ESTADO COMPARTILHADO ===================
+    
+    def _sync(self, force: bool = False):
+        """Aplica ao espelho local as mudanças gravadas por outros workers
+        
+        Sem `force`, não consulta o backend se a última sincronização foi há
+        menos de `sync_interval` segundos: leituras podem ver o estado de
+        até esse tempo atrás. Quem não encontra o que procura (ID criado em
+        outro worker) ou perde um compare-and-set sincroniza com force.
+        """
+        if not self.backend:
+            return
+        now = time.monotonic()
+        if not force and now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        
+        namespaces = ("users", "ride_requests", "notifications")
+        if self.geofences is not None:
+            # Checkpoints disparados em outros workers avançam os geofences daqui
+            namespaces += (GeofenceMonitor.NAMESPACE,)
+        self._cursor, changes = self.backend.changes_since(self._cursor, namespaces)
+        for seq, namespace, key, value in changes:
+            # Escritas deste próprio worker já estão aplicadas no espelho
+            if self._own_writes.pop((namespace, key), None) == seq:
+                continue
+            if namespace == "users" and value is not None:
+                self._apply_user(User.model_validate(value))
+            elif namespace == "ride_requests" and value is not None:
+                self._apply_ride(RideRecord.from_model(RideRequest.model_validate(value)))
+            elif namespace == "notifications":
+                user_id, notification_id = key.split("/", 1)
+                if value is None:
+                    self._remove_notification(user_id, notification_id)
+                else:
+                    self._apply_notification(NotificationRecord.from_model(NotificationData.model_validate(value)))
+            elif namespace == GeofenceMonitor.NAMESPACE:
+                trip_id, event = key.rsplit("/", 1)
+                self.geofences.observe(trip_id, event, value is not None)
+    
+    def _write(self, namespace: str, key: str, value: Optional[Dict[str, Any]]):
+        """Grava no backend compartilhado, se houver"""
+        if not self.backend:
+            return
+        if value is None:
+            seq = self.backend.delete(namespace, key)
+        else:
+            seq = self.backend.put(namespace, key, value)
+        self._own_writes[(namespace, key)] = seq
+    
+    def _record_own_writes(self, writes: List[Tuple[str, str, Optional[Dict[str, Any]]]], seqs: List[int]):
+        for (namespace, key, _), seq in zip(writes, seqs):
+            self._own_writes[(namespace, key)] = seq
+    
+    def _apply_user(self, user: User):
+        self.users[user.id] = user
+        self.notifications.setdefault(user.id, [])
+    
+    def _apply_ride(self, ride_request: RideRecord):
+        if self.demand is not None and ride_request.id not in self.ride_requests:
+            coordinates = ride_request.trip.coordinates
+            if coordinates and not math.isnan(coordinates[0]):
+                self.demand.add(coordinates[0], coordinates[1], ride_request.created_at / 1_000_000)
+        self.ride_requests[ride_request.id] = ride_request
+        
+        for user_id in (ride_request.driver_id, ride_request.enterprise_id):
+            self._ride_ids_by_user.setdefault(user_id, set()).add(ride_request.id)
+        
+        if ride_request.status in ACTIVE_RIDE_STATUSES:
+            self._active_ride_by_driver[ride_request.driver_id] = ride_request.id
+        elif self._active_ride_by_driver.get(ride_request.driver_id) == ride_request.id:
+            del self._active_ride_by_driver[ride_request.driver_id]
+        
+        if self.columns is not None:
+            self.columns.upsert(ride_request)
+        
+        if self.geofences is not None:
+            if ride_request.status == RideStatus.EM_ANDAMENTO:
+                self.geofences.arm(ride_request.driver_id, ride_request.trip.trip_id, ride_request.trip.coordinates)
+            else:
+                self.geofences.disarm(ride_request.driver_id, ride_request.trip.trip_id)
+        
+        if self.traces is not None:
+            if ride_request.status == RideStatus.EM_ANDAMENTO:
+                self.traces.start(ride_request.driver_id, ride_request.trip.trip_id)
+            else:
+                self.traces.finish(ride_request.trip.trip_id)
+    
+    def _apply_notification(self, notification: NotificationRecord):
+        notifications = self.notifications.setdefault(notification.user_id, [])
+        for index, existing in enumerate(notifications):
+            if existing.id == notification.id:
+                notifications[index] = notification
+                return
+        notifications.append(notification)
+    
+    def _remove_notification(self, user_id: str, notification_id: str):
+        notifications = self.notifications.get(user_id, [])
+        self.notifications[user_id] = [n for n in notifications if n.id != notification_id]
+    
+    def _save_user(self, user: User):
+        self._apply_user(user)
+        self._write("users", user.id, user.model_dump(mode="json"))
+    
+    def _save_ride(self, ride_request: RideRecord):
+        self._apply_ride(ride_request)
+        # Sem backend não há por que montar o modelo só para serializar
+        if self.backend:
+            self._write("ride_requests", ride_request.id, ride_request.to_model().model_dump(mode="json"))
+    
+    def _transition_ride(self, request_id: str, change: Callable[[RideRecord], None],
+                         expected_version: Optional[int] = None) -> RideRecord:
+        """Aplica uma transição de status por compare-and-set na versão da corrida
+        
+        `change` valida o estado (ValueError) e altera uma cópia do registro;
+        a cópia só substitui a corrida se a versão gravada ainda for a lida,
+        sem trava global: transições concorrentes na mesma corrida (neste ou
+        em outro worker) têm um único vencedor, e a perdedora revalida sobre
+        o estado novo. `expected_version` é a versão vista pelo cliente.
+        """
+        for attempt in range(MAX_TRANSITION_ATTEMPTS):
+            # Depois de perder o compare-and-set, relê o estado atual do backend
+            self._sync(force=attempt > 0)
+            current = self.ride_requests.get(request_id)
+            if not current and attempt == 0:
+                self._sync(force=True)
+                current = self.ride_requests.get(request_id)
+            if not current:
+                raise ValueError("Solicitação não encontrada")
+            if expected_version is not None and current.version != expected_version:
+                raise RideConflictError(
+                    f"Corrida alterada por outra requisição (versão atual {current.version}, esperada {expected_version})"
+                )
+            
+            updated = copy.copy(current)
+            change(updated)
+            updated.version = current.version + 1
+            if self._compare_and_save_ride(updated, current.version):
+                if updated.status not in ACTIVE_RIDE_STATUSES:
+                    self._release_driver(updated.driver_id, updated.id)
+                return updated
+        raise RideConflictError("Corrida alterada concorrentemente; tente novamente")
+    
+    def _compare_and_save_ride(self, ride_request: RideRecord, expected_version: int) -> bool:
+        if self.backend:
+            seq = self.backend.compare_and_put(
+                "ride_requests", ride_request.id, ride_request.to_model().model_dump(mode="json"),
+                lambda stored: stored is not None and stored.get("version", 1) == expected_version
+            )
+            if seq is None:
+                return False
+            self._own_writes[("ride_requests", ride_request.id)] = seq
+        elif self.ride_requests[ride_request.id].version != expected_version:
+            return False
+        self._apply_ride(ride_request)
+        return True
+    
+    def _claim_driver(self, driver_id: str, request_id: str) -> bool:
+        """Reserva o motorista para a corrida entre workers (add atômico no backend)
+        
+        A reserva expira quando a corrida deixa de estar ativa
+        (_release_driver); se isso se perder, ela é tomada pela próxima
+        corrida quando a reservada não está ativa (ou nunca foi gravada).
+        """
+        if not self.backend:
+            return True
+        claim = {"ride_id": request_id, "claimed_at": time.time()}
+        if self.backend.add("driver_claims", driver_id, claim):
+            return True
+        
+        held = self.backend.get("driver_claims", driver_id)
+        held_ride_id = held["ride_id"] if held else None
+        stored = self.backend.get("ride_requests", held_ride_id) if held_ride_id else None
+        if stored is not None:
+            if RideStatus(stored["status"]) in ACTIVE_RIDE_STATUSES:
+                return False
+        elif held and time.time() - held["claimed_at"] < DRIVER_CLAIM_ORPHAN_SECONDS:
+            # Outro worker acabou de reservar e ainda vai gravar a corrida
+            return False
+        return self.backend.compare_and_put(
+            "driver_claims", driver_id, claim,
+            lambda current: (current["ride_id"] if current else None) == held_ride_id
+        ) is not None
+    
+    def _claim_drivers(self, claims: Dict[str, str]) -> Set[str]:
+        """_claim_driver de vários motoristas (motorista -> corrida) numa transação
+        
+        Só os já reservados por outra corrida seguem o caminho individual.
+        Faz I/O no backend: chamado numa thread.
+        """
+        if not self.backend:
+            return set(claims)
+        now = time.time()
+        claimed = set(self.backend.add_many(
+            "driver_claims", {driver_id: {"ride_id": request_id, "claimed_at": now} for driver_id, request_id in claims.items()}
+        ))
+        return claimed | {
+            driver_id for driver_id, request_id in claims.items()
+            if driver_id not in claimed and self._claim_driver(driver_id, request_id)
+        }
+    
+    def _release_driver(self, driver_id: str, request_id: str):
+        """Expira a reserva do motorista se ela ainda for desta corrida"""
+        if not self.backend:
+            return
+        self.backend.compare_and_put(
+            "driver_claims", driver_id, {"ride_id": request_id, "claimed_at": time.time()},
+            lambda current: current is not None and current["ride_id"] == request_id, ttl=0
+        )
+    
+    def _save_notification(self, notification: NotificationRecord,
+                           writes: Optional[List[Tuple[str, str, Optional[Dict[str, Any]]]]] = None):
+        if self.backend:
+            key = f"{notification.user_id}/{notification.id}"
+            value = notification.to_model().model_dump(mode="json")
+            if writes is not None:
+                writes.append(("notifications", key, value))
+            else:
+                self._write("notifications", key, value)
+    
+    def store_sizes(self) -> Dict[str, int]:
+        """Tamanho de cada estrutura em memória (para métricas)"""
+        return {
+            "users": len(self.users),
+            "ride_requests": len(self.ride_requests),
+            "notifications": sum(len(n) for n in self.notifications.values()),
+            "index_rides_by_user": sum(len(ids) for ids in self._ride_ids_by_user.values()),
+            "index_active_ride_by_driver": len(self._active_ride_by_driver),
+            "driver_locations": len(self.locations),
+            "route_metrics_cache": len(self.routes),
+            "geofence_trips": len(self.geofences) if self.geofences is not None else 0,
+            "active_traces": len(self.traces) if self.traces is not None else 0,
+            "demand_buckets": len(self.demand) if self.demand is not None else 0,
+        }
+    
+    # =================== USUÁRIOS ===================
+    
+    @traced()
     async def get_user(self, user_id: str) -> Optional[User]:
         """Obtém um usuário pelo ID"""
+        self._sync()
+        if user_id not in self.users:
+            self._sync(force=True)
         return self.users.get(user_id)
     
+    @traced()
+    async def list_users(self) -> List[User]:
+        """Lista todos os usuários"""
+        self._sync()
+        return list(self.users.values())
+    
+    @traced()
     async def get_users_by_role(self, role: UserRole) -> List[User]:
         """Obtém todos os usuários de uma role específica"""
+        self._sync()
         return [user for user in self.users.values() if user.role == role and user.is_active]
     
+    @traced()
     async def create_user(self, user_data: Dict) -> User:
         """Cria um novo usuário"""
         user_id = user_data.get("id") or f"{user_data['role'].upper()}-{uuid.uuid4().hex[:8]}"
@@ -78,13 +403,13 @@ class UserService:
             created_at=datetime.utcnow()
         )
         
-        self.users[user_id] = user
-        self.notifications[user_id] = []
+        self._save_user(user)
         
         logger.info(f"Usuário criado: {user_id} ({user.role})")
         return user
     
-    async def create_ride_request(self, enterprise_id: str, driver_id: str, trip_data) -> RideRequest:
+    @traced()
+    async def create_ride_request(self, enterprise_id: str, driver_id: str, trip_data) -> RideRecord:
         """Cria uma nova solicitação de corrida"""
         # Validações
         enterprise = await self.get_user(enterprise_id)
@@ -95,27 +420,26 @@ class UserService:
         if not driver or driver.role != UserRole.DRIVER:
             raise ValueError("Motorista não encontrado ou inválido")
         
-        # Verifica se o driver já tem uma corrida pendente ou em andamento
-        active_requests = [
-            req for req in self.ride_requests.values() 
-            if req.driver_id == driver_id and req.status in [RideStatus.PENDENTE, RideStatus.ACEITO, RideStatus.EM_ANDAMENTO]
-        ]
-        
-        if active_requests:
+        # Verifica se o driver já tem uma corrida pendente ou em andamento; a
+        # reserva no backend fecha a janela entre a verificação e a gravação
+        # quando outro worker cria uma corrida para o mesmo motorista
+        request_id = f"REQ-{uuid.uuid4().hex[:8]}"
+        if driver_id in self._active_ride_by_driver or not self._claim_driver(driver_id, request_id):
             raise ValueError("Motorista já possui uma corrida ativa")
         
         # Cria a solicitação
-        request_id = f"REQ-{uuid.uuid4().hex[:8]}"
-        ride_request = RideRequest(
+        set_attribute("ride.id", request_id)
+        set_attribute("trip.id", trip_data.trip_id)
+        ride_request = RideRecord(
             id=request_id,
             enterprise_id=enterprise_id,
             driver_id=driver_id,
-            trip_data=trip_data,
+            trip=TripRecord.from_model(trip_data),
             status=RideStatus.PENDENTE,
-            created_at=datetime.utcnow()
+            created_at=to_micros(datetime.utcnow())
         )
         
-        self.ride_requests[request_id] = ride_request
+        self._save_ride(ride_request)
         
         # Criar notificação para o driver
         await self._create_notification(
@@ -126,24 +450,94 @@ class UserService:
             {"ride_request_id": request_id, "enterprise_name": enterprise.name}
         )
         
-        logger.info(f"Solicitação de corrida criada: {request_id} (Enterprise: {enterprise_id}, Driver: {driver_id})")
+        logger.info("Solicitação de corrida criada: %s (Enterprise: %s, Driver: %s)", request_id, enterprise_id, driver_id)
         return ride_request
     
-    async def accept_ride_request(self, request_id: str, driver_id: str) -> RideRequest:
+    @traced()
+    async def create_ride_requests_bulk(self, assignments: List[Tuple[str, str, Any]]) -> List[Optional[RideRecord]]:
+        """Cria várias corridas de uma vez (despacho automático)
+        
+        `assignments` traz tuplas (enterprise_id, driver_id, trip_data). As
+        validações de create_ride_request valem para cada item, mas uma
+        sincronização e um horário servem ao lote todo; itens inválidos (ex:
+        motorista que ficou ocupado) resultam em None na posição. As
+        reservas de motorista e as gravações do lote são uma transação cada
+        no backend, numa thread, fora do event loop.
+        """
+        self._sync()
+        created_at = to_micros(datetime.utcnow())
+        enterprises: Dict[str, Optional[User]] = {}
+        candidates: Dict[int, Tuple[User, str]] = {}
+        claims: Dict[str, str] = {}
+        for index, (enterprise_id, driver_id, trip_data) in enumerate(assignments):
+            if enterprise_id not in enterprises:
+                enterprise = self.users.get(enterprise_id)
+                enterprises[enterprise_id] = enterprise if enterprise and enterprise.role == UserRole.ENTERPRISE else None
+            enterprise = enterprises[enterprise_id]
+            driver = self.users.get(driver_id)
+            if (not enterprise or not driver or driver.role != UserRole.DRIVER
+                    or driver_id in self._active_ride_by_driver or driver_id in claims):
+                continue
+            request_id = f"REQ-{uuid.uuid4().hex[:8]}"
+            candidates[index] = (enterprise, request_id)
+            claims[driver_id] = request_id
+        
+        claimed = await asyncio.to_thread(self._claim_drivers, claims) if self.backend else set(claims)
+        
+        results: List[Optional[RideRecord]] = [None] * len(assignments)
+        writes: List[Tuple[str, str, Optional[Dict[str, Any]]]] = []
+        for index, (enterprise, request_id) in candidates.items():
+            enterprise_id, driver_id, trip_data = assignments[index]
+            if driver_id not in claimed:
+                continue
+            ride_request = RideRecord(
+                id=request_id,
+                enterprise_id=enterprise_id,
+                driver_id=driver_id,
+                trip=TripRecord.from_model(trip_data),
+                status=RideStatus.PENDENTE,
+                created_at=created_at
+            )
+            if self.backend:
+                writes.append(("ride_requests", request_id, ride_request.to_model().model_dump(mode="json")))
+            self._add_notification(
+                driver_id,
+                "ride_request",
+                "Nova Corrida Disponível",
+                f"A empresa {enterprise.name} enviou uma solicitação de corrida.",
+                {"ride_request_id": request_id, "enterprise_name": enterprise.name},
+                created_at,
+                writes
+            )
+            results[index] = ride_request
+        
+        # As corridas só entram no espelho depois de gravadas: uma transição feita
+        # nelas antes disso não encontraria a versão no backend
+        if writes:
+            self._record_own_writes(writes, await asyncio.to_thread(self.backend.put_many, writes))
+        for ride_request in results:
+            if ride_request is not None:
+                self._apply_ride(ride_request)
+        
+        created = sum(1 for ride_request in results if ride_request is not None)
+        set_attribute("rides.created", created)
+        logger.info("Solicitações de corrida criadas em lote: %d de %d", created, len(assignments))
+        return results
+    
+    @traced()
+    async def accept_ride_request(self, request_id: str, driver_id: str, version: Optional[int] = None) -> RideRecord:
         """Driver aceita uma solicitação de corrida"""
-        ride_request = self.ride_requests.get(request_id)
-        if not ride_request:
-            raise ValueError("Solicitação não encontrada")
-        
-        if ride_request.driver_id != driver_id:
-            raise ValueError("Apenas o motorista designado pode aceitar esta corrida")
-        
-        if ride_request.status != RideStatus.PENDENTE:
-            raise ValueError(f"Corrida não pode ser aceita. Status atual: {ride_request.status}")
+        def accept(ride_request: RideRecord):
+            if ride_request.driver_id != driver_id:
+                raise ValueError("Apenas o motorista designado pode aceitar esta corrida")
+            
+            if ride_request.status != RideStatus.PENDENTE:
+                raise ValueError(f"Corrida não pode ser aceita. Status atual: {ride_request.status}")
+            
+            ride_request.status = RideStatus.ACEITO
+            ride_request.accepted_at = to_micros(datetime.utcnow())
         
-        # Atualiza status
-        ride_request.status = RideStatus.ACEITO
-        ride_request.accepted_at = datetime.utcnow()
+        ride_request = self._transition_ride(request_id, accept, version)
         
         # Notifica a empresa
         enterprise = await self.get_user(ride_request.enterprise_id)
@@ -157,25 +551,25 @@ class UserService:
             {"ride_request_id": request_id, "driver_name": driver.name}
         )
         
-        logger.info(f"Corrida aceita: {request_id} por {driver_id}")
+        logger.info("Corrida aceita: %s por %s", request_id, driver_id)
         return ride_request
     
-    async def reject_ride_request(self, request_id: str, driver_id: str, reason: Optional[str] = None) -> RideRequest:
+    @traced()
+    async def reject_ride_request(self, request_id: str, driver_id: str, reason: Optional[str] = None,
+                                  version: Optional[int] = None) -> RideRecord:
         """Driver rejeita uma solicitação de corrida"""
-        ride_request = self.ride_requests.get(request_id)
-        if not ride_request:
-            raise ValueError("Solicitação não encontrada")
-        
-        if ride_request.driver_id != driver_id:
-            raise ValueError("Apenas o motorista designado pode rejeitar esta corrida")
-        
-        if ride_request.status != RideStatus.PENDENTE:
-            raise ValueError(f"Corrida não pode ser rejeitada. Status atual: {ride_request.status}")
+        def reject(ride_request: RideRecord):
+            if ride_request.driver_id != driver_id:
+                raise ValueError("Apenas o motorista designado pode rejeitar esta corrida")
+            
+            if ride_request.status != RideStatus.PENDENTE:
+                raise ValueError(f"Corrida não pode ser rejeitada. Status atual: {ride_request.status}")
+            
+            ride_request.status = RideStatus.RECUSADO
+            ride_request.rejected_at = to_micros(datetime.utcnow())
+            ride_request.rejection_reason = reason
         
-        # Atualiza status
-        ride_request.status = RideStatus.RECUSADO
-        ride_request.rejected_at = datetime.utcnow()
-        ride_request.rejection_reason = reason
+        ride_request = self._transition_ride(request_id, reject, version)
         
         # Notifica a empresa
         enterprise = await self.get_user(ride_request.enterprise_id)
@@ -190,24 +584,23 @@ class UserService:
             {"ride_request_id": request_id, "driver_name": driver.name, "reason": reason}
         )
         
-        logger.info(f"Corrida rejeitada: {request_id} por {driver_id}. Motivo: {reason}")
+        logger.info("Corrida rejeitada: %s por %s. Motivo: %s", request_id, driver_id, reason)
         return ride_request
     
-    async def start_ride(self, request_id: str, enterprise_id: str) -> RideRequest:
+    @traced()
+    async def start_ride(self, request_id: str, enterprise_id: str, version: Optional[int] = None) -> RideRecord:
         """Enterprise inicia uma corrida aceita"""
-        ride_request = self.ride_requests.get(request_id)
-        if not ride_request:
-            raise ValueError("Solicitação não encontrada")
-        
-        if ride_request.enterprise_id != enterprise_id:
-            raise ValueError("Apenas a empresa solicitante pode iniciar esta corrida")
-        
-        if ride_request.status != RideStatus.ACEITO:
-            raise ValueError(f"Corrida não pode ser iniciada. Status atual: {ride_request.status}")
+        def start(ride_request: RideRecord):
+            if ride_request.enterprise_id != enterprise_id:
+                raise ValueError("Apenas a empresa solicitante pode iniciar esta corrida")
+            
+            if ride_request.status != RideStatus.ACEITO:
+                raise ValueError(f"Corrida não pode ser iniciada. Status atual: {ride_request.status}")
+            
+            ride_request.status = RideStatus.EM_ANDAMENTO
+            ride_request.started_at = to_micros(datetime.utcnow())
         
-        # Atualiza status
-        ride_request.status = RideStatus.EM_ANDAMENTO
-        ride_request.started_at = datetime.utcnow()
+        ride_request = self._transition_ride(request_id, start, version)
         
         # Notifica o driver
         await self._create_notification(
@@ -218,26 +611,27 @@ class UserService:
             {"ride_request_id": request_id}
         )
         
-        logger.info(f"Corrida iniciada: {request_id}")
+        logger.info("Corrida iniciada: %s", request_id)
         return ride_request
     
-    async def get_ride_requests_for_user(self, user_id: str, status: Optional[RideStatus] = None) -> List[RideRequest]:
+    @traced()
+    async def get_ride_requests_for_user(self, user_id: str, status: Optional[RideStatus] = None) -> List[RideRecord]:
         """Obtém solicitações de corrida para um usuário"""
         user = await self.get_user(user_id)
         if not user:
             return []
         
-        requests = []
-        for ride_request in self.ride_requests.values():
-            # Driver vê apenas suas próprias solicitações
-            if user.role == UserRole.DRIVER and ride_request.driver_id == user_id:
-                requests.append(ride_request)
-            # Enterprise vê apenas suas próprias solicitações
-            elif user.role == UserRole.ENTERPRISE and ride_request.enterprise_id == user_id:
-                requests.append(ride_request)
-            # Admin vê todas
-            elif user.role == UserRole.ADMIN:
-                requests.append(ride_request)
+        # Admin vê todas
+        if user.role == UserRole.ADMIN:
+            requests = list(self.ride_requests.values())
+        # Driver e Enterprise veem apenas suas próprias solicitações
+        else:
+            requests = []
+            for request_id in self._ride_ids_by_user.get(user_id, ()):
+                ride_request = self.ride_requests[request_id]
+                if (user.role == UserRole.DRIVER and ride_request.driver_id == user_id) or \
+                   (user.role == UserRole.ENTERPRISE and ride_request.enterprise_id == user_id):
+                    requests.append(ride_request)
         
         # Filtro por status se especificado
         if status:
@@ -247,45 +641,232 @@ class UserService:
         requests.sort(key=lambda x: x.created_at, reverse=True)
         return requests
     
-    async def get_ride_request(self, request_id: str) -> Optional[RideRequest]:
+    @traced()
+    async def get_ride_request(self, request_id: str) -> Optional[RideRecord]:
         """Obtém uma solicitação específica"""
+        self._sync()
+        if request_id not in self.ride_requests:
+            self._sync(force=True)
         return self.ride_requests.get(request_id)
     
+    @traced("UserService.create_notification")
     async def _create_notification(self, user_id: str, notification_type: str, title: str, message: str, data: Optional[Dict] = None):
         """Cria uma notificação para um usuário"""
-        notification = NotificationData(
+        set_attribute("notification.type", notification_type)
+        self._add_notification(user_id, notification_type, title, message, data)
+    
+    def _add_notification(self, user_id: str, notification_type: str, title: str, message: str,
+                          data: Optional[Dict] = None, created_at: Optional[int] = None,
+                          writes: Optional[List[Tuple[str, str, Optional[Dict[str, Any]]]]] = None):
+        """Adiciona a notificação; com `writes`, as gravações no backend vão para a lista (lotes)"""
+        notification = NotificationRecord(
             id=f"NOTIF-{uuid.uuid4().hex[:8]}",
             user_id=user_id,
             type=notification_type,
             title=title,
             message=message,
-            data=data or {}
+            data=data,
+            created_at=created_at
         )
         
         if user_id not in self.notifications:
             self.notifications[user_id] = []
         
         self.notifications[user_id].append(notification)
+        self._save_notification(notification, writes)
         
         # Manter apenas as últimas 50 notificações por usuário
-        if len(self.notifications[user_id]) > 50:
-            self.notifications[user_id] = self.notifications[user_id][-50:]
+        if len(self.notifications[user_id]) > MAX_NOTIFICATIONS_PER_USER:
+            for expired in self.notifications[user_id][:-MAX_NOTIFICATIONS_PER_USER]:
+                if writes is not None:
+                    if self.backend:
+                        writes.append(("notifications", f"{user_id}/{expired.id}", None))
+                else:
+                    self._write("notifications", f"{user_id}/{expired.id}", None)
+            self.notifications[user_id] = self.notifications[user_id][-MAX_NOTIFICATIONS_PER_USER:]
+    
+    async def notify(self, user_id: str, notification_type: str, title: str, message: str, data: Optional[Dict] = None):
+        """Cria uma notificação para um usuário (uso por outros serviços, ex: despacho)"""
+        await self._create_notification(user_id, notification_type, title, message, data)
     
-    async def get_notifications(self, user_id: str, unread_only: bool = False) -> List[NotificationData]:
+    @traced()
+    async def get_notifications(self, user_id: str, unread_only: bool = False) -> List[NotificationRecord]:
         """Obtém notificações de um usuário"""
+        self._sync()
         notifications = self.notifications.get(user_id, [])
         
         if unread_only:
             notifications = [n for n in notifications if not n.read]
         
-        # Ordena por data (mais recentes primeiro)
-        notifications.sort(key=lambda x: x.created_at, reverse=True)
-        return notifications
+        # Ordena por data (mais recentes primeiro), sem reordenar a lista armazenada
+        return sorted(notifications, key=lambda x: x.created_at, reverse=True)
     
+    @traced()
     async def mark_notification_read(self, user_id: str, notification_id: str):
         """Marca uma notificação como lida"""
+        self._sync()
         notifications = self.notifications.get(user_id, [])
         for notification in notifications:
             if notification.id == notification_id:
                 notification.read = True
-                break
\ No newline at end of file
+                self._save_notification(notification)
+                break
+    
+    # =================== LOCALIZAÇÃO DE MOTORISTAS ===================
+    
+    def is_driver_available(self, driver_id: str) -> bool:
+        """Motorista ativo e sem corrida pendente, aceita ou em andamento"""
+        user = self.users.get(driver_id)
+        return (user is not None and user.role == UserRole.DRIVER and user.is_active
+                and driver_id not in self._active_ride_by_driver)
+    
+    def available_driver_positions(self) -> List[Tuple[str, float, float]]:
+        """(driver_id, lat, lng) dos motoristas disponíveis com posição recente"""
+        self._sync()
+        return [position for position in self.locations.fresh() if self.is_driver_available(position[0])]
+    
+    async def update_driver_location(self, driver_id: str, lat: float, lng: float,
+                                     recorded_at: Optional[datetime] = None) -> Dict[str, Any]:
+        """Registra um ping de posição e verifica os geofences da corrida em andamento
+        
+        Retorna accepted=False se o ping for mais antigo que o último, e os
+        checkpoints disparados por ele.
+        """
+        self._sync_pings()
+        user = self.users.get(driver_id)
+        if user is None:
+            # Motorista criado em outro worker ainda não sincronizado
+            self._sync(force=True)
+            user = self.users.get(driver_id)
+        if not user or user.role != UserRole.DRIVER:
+            raise ValueError("Motorista não encontrado ou inválido")
+        
+        return self._apply_ping(driver_id, lat, lng, recorded_at)
+    
+    async def update_driver_locations(self, pings: List[Tuple[str, float, float, Optional[datetime]]]) -> Dict[str, Any]:
+        """Vários pings (driver_id, lat, lng, recorded_at) de uma vez, na ordem recebida
+        
+        Pings de IDs que não são motoristas são contados em `unknown` em vez
+        de invalidar o lote.
+        """
+        self._sync_pings()
+        accepted = ignored = unknown = 0
+        checkpoints: List[Dict[str, str]] = []
+        for driver_id, lat, lng, recorded_at in pings:
+            user = self.users.get(driver_id)
+            if not user or user.role != UserRole.DRIVER:
+                unknown += 1
+                continue
+            result = self._apply_ping(driver_id, lat, lng, recorded_at)
+            if result["accepted"]:
+                accepted += 1
+                checkpoints.extend(result["checkpoints"])
+            else:
+                ignored += 1
+        return {"accepted": accepted, "ignored": ignored, "unknown": unknown, "checkpoints": checkpoints}
+    
+    def _sync_pings(self):
+        # Pings chegam em alta frequência: sincroniza no máximo a cada PING_SYNC_INTERVAL
+        # segundos (corridas iniciadas em outro worker armam os geofences aqui)
+        if self.backend and time.monotonic() - self._pings_synced_at > PING_SYNC_INTERVAL:
+            self._pings_synced_at = time.monotonic()
+            self._sync(force=True)
+    
+    def _apply_ping(self, driver_id: str, lat: float, lng: float, recorded_at: Optional[datetime]) -> Dict[str, Any]:
+        at = to_micros(recorded_at) / 1_000_000 if recorded_at is not None else None
+        if not self.locations.update(driver_id, lat, lng, at):
+            return {"accepted": False, "checkpoints": []}
+        if self.traces is not None:
+            self.traces.record(driver_id, lat, lng, at)
+        fired = self.geofences.check(driver_id, lat, lng) if self.geofences is not None else []
+        if self.traces is not None:
+            # A chegada encerra o trajeto, mesmo com a corrida ainda em andamento
+            for trip_id, event in fired:
+                if event == "chegada":
+                    self.traces.finish(trip_id)
+        return {"accepted": True, "checkpoints": [{"trip_id": trip_id, "event": event} for trip_id, event in fired]}
+    
+    @traced()
+    async def nearest_available_drivers(self, lat: float, lng: float, k: int = 5,
+                                        max_km: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Os k motoristas disponíveis mais próximos de (lat, lng) com posição recente"""
+        self._sync()
+        now = time.time()
+        drivers = []
+        for distance, driver_id in self.locations.nearest(lat, lng, k, self.is_driver_available, max_km, now):
+            driver_lat, driver_lng, at = self.locations.get(driver_id)
+            drivers.append({
+                "driver_id": driver_id,
+                "name": self.users[driver_id].name,
+                "lat": driver_lat,
+                "lng": driver_lng,
+                "distance_km": round(distance, 3),
+                "age_seconds": round(max(0.0, now - at), 1),
+            })
+        return drivers
+    
+    # =================== MÉTRICAS DE ROTA ===================
+    
+    def route_metrics(self, rides: List[RideRecord]) -> List[RouteMetrics]:
+        """Distância e ETA da rota de cada corrida, calculadas em lote (com cache por rota)"""
+        return self.routes.metrics([(ride.trip.route, ride.trip.coordinates) for ride in rides])
+    
+    # =================== VARREDURAS ===================
+    
+    @traced()
+    async def scan_rides(self, status: Optional[RideStatus] = None, created_from: Optional[datetime] = None,
+                         created_to: Optional[datetime] = None, driver_id: Optional[str] = None,
+                         enterprise_id: Optional[str] = None, limit: int = 100, offset: int = 0) -> Dict[str, Any]:
+        """Varredura administrativa de todas as corridas (created_to exclusivo)
+        
+        Retorna o total, a contagem por status (ignorando o filtro de status)
+        e uma página das corridas mais recentes. Usa o store colunar quando
+        configurado; caso contrário percorre os registros.
+        """
+        self._sync()
+        start, end = to_micros(created_from), to_micros(created_to)
+        
+        if self.columns is not None:
+            rows = self.columns.select(None, start, end, driver_id, enterprise_id)
+            by_status = self.columns.count_by_status(rows)
+            if status is not None:
+                rows = self.columns.with_status(rows, status)
+            total = len(rows)
+            page = self.columns.newest(rows, offset + limit)[offset:]
+            rides = [self.ride_requests[request_id] for request_id in page]
+        else:
+            matches = [
+                ride for ride in self.ride_requests.values()
+                if (start is None or ride.created_at >= start) and (end is None or ride.created_at < end)
+                and (driver_id is None or ride.driver_id == driver_id)
+                and (enterprise_id is None or ride.enterprise_id == enterprise_id)
+            ]
+            by_status = {s.value: 0 for s in RideStatus}
+            for ride in matches:
+                by_status[ride.status.value] += 1
+            if status is not None:
+                matches = [ride for ride in matches if ride.status == status]
+            total = len(matches)
+            matches.sort(key=lambda x: x.created_at, reverse=True)
+            rides = matches[offset:offset + limit]
+        
+        return {
+            "total": total,
+            "by_status": by_status,
+            "ride_requests": rides,
+        }
+    
+    @traced()
+    async def demand_heatmap(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                             created_from: datetime, created_to: datetime, precision: int) -> Dict[str, Any]:
+        """Origens das corridas por célula de geohash na caixa e no intervalo (created_to exclusivo)
+        
+        Lê os contadores pré-agregados (demand.py), sem percorrer as corridas.
+        """
+        if self.demand is None:
+            raise ValueError("Heatmap de demanda desabilitado")
+        self._sync()
+        return self.demand.query(
+            min_lat, min_lng, max_lat, max_lng,
+            to_micros(created_from) / 1_000_000, to_micros(created_to) / 1_000_000, precision
+        )